@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+"""Compares two benchmark runs produced by run.py by their median times.
+
+    python benchmarks/compare.py before.json after.json
+"""
+import sys
+import json
+
+
+def load(path):
+    with open(path) as f:
+        report = json.load(f)
+
+    results = {}
+    for entry in report['results']:
+        key = (entry['benchmark'], entry['profile'], entry.get('repos'))
+        results[key] = entry
+    return report['metadata'], results
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        sys.exit(__doc__.strip())
+
+    before_meta, before = load(argv[0])
+    after_meta, after = load(argv[1])
+    print(f"before: {before_meta.get('commit')}  after: {after_meta.get('commit')}")
+    print(f"{'benchmark':<10} {'profile':<14} {'repos':>7} {'before (s)':>12} {'after (s)':>12} {'change':>8}")
+
+    for key in sorted(set(before) & set(after), key=lambda k: (k[0], k[1], k[2] or 0)):
+        old = before[key]['seconds']['median']
+        new = after[key]['seconds']['median']
+        change = f"{(new - old) / old * 100:+.1f}%" if old else 'n/a'
+        benchmark, profile, repos = key
+        print(f"{benchmark:<10} {profile:<14} {repos or '':>7} {old:>12.4f} {new:>12.4f} {change:>8}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""Clone, fetch, push and hag ls benchmarks for hcli_hag.
+
+Synthetic repositories are generated under a scratch directory and served from this process through
+WSGIApp.server(). Results are written as JSON so that runs can be compared across commits with compare.py.
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --scale 0.1 --ls-counts 100,10000 --output quick.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import datetime
+import tempfile
+import statistics
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# We benchmark the working tree rather than whatever hcli_hag happens to be installed
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+import synthetic
+import server
+
+
+def summarize(samples):
+    return {
+        'min': min(samples),
+        'median': statistics.median(samples),
+        'mean': statistics.fmean(samples),
+        'max': max(samples),
+    }
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+# Peak RSS of this process (which includes the server) in KiB. On Linux the high-water mark is reset
+# before each benchmark so that every result reports its own peak.
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peak_rss_kib():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+# Bytes that crossed the wire for an endpoint, read from the server's metrics counters
+def wire_bytes(endpoint):
+    from hcli_hag.cli.wsgiapp import metrics
+    if endpoint == 'git-receive-pack':
+        return metrics.request_bytes.value(endpoint=endpoint)
+    return metrics.response_bytes.value(endpoint=endpoint)
+
+def measure(endpoint, fn):
+    before = wire_bytes(endpoint)
+    elapsed = timed(fn)
+    return elapsed, wire_bytes(endpoint) - before
+
+def result(benchmark, profile, samples, transferred=None, **extra):
+    entry = {'benchmark': benchmark, 'profile': profile, 'iterations': len(samples), 'seconds': summarize(samples)}
+    if transferred:
+        entry['bytes'] = statistics.median(transferred)
+        entry['bytes_per_second'] = entry['bytes'] / entry['seconds']['median'] if entry['seconds']['median'] else None
+    entry['peak_rss_kib'] = peak_rss_kib()
+    entry.update(extra)
+    return entry
+
+def bench_clone(url, scratch, profile, iterations):
+    reset_peak_rss()
+    samples, transferred = [], []
+    for i in range(iterations):
+        dest = os.path.join(scratch, f'clone-{profile}-{i}')
+        elapsed, sent = measure('git-upload-pack', lambda: synthetic.git('clone', '-q', '--bare', url, dest))
+        samples.append(elapsed)
+        transferred.append(sent)
+        shutil.rmtree(dest)
+    return result('clone', profile, samples, transferred)
+
+# Each iteration lands a new commit on the served repository (on disk, not through hag) and times the fetch of it.
+def bench_fetch(url, repo_path, scratch, profile, iterations, files, size):
+    fetcher = os.path.join(scratch, f'fetch-{profile}')
+    work = os.path.join(scratch, f'fetch-work-{profile}')
+    synthetic.git('clone', '-q', '--bare', url, fetcher)
+    synthetic.git('clone', '-q', repo_path, work)
+
+    reset_peak_rss()
+    samples, transferred = [], []
+    for i in range(iterations):
+        synthetic.add_commit(work, f'fetch-{i}', files, size)
+        synthetic.git('push', '-q', 'origin', 'HEAD:master', cwd=work)
+        elapsed, sent = measure('git-upload-pack',
+                                lambda: synthetic.git('fetch', '-q', 'origin', 'master:master', cwd=fetcher))
+        samples.append(elapsed)
+        transferred.append(sent)
+
+    shutil.rmtree(fetcher)
+    shutil.rmtree(work)
+    return result('fetch', profile, samples, transferred, files_per_iteration=files, file_size=size)
+
+def bench_push(url, scratch, profile, iterations, files, size):
+    work = os.path.join(scratch, f'push-{profile}')
+    synthetic.git('clone', '-q', url, work)
+
+    reset_peak_rss()
+    samples, transferred = [], []
+    for i in range(iterations):
+        synthetic.add_commit(work, f'push-{i}', files, size)
+        elapsed, received = measure('git-receive-pack',
+                                    lambda: synthetic.git(*server.auth_args(), 'push', '-q', 'origin', 'HEAD:master',
+                                                          cwd=work))
+        samples.append(elapsed)
+        transferred.append(received)
+
+    shutil.rmtree(work)
+    return result('push', profile, samples, transferred, files_per_iteration=files, file_size=size)
+
+# hag ls through the CLI with the listing built up to each count. The first listing after the folders are
+# created has to rescan every user ("cold"); the following ones are served from the up to date catalog ("warm").
+def bench_ls(repos_root, counts, iterations):
+    from hcli_hag.cli.cli import CLI
+
+    def ls(*options):
+        listed = 0
+        for chunk in CLI(['hag', 'ls'] + list(options)).execute():
+            listed += chunk.count(b'\n')
+        return listed
+
+    results = []
+    for count in counts:
+        synthetic.create_listing(repos_root, count)
+
+        reset_peak_rss()
+        listed = []
+        cold = timed(lambda: listed.append(ls()))
+        results.append(result('ls', 'cold', [cold], repos=count, listed=listed[-1]))
+
+        for options, name in (((), 'warm'), (('--json',), 'warm-json'), (('--user', 'ls-000'), 'warm-user')):
+            reset_peak_rss()
+            samples = [timed(lambda: ls(*options)) for i in range(iterations)]
+            results.append(result('ls', name, samples, repos=count))
+
+    return results
+
+def metadata(args):
+    def run(*command):
+        try:
+            return subprocess.run(command, cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    from hcli_hag import package
+    return {
+        'version': package.__version__,
+        'commit': run('git', 'rev-parse', 'HEAD'),
+        'dirty': bool(run('git', 'status', '--porcelain', '--untracked-files=no')),
+        'git': run('git', '--version'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'started': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'arguments': vars(args),
+    }
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--benchmarks', default='clone,fetch,push,ls',
+                        help='comma separated benchmarks to run (clone, fetch, push, ls)')
+    parser.add_argument('--profiles', default=','.join(synthetic.PROFILES),
+                        help='comma separated repository profiles')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the size of every profile')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--ls-counts', default='100,10000,100000', help='repository counts to list')
+    parser.add_argument('--change-files', type=int, default=100, help='files added per fetch/push iteration')
+    parser.add_argument('--change-size', type=int, default=4096, help='size of each added file in bytes')
+    parser.add_argument('--option', action='append', default=[], metavar='NAME=VALUE',
+                        help='hag configuration option for the server, e.g. hag.pack.cache=True')
+    parser.add_argument('--workdir', help='scratch directory (a temporary one is used and removed by default)')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    benchmarks = [b for b in args.benchmarks.split(',') if b]
+    profiles = [p for p in args.profiles.split(',') if p]
+    options = dict(option.split('=', 1) for option in args.option)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='hag-bench-')
+    scratch = os.path.join(workdir, 'scratch')
+    os.makedirs(scratch, exist_ok=True)
+
+    try:
+        repos_root, config_path = server.prepare(workdir, options)
+        report = {'metadata': metadata(args), 'repositories': [], 'results': []}
+
+        bench = server.BenchServer(config_path)
+        base_url = bench.start()
+        try:
+            for profile in profiles:
+                if not {'clone', 'fetch', 'push'} & set(benchmarks):
+                    break
+
+                repo_path = os.path.join(repos_root, server.USER, f'{profile}.git')
+                print(f'generating {profile}', file=sys.stderr)
+                report['repositories'].append(synthetic.create_repo(repo_path, profile, args.scale))
+                url = f'{base_url}/{server.USER}/{profile}.git'
+
+                if 'clone' in benchmarks:
+                    print(f'clone {profile}', file=sys.stderr)
+                    report['results'].append(bench_clone(url, scratch, profile, args.iterations))
+                if 'fetch' in benchmarks:
+                    print(f'fetch {profile}', file=sys.stderr)
+                    report['results'].append(bench_fetch(url, repo_path, scratch, profile, args.iterations,
+                                                         args.change_files, args.change_size))
+                if 'push' in benchmarks:
+                    print(f'push {profile}', file=sys.stderr)
+                    report['results'].append(bench_push(url, scratch, profile, args.iterations,
+                                                        args.change_files, args.change_size))
+        finally:
+            bench.stop()
+
+        if 'ls' in benchmarks:
+            counts = [int(c) for c in args.ls_counts.split(',') if c]
+            print(f'ls {counts}', file=sys.stderr)
+            report['results'].extend(bench_ls(repos_root, counts, args.iterations))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import os
+import base64
+import threading
+
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+USER = 'bench'
+PASSWORD = 'benchpw'
+
+
+# Points hag and hcli_core at a scratch home under workdir and writes a config with auth enabled and a bench user.
+# This has to run before any hcli_hag module is imported since their configuration is read at import time.
+def prepare(workdir, options=None):
+    from argon2 import PasswordHasher
+
+    home = os.path.join(workdir, 'home')
+    core_home = os.path.join(workdir, 'core')
+    etc = os.path.join(core_home, '.hcli_core', 'etc', 'hag')
+    os.makedirs(os.path.join(home, '.hag'), exist_ok=True)
+    os.makedirs(etc, exist_ok=True)
+    os.environ['HAG_HOME'] = home
+    os.environ['hcli_core_home'] = core_home
+
+    hasher = PasswordHasher()
+    lines = ['[default]',
+             'username = admin',
+             f'password = {hasher.hash("admin")}',
+             'core.auth = True',
+             'core.wsgiapp.port = 10000']
+    for name, value in (options or {}).items():
+        lines.append(f'{name} = {value}')
+    lines += ['', '[user_bench]', f'username = {USER}', f'password = {hasher.hash(PASSWORD)}', '']
+
+    config_path = os.path.join(etc, 'config')
+    with open(config_path, 'w') as f:
+        f.write('\n'.join(lines))
+
+    credentials_path = os.path.join(etc, 'credentials')
+    with open(credentials_path, 'w') as f:
+        f.write('[default]\nusername = admin\npassword = *\n')
+    os.chmod(credentials_path, 0o600)
+
+    return os.path.join(home, '.hag'), config_path
+
+def auth_args():
+    token = base64.b64encode(f'{USER}:{PASSWORD}'.encode()).decode()
+    return ['-c', f'http.extraHeader=Authorization: Basic {token}']
+
+# Bounds wsgi.input to Content-Length like gunicorn does; wsgiref hands over the raw socket.
+class _BoundedInput:
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        self._remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._stream.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._stream.readline(size)
+        self._remaining -= len(data)
+        return data
+
+class _ThreadingServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+class _QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+# Serves WSGIApp.server() on a loopback port from a background thread of the benchmark process.
+class BenchServer:
+
+    def __init__(self, config_path):
+        import hcli_hag.cli
+        from hcli_hag.cli.wsgiapp.wsgiapp import WSGIApp
+
+        self.app = WSGIApp('wsgiapp', os.path.dirname(hcli_hag.cli.__file__), config_path)
+        self._falcon_app = self.app.server()
+        self._server = None
+        self.url = None
+
+    def _wsgi(self, environ, start_response):
+        length = environ.get('CONTENT_LENGTH')
+        if length:
+            environ['wsgi.input'] = _BoundedInput(environ['wsgi.input'], int(length))
+        return self._falcon_app(environ, start_response)
+
+    def start(self):
+        self._server = make_server('127.0.0.1', 0, self._wsgi, server_class=_ThreadingServer,
+                                   handler_class=_QuietHandler)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self._server.server_port}'
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
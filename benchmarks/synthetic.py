@@ -0,0 +1,122 @@
+import os
+import random
+import subprocess
+
+# Synthetic repository profiles. Sizes are multiplied by the --scale given to run.py.
+#   small-objects: many tiny blobs spread over a modest number of commits
+#   large-blobs:   a handful of big incompressible blobs
+#   deep-history:  a long linear history that touches one file per commit
+#   wide-refs:     a short history referenced by thousands of branches and tags
+PROFILES = {
+    'small-objects': {'commits': 200, 'files_per_commit': 100, 'file_size': 128},
+    'large-blobs': {'commits': 4, 'files_per_commit': 1, 'file_size': 16 * 1024 * 1024},
+    'deep-history': {'commits': 10000, 'files_per_commit': 1, 'file_size': 256},
+    'wide-refs': {'commits': 100, 'files_per_commit': 1, 'file_size': 256, 'refs': 10000},
+}
+
+_EPOCH = 1700000000
+
+
+def git(*args, cwd=None, input=None, env=None):
+    full_env = dict(os.environ, GIT_TERMINAL_PROMPT='0',
+                    GIT_AUTHOR_NAME='bench', GIT_AUTHOR_EMAIL='bench@localhost',
+                    GIT_COMMITTER_NAME='bench', GIT_COMMITTER_EMAIL='bench@localhost')
+    if env:
+        full_env.update(env)
+    completed = subprocess.run(['git'] + list(args), cwd=cwd, input=input, env=full_env, capture_output=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"git {' '.join(args)} failed: {completed.stderr.decode(errors='replace').strip()}")
+    return completed
+
+def _scaled(profile, scale):
+    spec = dict(PROFILES[profile])
+    for key in ('commits', 'files_per_commit', 'refs'):
+        if key in spec:
+            spec[key] = max(1, int(spec[key] * scale))
+    if profile != 'large-blobs':
+        return spec
+
+    # Large blobs keep their count and shrink in size instead so that a quick run still has a few of them
+    spec['file_size'] = max(1024, int(spec['file_size'] * scale))
+    return spec
+
+# Blob contents are derived from the profile, commit and file so that every run builds the same repository. Large blobs
+# are pseudo-random bytes from a generator seeded the same way, which don't compress or delta.
+def _content(profile, commit, index, size):
+    seed = f"{profile} {commit} {index}\n"
+    if profile == 'large-blobs':
+        return random.Random(seed).randbytes(size)
+    seed = seed.encode()
+    return (seed * (size // len(seed) + 1))[:size]
+
+# Builds a git fast-import stream for the profile. Blobs are inlined so the stream is generated lazily.
+def _fast_import_stream(profile, spec):
+    mark = 0
+    for commit in range(spec['commits']):
+        mark += 1
+        message = f"commit {commit}\n".encode()
+        header = (f"commit refs/heads/master\nmark :{mark}\n"
+                  f"committer bench <bench@localhost> {_EPOCH + commit} +0000\n"
+                  f"data {len(message)}\n").encode() + message
+        if commit > 0:
+            header += f"from :{mark - 1}\n".encode()
+        yield header
+
+        for index in range(spec['files_per_commit']):
+            if profile == 'deep-history':
+                path = 'history.txt'
+            else:
+                path = f"d{commit % 100:02d}/c{commit}-f{index}.bin"
+            data = _content(profile, commit, index, spec['file_size'])
+            yield f"M 100644 inline {path}\ndata {len(data)}\n".encode() + data + b"\n"
+        yield b"\n"
+
+    for ref in range(spec.get('refs', 0)):
+        target = ref % spec['commits'] + 1
+        kind = 'tags' if ref % 2 else 'heads'
+        yield f"reset refs/{kind}/ref-{ref:06d}\nfrom :{target}\n\n".encode()
+
+# Creates a bare repository for the profile at path and returns a short description of it.
+def create_repo(path, profile, scale=1.0):
+    spec = _scaled(profile, scale)
+    git('init', '-q', '--bare', path)
+    git('symbolic-ref', 'HEAD', 'refs/heads/master', cwd=path)
+
+    process = subprocess.Popen(['git', 'fast-import', '--quiet'], cwd=path, stdin=subprocess.PIPE,
+                               env=dict(os.environ, GIT_DIR=path))
+    try:
+        for chunk in _fast_import_stream(profile, spec):
+            process.stdin.write(chunk)
+        process.stdin.close()
+    finally:
+        if process.wait() != 0:
+            raise RuntimeError(f"git fast-import failed for {profile}")
+
+    git('pack-refs', '--all', cwd=path)
+    return dict(spec, profile=profile, size_bytes=directory_size(path))
+
+def directory_size(path):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass
+    return total
+
+# Adds a commit with count new files of size bytes to a work tree and returns the new commit.
+def add_commit(work, tag, count, size):
+    for index in range(count):
+        with open(os.path.join(work, f"{tag}-{index}.bin"), 'wb') as f:
+            f.write(random.Random(f"{tag} {index}").randbytes(size))
+    git('add', '-A', cwd=work)
+    git('commit', '-q', '-m', tag, cwd=work)
+    return git('rev-parse', 'HEAD', cwd=work).stdout.strip().decode()
+
+# Creates count empty repository folders spread over users, which is all hag ls looks at.
+# Existing folders are kept so that larger counts can be built on top of smaller ones.
+def create_listing(root, count, users=100):
+    for index in range(count):
+        user_path = os.path.join(root, f"ls-{index % users:03d}")
+        os.makedirs(os.path.join(user_path, f"repo-{index:06d}.git"), exist_ok=True)
@@ -0,0 +1,188 @@
+import os
+import json
+import heapq
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from hcli_hag.cli import config
+from hcli_hag.cli import storage
+
+from hcli_core import logger
+
+log = logger.Logger("hag")
+
+
+def _dir_state(path):
+    st = os.stat(path)
+
+    # Adding, removing or renaming a repo directory bumps the user directory's mtime (and its link count)
+    return [st.st_mtime_ns, st.st_nlink]
+
+# Persistent index of <root>/<user>/<repo>.git kept current from directory mtimes.
+# A refresh lists the root and stats each user directory; only users whose directory changed are re-listed,
+# so listing tens of thousands of repos costs one stat per user instead of one listdir per user.
+class Catalog:
+
+    def __init__(self, root, path):
+        self.root = root
+        self.path = path
+        self._users = {}
+        self._file_state = None
+        self._lock = threading.RLock()
+
+    def _load(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+
+        file_state = (st.st_mtime_ns, st.st_size)
+        if file_state == self._file_state:
+            return
+
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            self._users = data.get('users', {})
+            self._file_state = file_state
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring unreadable hag catalog {self.path}: {e}")
+            self._users = {}
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.catalog', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'users': self._users}, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+            st = os.stat(self.path)
+            self._file_state = (st.st_mtime_ns, st.st_size)
+        except OSError as e:
+            log.warning(f"Unable to save hag catalog {self.path}: {e}")
+
+    def _scan_user(self, user):
+        user_path = os.path.join(self.root, user)
+        state = _dir_state(user_path)
+        repos = sorted(r for r in os.listdir(user_path)
+                       if r.endswith('.git') and not r.startswith('.') and os.path.isdir(os.path.join(user_path, r)))
+        log.debug(f"Catalog rescanned {user_path}: {len(repos)} repos")
+        return {'state': state, 'repos': repos}
+
+    # Brings the catalog up to date with the filesystem. When user is given only that user is checked.
+    def refresh(self, user=None):
+        with self._lock:
+            self._load()
+            changed = False
+
+            if user is not None:
+                users = [user]
+            else:
+                try:
+                    users = [u for u in os.listdir(self.root)
+                             if not u.startswith('.') and os.path.isdir(os.path.join(self.root, u))]
+                except FileNotFoundError:
+                    users = []
+
+                for gone in set(self._users) - set(users):
+                    del self._users[gone]
+                    changed = True
+
+            for name in users:
+                try:
+                    state = _dir_state(os.path.join(self.root, name))
+                except (FileNotFoundError, NotADirectoryError):
+                    if self._users.pop(name, None) is not None:
+                        changed = True
+                    continue
+
+                entry = self._users.get(name)
+                if entry is None or entry['state'] != state:
+                    try:
+                        self._users[name] = self._scan_user(name)
+                        changed = True
+                    except OSError as e:
+                        log.error(f"Error scanning repos for {name}: {e}")
+
+            if changed:
+                self._save()
+
+    # Forces the next refresh to re-list a user's repos (e.g. after hag creates or removes one).
+    def invalidate(self, user):
+        with self._lock:
+            self._users.pop(user, None)
+
+    # Yields (user, repo) pairs in sorted order.
+    def repos(self, user=None, prefix=None, refresh=True):
+        if user is not None and (user.startswith('.') or os.sep in user or user in ('', '..')):
+            return
+
+        if refresh:
+            self.refresh(user)
+
+        with self._lock:
+            if user is not None:
+                users = [user] if user in self._users else []
+            else:
+                users = sorted(self._users)
+            snapshot = [(u, self._users[u]['repos']) for u in users]
+
+        for name, repos in snapshot:
+            for repo in repos:
+                if prefix is None or repo.startswith(prefix):
+                    yield name, repo
+
+# The catalogs of every storage root. A listing refreshes them in parallel, one thread per root so that a slow disk
+# only delays its own scan, and merges their sorted listings.
+class StorageCatalog:
+
+    def __init__(self, catalogs):
+        self.catalogs = catalogs
+
+    def refresh(self, user=None):
+        if len(self.catalogs) == 1:
+            self.catalogs[0].refresh(user)
+            return
+
+        with ThreadPoolExecutor(max_workers=len(self.catalogs), thread_name_prefix='hag-catalog') as pool:
+            for future in [pool.submit(catalog.refresh, user) for catalog in self.catalogs]:
+                try:
+                    future.result()
+                except OSError as e:
+                    log.error(f"Error scanning repos: {e}")
+
+    def invalidate(self, user):
+        for catalog in self.catalogs:
+            catalog.invalidate(user)
+
+    # Yields (user, repo) pairs in sorted order across all roots. A repo that shows up on two roots while it's being
+    # moved is listed once.
+    def repos(self, user=None, prefix=None):
+        if len(self.catalogs) == 1:
+            yield from self.catalogs[0].repos(user, prefix)
+            return
+
+        if user is not None and (user.startswith('.') or os.sep in user or user in ('', '..')):
+            return
+
+        self.refresh(user)
+        previous = None
+        for entry in heapq.merge(*[catalog.repos(user, prefix, refresh=False) for catalog in self.catalogs]):
+            if entry != previous:
+                yield entry
+            previous = entry
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+# The primary root keeps its catalog at config.catalog_path; every other root keeps one in its own folder
+def get_catalog():
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            roots = storage.get_storage().roots
+            _catalog = StorageCatalog([Catalog(root, config.catalog_path if root == config.repos else
+                                               os.path.join(root, '.catalog')) for root in roots])
+        return _catalog
@@ -3,13 +3,23 @@ import os
 import json
 
 from hcli_hag.cli import config
+from hcli_hag.cli import catalog
+from hcli_hag.cli import maintenance
+from hcli_hag.cli import storage
+from hcli_hag.cli import stats
+from hcli_hag.cli.wsgiapp import backend
 from hcli_hag.cli.utils import formatting
 
+from hcli_core import config as c
 from hcli_core import logger
+from hcli_core.auth.cli import credential
+from hcli_problem_details import *
 
-from typing import Optional, Dict, Callable, List
+from dulwich.errors import NotGitRepository
 
-log = logger.Logger(name="hag")
+from typing import Optional, Dict, Callable, List, Iterable, Iterator, Tuple
+
+log = logger.Logger("hag")
 
 
 class CLI:
@@ -19,43 +29,361 @@ class CLI:
         self.inputstream = inputstream
         self.handlers: Dict[str, Callable] = {
             'ls':  self._handle_ls,
+            'gc':  self._handle_gc,
+            'mv':  self._handle_mv,
+            'stat': self._handle_stat,
+            'create': self._handle_create,
+            'rm': self._handle_rm,
+            'fork': self._handle_fork,
         }
 
-    def execute(self) -> Optional[io.BytesIO]:
+    def execute(self) -> Optional[Iterable[bytes]]:
         if len(self.commands) > 1 and self.commands[1] in self.handlers:
             return self.handlers[self.commands[1]]()
 
         return None
 
-    def _handle_ls(self) -> Optional[io.BytesIO]:
+    # Parses "--name value" and "--flag" options following the command (from the start-th word). Quoted HCLI
+    # parameters are unquoted.
+    def _parse_options(self, valued: List[str], flags: List[str], start: int = 2) -> Dict[str, object]:
+        options: Dict[str, object] = {}
+        args = self.commands[start:]
+        i = 0
+        while i < len(args):
+            arg = args[i]
+            if arg in flags:
+                options[arg] = True
+                i += 1
+            elif arg in valued and i + 1 < len(args):
+                options[arg] = args[i + 1].strip('\'"')
+                i += 2
+            else:
+                msg = f"unknown or incomplete option {arg}."
+                log.error(msg)
+                raise BadRequestError(detail=msg)
+
+        return options
+
+    def _int_option(self, options: Dict[str, object], name: str) -> Optional[int]:
+        if name not in options:
+            return None
+
+        try:
+            value = int(options[name])
+            if value < 0:
+                raise ValueError(value)
+            return value
+        except ValueError:
+            msg = f"{name} must be a non-negative integer."
+            log.error(msg)
+            raise BadRequestError(detail=msg)
+
+    def _handle_ls(self) -> Iterator[bytes]:
+        options = self._parse_options(['--user', '--prefix', '--limit', '--offset'], ['--json'])
+        limit = self._int_option(options, '--limit')
+        offset = self._int_option(options, '--offset') or 0
+
         def get_repos():
+            base_url = config.core_wsgiapp_base_url
+            count = 0
+            try:
+                for index, (user, repo) in enumerate(catalog.get_catalog().repos(options.get('--user'),
+                                                                                 options.get('--prefix'))):
+                    if index < offset:
+                        continue
+                    if limit is not None and count >= limit:
+                        break
+                    count += 1
+                    yield {
+                            'user': user,
+                            'repo': f"{base_url}/{user}/{repo}"
+                    }
+            except Exception as e:
+                log.error(f"Error scanning repos: {e}")
+
+        # We stream rows as they are produced so that large listings are never built up in memory
+        def generator():
+            if '--json' in options:
+                yield b'['
+                separator = b'\n'
+                for entry in get_repos():
+                    yield separator + json.dumps(entry).encode('utf-8')
+                    separator = b',\n'
+                yield b'\n]'
+            else:
+                yield formatting.format_header().encode('utf-8')
+                for entry in get_repos():
+                    yield ("\n" + formatting.format_row(entry['user'], entry['repo'])).encode('utf-8')
+
+        return generator()
+
+    # Parses a quoted "user/repo" (or "user/repo.git") parameter into its user and repo.git
+    def _repo_name(self, parameter: str) -> Tuple[str, str]:
+        name = parameter.strip('\'"')
+        if not name.endswith('.git'):
+            name += '.git'
+
+        try:
+            return backend.parse_repo_path(name)
+        except NotGitRepository:
+            msg = f"invalid repository {name}."
+            log.error(msg)
+            raise BadRequestError(detail=msg)
+
+    # Resolves a quoted "user/repo" (or "user/repo.git") parameter to the repository's folder on its storage root.
+    # Up to max_args parameters (the repository first) are accepted.
+    def _repo_parameter(self, max_args: int = 1) -> Tuple[str, str]:
+        if not 3 <= len(self.commands) <= 2 + max_args:
+            msg = "a single user/repo parameter is required." if max_args == 1 else "a user/repo parameter is required."
+            log.error(msg)
+            raise BadRequestError(detail=msg)
+
+        user, repo = self._repo_name(self.commands[2])
+        repo_path = storage.get_storage().locate(user, repo)
+        if not os.path.isdir(repo_path):
+            msg = f"repository {user}/{repo} not found."
+            log.error(msg)
+            raise NotFoundError(detail=msg)
+
+        return user, repo_path
+
+    # The user the command runs as. Commands that change repositories are refused without one.
+    def _authenticated_user(self) -> str:
+        auth_user = c.ServerContext.get_current_user()
+        if not auth_user:
+            msg = "no authenticated user found."
+            log.error(msg)
+            raise AuthenticationError(detail=msg)
+        return auth_user
+
+    # Whether a user has hcli_core's admin role
+    def _is_admin(self, user: str) -> bool:
+        return 'admin' in credential.CredentialManager().get_user_roles(user)
+
+    # Only a repository's owner (or an admin) may change it
+    def _authorize_owner(self, user: str) -> None:
+        auth_user = self._authenticated_user()
+        if auth_user != user and not self._is_admin(auth_user):
+            msg = f"user '{auth_user}' does not match repository owner '{user}'."
+            log.error(msg)
+            raise AuthorizationError(detail=msg)
+
+    # Only an admin may run operator commands
+    def _authorize_admin(self) -> None:
+        auth_user = self._authenticated_user()
+        if not self._is_admin(auth_user):
+            msg = f"user '{auth_user}' is not an admin."
+            log.error(msg)
+            raise AuthorizationError(detail=msg)
+
+    def _handle_gc(self) -> Iterator[bytes]:
+        user, repo_path = self._repo_parameter()
+        self._authorize_owner(user)
+
+        try:
+            result = maintenance.run_gc(repo_path, grace_period=config.maintenance_prune_grace)
+        except maintenance.MaintenanceInProgress as e:
+            log.error(str(e))
+            raise ConflictError(detail=str(e))
+
+        if config.stats:
+            stats.record_scan(stats.get_store(), user, os.path.basename(repo_path), repo_path)
+
+        def generator():
+            yield f"packs: {result.packs_before} -> {result.packs_after}\n".encode('utf-8')
+            yield f"loose objects: {result.loose_objects_before} -> {result.loose_objects_after}\n".encode('utf-8')
+            yield (f"pruned objects: {len(result.pruned_objects)} "
+                   f"({formatting.format_size(result.bytes_freed)} freed)\n").encode('utf-8')
+
+        return generator()
+
+    def _handle_mv(self) -> Iterator[bytes]:
+        user, repo_path = self._repo_parameter(max_args=2)
+        repo = os.path.basename(repo_path)
+
+        # Where repositories are stored is the operator's concern, not the owner's
+        self._authorize_admin()
+
+        root = self.commands[3].strip('\'"') if len(self.commands) > 3 else None
+        try:
+            src, dst = storage.get_storage().move(user, repo, root)
+        except ValueError:
+            msg = f"{root} is not a storage root."
+            log.error(msg)
+            raise BadRequestError(detail=msg)
+        except FileNotFoundError:
+            msg = f"repository {user}/{repo} not found."
+            log.error(msg)
+            raise NotFoundError(detail=msg)
+        except (FileExistsError, maintenance.MaintenanceInProgress) as e:
+            log.error(str(e))
+            raise ConflictError(detail=str(e))
+
+        catalog.get_catalog().invalidate(user)
+
+        def generator():
+            if src == dst:
+                yield f"{user}/{repo} is already on {os.path.dirname(os.path.dirname(dst))}\n".encode('utf-8')
+            else:
+                yield (f"{user}/{repo}: {os.path.dirname(os.path.dirname(src))} -> "
+                       f"{os.path.dirname(os.path.dirname(dst))}\n").encode('utf-8')
+
+        return generator()
+
+    # Reports repository statistics from the incrementally maintained store: a single repository, or every repository
+    # (optionally of one user or with a name prefix). Repositories without statistics yet are measured once.
+    def _handle_stat(self) -> Iterator[bytes]:
+        single = len(self.commands) > 2 and not self.commands[2].startswith('--')
+        if single:
+            options = self._parse_options([], ['--json', '--refresh'], start=3)
+            user, repo_path = self._repo_parameter(max_args=len(self.commands) - 2)
+        else:
+            options = self._parse_options(['--user', '--prefix'], ['--json'])
+
+        store = stats.get_store() if config.stats else None
+
+        def name(user, repo):
+            return f"{user}/{repo[:-4] if repo.endswith('.git') else repo}"
+
+        if single:
+            repo = os.path.basename(repo_path)
+            entry = stats.repo_stats(store, user, repo, repo_path, refresh='--refresh' in options)
+
+            def generator():
+                if '--json' in options:
+                    yield json.dumps({'repo': name(user, repo), **entry}, indent=4).encode('utf-8') + b'\n'
+                    return
+
+                yield f"repo: {name(user, repo)}\n".encode('utf-8')
+                for field, value in entry.items():
+                    if field == 'size':
+                        value = formatting.format_size(value)
+                    elif field in ('last_push', 'updated'):
+                        value = formatting.format_time(value)
+                    yield f"{field.replace('_', ' ')}: {value}\n".encode('utf-8')
+
+            return generator()
+
+        def get_stats():
+            entries = store.entries() if store is not None else {}
+            stats_storage = storage.get_storage()
             try:
-                base_url = config.core_wsgiapp_base_url
-                repos = []
-                for user in os.listdir(config.repos):
-                    user_path = os.path.join(config.repos, user)
-                    if os.path.isdir(user_path):
-                        for repo in os.listdir(user_path):
-                            log.info(user_path)
-                            if repo.endswith('.git'):
-                                repo_path = os.path.join(user_path, repo)
-                                log.info(repo_path)
-                                try:
-                                    repos.append({
-                                            'user': user,
-                                            'repo': f"{base_url}/{user}/{repo}"
-                                    })
-
-                                    #repos[f"/{user}/{repo}"] = 1
-                                except Exception as e:
-                                    log.error(f"Error loading repo {user}/{repo}: {e}")
-                return repos
+                for user, repo in catalog.get_catalog().repos(options.get('--user'), options.get('--prefix')):
+                    repo_path = stats_storage.locate(user, repo)
+                    try:
+                        entry = stats.repo_stats(store, user, repo, repo_path, entry=entries.get(f"{user}/{repo}"))
+                    except OSError as e:
+                        log.error(f"Error measuring {user}/{repo}: {e}")
+                        continue
+                    yield {'repo': name(user, repo), **entry}
             except Exception as e:
                 log.error(f"Error scanning repos: {e}")
-                return {}
 
-        repos = get_repos()
-        json_string = json.dumps(repos, indent=4)
+        # Rows are streamed as they are produced, like hag ls
+        def generator():
+            if '--json' in options:
+                yield b'['
+                separator = b'\n'
+                for entry in get_stats():
+                    yield separator + json.dumps(entry).encode('utf-8')
+                    separator = b',\n'
+                yield b'\n]'
+            else:
+                yield formatting.format_stat_header().encode('utf-8')
+                for entry in get_stats():
+                    yield ("\n" + formatting.format_stat_row(entry['repo'], formatting.format_size(entry['size']),
+                                                              entry['objects'], entry['packs'], entry['refs'],
+                                                              formatting.format_time(entry['last_push']),
+                                                              entry['clones'])).encode('utf-8')
+
+        return generator()
+
+    def _handle_create(self) -> Iterator[bytes]:
+        if len(self.commands) != 3:
+            msg = "a single user/repo parameter is required."
+            log.error(msg)
+            raise BadRequestError(detail=msg)
+
+        user, repo = self._repo_name(self.commands[2])
+        self._authorize_owner(user)
+
+        try:
+            repo_path = storage.get_storage().create(user, repo)
+        except FileExistsError:
+            msg = f"repository {user}/{repo} already exists."
+            log.error(msg)
+            raise ConflictError(detail=msg)
+
+        self._created(user, repo, repo_path)
 
-        return io.BytesIO(formatting.format_rows(repos).encode('utf-8'))
-#         return io.BytesIO(json_string.encode('utf-8'))
+        def generator():
+            yield f"{config.core_wsgiapp_base_url}/{user}/{repo}\n".encode('utf-8')
+
+        return generator()
+
+    # Forks a repository into another user's namespace: hag fork 'user/repo' ['user/repo'], by default under the
+    # same name for the authenticated user. Any user may fork a repository they can fetch.
+    def _handle_fork(self) -> Iterator[bytes]:
+        src_user, src_path = self._repo_parameter(max_args=2)
+        src_repo = os.path.basename(src_path)
+
+        if len(self.commands) > 3:
+            user, repo = self._repo_name(self.commands[3])
+        else:
+            user, repo = self._authenticated_user(), src_repo
+        self._authorize_owner(user)
+
+        try:
+            repo_path, linked, copied = storage.get_storage().fork(src_user, src_repo, user, repo)
+        except FileNotFoundError:
+            msg = f"repository {src_user}/{src_repo} not found."
+            log.error(msg)
+            raise NotFoundError(detail=msg)
+        except FileExistsError:
+            msg = f"repository {user}/{repo} already exists."
+            log.error(msg)
+            raise ConflictError(detail=msg)
+        except maintenance.MaintenanceInProgress as e:
+            log.error(str(e))
+            raise ConflictError(detail=str(e))
+
+        self._created(user, repo, repo_path)
+
+        def generator():
+            yield f"{config.core_wsgiapp_base_url}/{user}/{repo}\n".encode('utf-8')
+            yield f"forked from {src_user}/{src_repo}: {linked} object files shared, {copied} copied\n".encode('utf-8')
+
+        return generator()
+
+    def _handle_rm(self) -> Iterator[bytes]:
+        user, repo_path = self._repo_parameter()
+        repo = os.path.basename(repo_path)
+        self._authorize_owner(user)
+
+        try:
+            storage.get_storage().remove(user, repo)
+        except FileNotFoundError:
+            msg = f"repository {user}/{repo} not found."
+            log.error(msg)
+            raise NotFoundError(detail=msg)
+        except maintenance.MaintenanceInProgress as e:
+            log.error(str(e))
+            raise ConflictError(detail=str(e))
+
+        catalog.get_catalog().invalidate(user)
+        if config.stats:
+            stats.get_store().forget(f"{user}/{repo}")
+
+        def generator():
+            yield f"removed {user}/{repo}\n".encode('utf-8')
+
+        return generator()
+
+    # A new repository is listed and has statistics right away
+    def _created(self, user: str, repo: str, repo_path: str) -> None:
+        catalog.get_catalog().invalidate(user)
+        if config.stats:
+            try:
+                stats.record_scan(stats.get_store(), user, repo, repo_path)
+            except OSError as e:
+                log.warning(f"Unable to record the statistics of {user}/{repo}: {e}")
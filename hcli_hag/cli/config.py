@@ -1,7 +1,9 @@
 import os
+import time
 import inspect
+import threading
 
-from configparser import ConfigParser
+from configparser import ConfigParser, Error as ConfigParserError
 from hcli_core import logger
 
 log = logger.Logger(name="hag")
@@ -9,36 +11,136 @@ log = logger.Logger(name="hag")
 root = os.path.dirname(inspect.getfile(lambda: None))
 home = os.getenv('HAG_HOME') or os.path.expanduser("~")
 repos = os.path.abspath(os.path.join(home, '.hag'))
+catalog_path = os.path.join(repos, '.catalog')
 hcli_core_home = os.getenv('hcli_core_home') or os.path.expanduser("~")
 hag_config_path = os.path.join(hcli_core_home, ".hcli_core", "etc", "hag", "config")
 
-_parser = ConfigParser(interpolation=None)
-_loaded = False
+# hag's settings, read lazily from hag_config_path and re-read when the file changes.
+# A setting is computed the first time it's read and cached until the file changes. Changes are detected with a stat
+# of the file, done at most once every check_interval seconds (hag.config.check.interval) when a setting is read, so a
+# running server picks up new values without a restart. Functions registered with on_reload() are called after the
+# file was re-read, to push new values into long lived objects (caches, the scheduler).
+class Settings:
 
-def _load():
-    global _loaded
-    if _loaded:
-        return
-    if os.path.exists(hag_config_path):
-        _parser.read(hag_config_path)
-        _loaded = True
-    else:
-        log.warning(f"hag config file not found at {hag_config_path}. Using defaults")
+    def __init__(self, path, check_interval=5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.generation = 0
+        self._parser = ConfigParser(interpolation=None)
+        self._signature = None
+        self._checked = None
+        self._values = {}
+        self._definitions = {}
+        self._listeners = []
+        self._lock = threading.RLock()
+
+    def define(self, name, compute):
+        self._definitions[name] = compute
+
+    def __contains__(self, name):
+        return name in self._definitions
+
+    def on_reload(self, listener):
+        self._listeners.append(listener)
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    # Re-reads the config file if it changed since it was last read. Returns True when it was (re)loaded.
+    def refresh(self, force=False):
+        checked = self._checked
+        if not force and checked is not None and time.monotonic() - checked < self.check_interval:
+            return False
+
+        with self._lock:
+            if not force and self._checked is not checked:
+                return False
+
+            first = self._checked is None
+            self._checked = time.monotonic()
+            signature = self._stat()
+            if not first and signature == self._signature:
+                return False
+
+            parser = ConfigParser(interpolation=None)
+            if signature is None:
+                log.warning(f"hag config file not found at {self.path}. Using defaults")
+            else:
+                try:
+                    parser.read(self.path)
+                except ConfigParserError as e:
+                    log.error(f"Unable to read hag config file {self.path}: {e}. Keeping the current settings")
+                    self._signature = signature
+                    return False
+
+            self._parser = parser
+            self._signature = signature
+            self._values = {}
+            self.generation += 1
+            self.check_interval = self._interval()
+
+        if not first:
+            log.info(f"Reloaded hag config file {self.path}")
+            for listener in self._listeners:
+                try:
+                    listener()
+                except Exception as e:
+                    log.error(f"Unable to apply reloaded hag config: {e}")
+        return True
+
+    def _interval(self):
+        try:
+            return float(self.option("hag.config.check.interval", self.check_interval))
+        except (ValueError, TypeError):
+            return self.check_interval
+
+    # The raw value of an option in the [default] section, or default
+    def option(self, option, default):
+        parser = self._parser
+        if parser.has_section("default") and parser.has_option("default", option):
+            return parser.get("default", option)
+        return default
+
+    def value(self, name):
+        self.refresh()
+        values = self._values
+        try:
+            return values[name]
+        except KeyError:
+            pass
+
+        with self._lock:
+            value = self._definitions[name]()
+            values[name] = value
+            return value
+
+settings = Settings(hag_config_path)
+
+# Settings are module attributes (config.stream_chunk_size), evaluated through the settings object on every access
+def __getattr__(name):
+    if name in settings:
+        return settings.value(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def get_core_wsgiapp_base_url() -> str:
-    _load()
 
     # 1. Explicit user override (recommended for production)
-    if _parser.has_section("default") and _parser.has_option("default", "core.wsgiapp.base.url"):
-        url = _parser.get("default", "core.wsgiapp.base.url").rstrip("/")
+    url = _get_option("core.wsgiapp.base.url", None)
+    if url is not None:
+        url = url.rstrip("/")
         log.debug(f"Using explicit core.wsgiapp.base.url = {url}")
         return url
 
     # 2. Fallback: build from the port that is already in hag's own config
     port = 10000
-    if _parser.has_section("default") and _parser.has_option("default", "core.wsgiapp.port"):
+    value = _get_option("core.wsgiapp.port", None)
+    if value is not None:
         try:
-            port = int(_parser.get("default", "core.wsgiapp.port"))
+            port = int(value)
         except (ValueError, TypeError):
             log.warning("Invalid core.wsgiapp.port. Assuming default 10000")
 
@@ -46,4 +148,218 @@ def get_core_wsgiapp_base_url() -> str:
     log.debug(f"Using fallback core wsgiapp base URL: {url}")
     return url
 
-core_wsgiapp_base_url = get_core_wsgiapp_base_url()
+def _get_option(option, default):
+    return settings.option(option, default)
+
+def _get_bool(option, default: bool) -> bool:
+    value = _get_option(option, None)
+    if value is None:
+        return default
+
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+
+    log.warning(f"Invalid {option} value: {value}. Assuming default {default}")
+    return default
+
+def _get_int(option, default: int) -> int:
+    value = _get_option(option, None)
+    if value is None:
+        return default
+
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        log.warning(f"Invalid {option} value: {value}. Assuming default {default}")
+        return default
+
+def _get_float(option, default: float) -> float:
+    value = _get_option(option, None)
+    if value is None:
+        return default
+
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        log.warning(f"Invalid {option} value: {value}. Assuming default {default}")
+        return default
+
+def _get_list(option):
+    return [s.strip() for s in _get_option(option, "").split(',') if s.strip()]
+
+# How often (seconds) the config file is checked for changes. Cache sizes, scheduler limits, streaming and
+# compression knobs, hook retries and maintenance thresholds take effect on a running server once the file is
+# re-read; switching a feature on or off (hag.pack.cache, hag.metrics, hag.gzip.response, hag.maintenance, hooks),
+# worker counts and folders need a restart
+settings.define('config_check_interval', lambda: settings.check_interval)
+
+settings.define('core_wsgiapp_base_url', get_core_wsgiapp_base_url)
+
+# Extra repository storage roots (comma separated folders, e.g. on other disks) used along with the hag home. A repo
+# is placed on a root by a hash of its user/repo and is found on whichever root holds it; hag mv moves one between
+# roots. hag.storage.index keeps an index of repos that don't live on their hashed root so that finding them doesn't
+# probe every root
+settings.define('storage_roots', lambda: _get_list("hag.storage.roots"))
+settings.define('storage_index', lambda: _get_bool("hag.storage.index", False))
+
+# Cache of successful authentications (so a push's round trips don't each pay for a password hash check): the
+# maximum number of entries and how long (seconds) an authentication is trusted. Changing a password or revoking an
+# API key invalidates its entries right away
+settings.define('auth_cache', lambda: _get_bool("hag.auth.cache", True))
+settings.define('auth_cache_size', lambda: _get_int("hag.auth.cache.size", 1024))
+settings.define('auth_cache_ttl', lambda: _get_float("hag.auth.cache.ttl", 300.0))
+
+# Token bucket limits on the repository endpoints, kept separately for each authenticated user, client address and
+# repo: requests per second and response bytes per second (0 means unlimited). A bucket saves up to
+# hag.ratelimit.burst seconds of its rate. Requests over a limit, or whose key owes more than hag.ratelimit.max.delay
+# seconds of bandwidth, get a 429 with Retry-After. At most hag.ratelimit.max.keys buckets are kept. X-Forwarded-For
+# only names the client address with hag.ratelimit.trust.forwarded, behind proxies that append to it: the address is
+# the entry hag.ratelimit.forwarded.hops (the number of such proxies) from the right
+settings.define('ratelimit', lambda: _get_bool("hag.ratelimit", False))
+settings.define('ratelimit_user_requests', lambda: _get_float("hag.ratelimit.user.requests", 0.0))
+settings.define('ratelimit_user_bytes', lambda: _get_int("hag.ratelimit.user.bytes", 0))
+settings.define('ratelimit_ip_requests', lambda: _get_float("hag.ratelimit.ip.requests", 0.0))
+settings.define('ratelimit_ip_bytes', lambda: _get_int("hag.ratelimit.ip.bytes", 0))
+settings.define('ratelimit_repo_requests', lambda: _get_float("hag.ratelimit.repo.requests", 0.0))
+settings.define('ratelimit_repo_bytes', lambda: _get_int("hag.ratelimit.repo.bytes", 0))
+settings.define('ratelimit_burst', lambda: _get_float("hag.ratelimit.burst", 10.0))
+settings.define('ratelimit_max_delay', lambda: _get_float("hag.ratelimit.max.delay", 30.0))
+settings.define('ratelimit_max_keys', lambda: _get_int("hag.ratelimit.max.keys", 10000))
+settings.define('ratelimit_trust_forwarded', lambda: _get_bool("hag.ratelimit.trust.forwarded", False))
+settings.define('ratelimit_forwarded_hops', lambda: _get_int("hag.ratelimit.forwarded.hops", 1))
+
+# Repository statistics (sizes, object, pack and ref counts, pushes, clones and fetches) kept up to date as pushes and
+# maintenance happen, for hag stat: the journal size (bytes) past which it's folded into a new snapshot and how often
+# (seconds) clone and fetch counts are written out
+settings.define('stats', lambda: _get_bool("hag.stats", True))
+settings.define('stats_journal_max', lambda: _get_int("hag.stats.journal.max", 1048576))
+settings.define('stats_flush_interval', lambda: _get_float("hag.stats.flush.interval", 10.0))
+
+# Stream git-upload-pack output to the client as dulwich generates it instead of buffering the whole pack
+settings.define('stream_upload_pack', lambda: _get_bool("hag.stream.upload.pack", True))
+
+# Number of pending pack chunks held between dulwich and the WSGI server before dulwich is paused
+settings.define('stream_queue_size', lambda: _get_int("hag.stream.queue.size", 16))
+
+# Size of the reads and inflate steps used when streaming request bodies
+settings.define('stream_chunk_size', lambda: _get_int("hag.stream.chunk.size", 65536))
+
+# Serving the git endpoints from an asyncio (ASGI) server. Requests are handled on a pool of hag.asgi.workers threads
+# and dulwich generates streamed responses on hag.asgi.git.workers more. Up to hag.asgi.buffer.size bytes of a
+# response are held in memory and up to hag.asgi.spool.size more are spooled to a temporary file (in
+# hag.asgi.spool.dir, by default the system's) before dulwich waits for a slow client. A push holds a thread for as
+# long as its pack takes to upload, so pushes run on a pool of their own of hag.asgi.push.workers threads and can't
+# starve fetches of workers
+settings.define('asgi_workers', lambda: _get_int("hag.asgi.workers", 32))
+settings.define('asgi_git_workers', lambda: _get_int("hag.asgi.git.workers", 8))
+settings.define('asgi_push_workers', lambda: _get_int("hag.asgi.push.workers", 4))
+settings.define('asgi_buffer_size', lambda: _get_int("hag.asgi.buffer.size", 1048576))
+settings.define('asgi_spool_size', lambda: _get_int("hag.asgi.spool.size", 8388608))
+settings.define('asgi_spool_dir', lambda: _get_option("hag.asgi.spool.dir", None))
+
+# Limits checked while a push's pack is read, so that a push over one is turned away before it's stored: the largest
+# pack (bytes), the largest blob (bytes, inflated; a delta counts by the size of the object it resolves to) and the
+# disk quotas of a repository and of all of a user's repositories (bytes stored plus the incoming pack). 0 disables
+# a limit
+settings.define('receive_max_pack_size', lambda: _get_int("hag.receive.max.pack.size", 0))
+settings.define('receive_max_blob_size', lambda: _get_int("hag.receive.max.blob.size", 0))
+settings.define('quota_repo', lambda: _get_int("hag.quota.repo", 0))
+settings.define('quota_user', lambda: _get_int("hag.quota.user", 0))
+
+# Upper bound on a decompressed gzip request body (guards against gzip bombs). 0 disables the limit
+settings.define('gzip_max_size', lambda: _get_int("hag.gzip.max.size", 1073741824))
+
+# Gzip compression of ref advertisements and other non-pack responses for clients that accept it: the zlib level
+# (1-9) and the smallest buffered response worth compressing
+settings.define('gzip_response', lambda: _get_bool("hag.gzip.response", True))
+settings.define('gzip_level', lambda: _get_int("hag.gzip.level", 6))
+settings.define('gzip_min_size', lambda: _get_int("hag.gzip.min.size", 1024))
+
+# Answer git wire protocol v2 requests (ls-refs and fetch) from clients that ask for it with Git-Protocol: version=2
+settings.define('protocol_v2', lambda: _get_bool("hag.protocol.v2", True))
+
+# Maximum number of idle open repositories kept by the git backend, in all and of any one repository (concurrent
+# requests to a repository each open a copy of their own), and how long (seconds) an unused one is kept
+settings.define('repo_cache_size', lambda: _get_int("hag.repo.cache.size", 128))
+settings.define('repo_cache_copies', lambda: _get_int("hag.repo.cache.copies", 4))
+settings.define('repo_cache_idle', lambda: _get_int("hag.repo.cache.idle", 300))
+
+# Maximum number of cached /info/refs advertisements and how long (seconds) one is served before its refs are re-checked
+settings.define('refs_cache_size', lambda: _get_int("hag.refs.cache.size", 1024))
+settings.define('refs_cache_ttl', lambda: _get_float("hag.refs.cache.ttl", 0.0))
+
+# Opt-in on disk cache of generated clone/fetch packs, its location and size budget (bytes)
+settings.define('pack_cache', lambda: _get_bool("hag.pack.cache", False))
+settings.define('pack_cache_dir', lambda: os.path.abspath(_get_option("hag.pack.cache.dir",
+                                                                      os.path.join(repos, '.cache', 'packs'))))
+settings.define('pack_cache_size', lambda: _get_int("hag.pack.cache.size", 1073741824))
+
+# Largest upload-pack request body considered for caching
+settings.define('pack_cache_request_max', lambda: _get_int("hag.pack.cache.request.max", 1048576))
+
+# Accept upload-pack wants for any object reachable from the refs rather than only ref tips (git's
+# uploadpack.allowReachableSHA1InWant). Blobless clones need it to fetch missing blobs on demand
+settings.define('upload_any_want', lambda: _get_bool("hag.upload.any.want", True))
+
+# Admission control for git-upload-pack and git-receive-pack: active request limits (0 means unlimited; the per repo
+# limit counts upload-packs), the wait queue, how long (seconds) a request may wait and the Retry-After (seconds) sent
+# when a request is turned away
+settings.define('scheduler_max_active', lambda: _get_int("hag.scheduler.max.active", 0))
+settings.define('scheduler_max_active_repo', lambda: _get_int("hag.scheduler.max.active.repo", 0))
+settings.define('scheduler_queue_size', lambda: _get_int("hag.scheduler.queue.size", 64))
+settings.define('scheduler_queue_timeout', lambda: _get_float("hag.scheduler.queue.timeout", 30.0))
+settings.define('scheduler_retry_after', lambda: _get_int("hag.scheduler.retry.after", 5))
+
+# Read replicas. A replica (hag.replica.primary set to the primary's git URL, e.g. http://primary:8000) serves fetches
+# from its own copy of the repositories and hands pushes to the primary, by proxying them or redirecting the client
+# (hag.replica.push = proxy or redirect). The primary notifies the replicas in hag.replica.peers (comma separated git
+# URLs) after each push, through the post-receive hook pipeline, and they fetch the changes with hag.replica.workers
+# threads. hag.replica.token, when set on both, authenticates the notifications
+settings.define('replica_primary', lambda: _get_option("hag.replica.primary", None))
+settings.define('replica_push', lambda: _get_option("hag.replica.push", "proxy"))
+settings.define('replica_peers', lambda: _get_list("hag.replica.peers"))
+settings.define('replica_token', lambda: _get_option("hag.replica.token", None))
+settings.define('replica_workers', lambda: _get_int("hag.replica.workers", 2))
+settings.define('replica_timeout', lambda: _get_float("hag.replica.timeout", 60.0))
+
+# JSON lines access log of the git endpoints, written by a background thread: where it goes (a file, "-" for stderr;
+# unset disables it), the share of successful reads that are logged (errors and pushes always are) and how many entries
+# may wait for the writer before further ones are dropped. Client addresses follow hag.ratelimit.trust.forwarded
+settings.define('access_log', lambda: _get_option("hag.access.log", None))
+settings.define('access_log_sample', lambda: _get_float("hag.access.log.sample", 1.0))
+settings.define('access_log_queue_size', lambda: _get_int("hag.access.log.queue.size", 10000))
+
+# Prometheus-style /metrics endpoint and the number of distinct repos reported before they are grouped as "other"
+settings.define('metrics', lambda: _get_bool("hag.metrics", True))
+settings.define('metrics_max_repos', lambda: _get_int("hag.metrics.max.repos", 1000))
+
+# Background repository maintenance (repack, pack-refs and prune). A repo is queued after this many pushes, or once it
+# has this many packs or (estimated) loose objects; 0 disables a threshold. Queued runs wait until at most
+# hag.maintenance.max.active foreground git requests are active, re-checking every hag.maintenance.idle.wait seconds,
+# and run regardless (at low priority) after hag.maintenance.max.wait seconds (0 waits indefinitely).
+# Unreachable objects younger than hag.maintenance.prune.grace seconds are kept. dulwich repacks in memory, so it's
+# off by default and repos whose objects take more than hag.maintenance.max.size bytes are left to hag gc.
+settings.define('maintenance', lambda: _get_bool("hag.maintenance", False))
+settings.define('maintenance_workers', lambda: _get_int("hag.maintenance.workers", 1))
+settings.define('maintenance_pushes', lambda: _get_int("hag.maintenance.pushes", 100))
+settings.define('maintenance_loose_objects', lambda: _get_int("hag.maintenance.loose.objects", 6700))
+settings.define('maintenance_packs', lambda: _get_int("hag.maintenance.packs", 50))
+settings.define('maintenance_max_active', lambda: _get_int("hag.maintenance.max.active", 4))
+settings.define('maintenance_idle_wait', lambda: _get_float("hag.maintenance.idle.wait", 5.0))
+settings.define('maintenance_max_wait', lambda: _get_float("hag.maintenance.max.wait", 3600.0))
+settings.define('maintenance_prune_grace', lambda: _get_int("hag.maintenance.prune.grace", 1209600))
+settings.define('maintenance_max_size', lambda: _get_int("hag.maintenance.max.size", 1073741824))
+
+# Post-receive hooks run asynchronously after pushes: comma separated executables (run like git's post-receive) and
+# Python callables ("module:attribute"), the spool folder that keeps events across restarts, the worker pool and
+# in-memory queue sizes, retries with exponential backoff (seconds) and the timeout (seconds) of a hook executable
+settings.define('hooks_scripts', lambda: _get_list("hag.hooks.scripts"))
+settings.define('hooks_callables', lambda: _get_list("hag.hooks.callables"))
+settings.define('hooks_spool_dir', lambda: os.path.abspath(_get_option("hag.hooks.spool.dir",
+                                                                       os.path.join(repos, '.hooks', 'spool'))))
+settings.define('hooks_workers', lambda: _get_int("hag.hooks.workers", 2))
+settings.define('hooks_queue_size', lambda: _get_int("hag.hooks.queue.size", 1000))
+settings.define('hooks_retries', lambda: _get_int("hag.hooks.retries", 5))
+settings.define('hooks_backoff', lambda: _get_float("hag.hooks.backoff", 1.0))
+settings.define('hooks_backoff_max', lambda: _get_float("hag.hooks.backoff.max", 300.0))
+settings.define('hooks_timeout', lambda: _get_float("hag.hooks.timeout", 60.0))
@@ -0,0 +1,221 @@
+import os
+import time
+import fcntl
+import queue
+import threading
+
+from dulwich import gc
+from dulwich.repo import Repo
+
+from hcli_core import logger
+
+log = logger.Logger("hag")
+
+LOCK_NAME = 'hag-gc.lock'
+
+
+class MaintenanceInProgress(Exception):
+    pass
+
+# Counts a repository's packs and estimates its loose objects the way git gc --auto does: objects are spread
+# evenly over the 256 fan-out folders, so one folder times 256 is a good estimate at the cost of one listdir.
+def repo_counts(repo_path):
+    try:
+        packs = sum(1 for name in os.listdir(os.path.join(repo_path, 'objects', 'pack')) if name.endswith('.pack'))
+    except FileNotFoundError:
+        packs = 0
+
+    try:
+        loose = len(os.listdir(os.path.join(repo_path, 'objects', '17'))) * 256
+    except FileNotFoundError:
+        loose = 0
+
+    return packs, loose
+
+# The bytes of a repository's packs plus an estimate of its loose objects (taken from one fan-out folder like
+# repo_counts), which is about what a repack holds in memory
+def object_size(repo_path):
+    pack_dir = os.path.join(repo_path, 'objects', 'pack')
+    size = 0
+    try:
+        names = os.listdir(pack_dir)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        if name.endswith('.pack'):
+            try:
+                size += os.path.getsize(os.path.join(pack_dir, name))
+            except FileNotFoundError:
+                pass
+
+    loose_dir = os.path.join(repo_path, 'objects', '17')
+    try:
+        names = os.listdir(loose_dir)
+    except FileNotFoundError:
+        names = []
+    for name in names:
+        try:
+            size += os.path.getsize(os.path.join(loose_dir, name)) * 256
+        except FileNotFoundError:
+            pass
+    return size
+
+# Repacks a repository into a single pack, packs its refs and prunes unreachable objects older than grace_period.
+# Runs are serialized per repository with a lock file so that hag gc and background maintenance (in this or another
+# worker process) never repack the same repository at once. Pushes may proceed concurrently: dulwich only removes
+# the packs and loose objects it repacked, and objects a push has written but not referenced yet are younger than
+# the grace period. Note that dulwich holds the repacked objects in memory.
+def run_gc(repo_path, prune=True, grace_period=1209600, progress=None):
+    lock_path = os.path.join(repo_path, LOCK_NAME)
+    with open(lock_path, 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise MaintenanceInProgress(f"Maintenance is already running for {repo_path}")
+
+        try:
+            start = time.monotonic()
+            repo = Repo(repo_path)
+            try:
+                stats = gc.garbage_collect(repo, prune=prune, grace_period=grace_period, progress=progress)
+            finally:
+                repo.close()
+
+            log.info(f"Maintenance of {repo_path} took {time.monotonic() - start:.2f}s: "
+                     f"packs {stats.packs_before} -> {stats.packs_after}, "
+                     f"loose objects {stats.loose_objects_before} -> {stats.loose_objects_after}, "
+                     f"pruned {len(stats.pruned_objects)} objects")
+            return stats
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+# Background repository maintenance.
+# Successful pushes are recorded per repository; once a repository has seen enough pushes, or has too many packs or
+# loose objects, it's queued for run_gc() on a small pool of low priority threads. A queued run waits until the
+# number of active foreground git requests is at most max_active, so maintenance mostly uses otherwise quiet time; on
+# a server that is never that quiet it runs anyway once it has waited max_wait seconds, still at low priority.
+# Since dulwich repacks in memory, repositories whose objects take more than max_size bytes are never maintained
+# automatically; hag gc still runs on them.
+class Maintenance:
+
+    def __init__(self, scheduler=None, on_done=None, workers=1, push_threshold=100, loose_threshold=6700,
+                 pack_threshold=50, max_active=4, idle_wait=5.0, max_wait=3600.0, grace_period=1209600,
+                 max_size=1073741824):
+        self.scheduler = scheduler
+        self.on_done = on_done
+        self.workers = max(1, workers)
+        self.push_threshold = push_threshold
+        self.loose_threshold = loose_threshold
+        self.pack_threshold = pack_threshold
+        self.max_active = max_active
+        self.idle_wait = idle_wait
+        self.max_wait = max_wait
+        self.grace_period = grace_period
+        self.max_size = max_size
+        self.runs = 0
+        self.failures = 0
+        self._pushes = {}
+        self._pending = set()
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self):
+        with self._lock:
+            return len(self._pending)
+
+    # Returns why a repository needs maintenance, or None.
+    def needs_gc(self, repo_path):
+        reason = self._reason(repo_path)
+        if reason is None or self.max_size <= 0:
+            return reason
+
+        size = object_size(repo_path)
+        if size > self.max_size:
+            with self._lock:
+                self._pushes.pop(repo_path, None)
+            log.info(f"Not maintaining {repo_path} ({reason}): its objects take about {size} bytes, over the "
+                     f"{self.max_size} byte limit. Run hag gc to maintain it.")
+            return None
+        return reason
+
+    def _reason(self, repo_path):
+        with self._lock:
+            pushes = self._pushes.get(repo_path, 0)
+        if self.push_threshold > 0 and pushes >= self.push_threshold:
+            return f"{pushes} pushes"
+
+        packs, loose = repo_counts(repo_path)
+        if self.pack_threshold > 0 and packs >= self.pack_threshold:
+            return f"{packs} packs"
+        if self.loose_threshold > 0 and loose >= self.loose_threshold:
+            return f"about {loose} loose objects"
+
+        return None
+
+    def record_push(self, repo_path):
+        with self._lock:
+            self._pushes[repo_path] = self._pushes.get(repo_path, 0) + 1
+
+        reason = self.needs_gc(repo_path)
+        if reason is not None:
+            self.submit(repo_path, reason)
+
+    def submit(self, repo_path, reason=None):
+        with self._lock:
+            if repo_path in self._pending:
+                return False
+            self._pending.add(repo_path)
+            self._start()
+
+        log.info(f"Queued maintenance of {repo_path}" + (f" ({reason})" if reason else ""))
+        self._queue.put(repo_path)
+        return True
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"hag-maintenance-{len(self._threads)}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _wait_for_idle(self, repo_path):
+        start = time.monotonic()
+        while self.scheduler is not None and self.scheduler.active > self.max_active:
+            if self.max_wait > 0 and time.monotonic() - start >= self.max_wait:
+                log.info(f"Maintaining {repo_path} with {self.scheduler.active} git requests active after waiting "
+                         f"{self.max_wait:.0f}s for a quieter moment")
+                return
+            time.sleep(self.idle_wait)
+
+    def _work(self):
+
+        # Lower this thread's scheduling priority (Linux applies nice values per thread) so that the I/O and
+        # the non-Python parts of a repack yield to the request threads
+        try:
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+
+        while True:
+            repo_path = self._queue.get()
+            try:
+                self._wait_for_idle(repo_path)
+                if not os.path.isdir(repo_path):
+                    continue
+
+                run_gc(repo_path, grace_period=self.grace_period)
+                with self._lock:
+                    self._pushes.pop(repo_path, None)
+                    self.runs += 1
+                if self.on_done is not None:
+                    self.on_done(repo_path)
+            except MaintenanceInProgress as e:
+                log.info(str(e))
+            except Exception as e:
+                with self._lock:
+                    self.failures += 1
+                log.error(f"Maintenance of {repo_path} failed: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(repo_path)
@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import fcntl
+import struct
+import tempfile
+import threading
+import contextlib
+
+from hcli_hag.cli import config
+
+from hcli_core import logger
+
+log = logger.Logger("hag")
+
+# Activity counters, which are added up rather than measured
+COUNTERS = ('pushes', 'clones', 'fetches')
+
+# What hag stat reports about a repository, in order
+FIELDS = ('size', 'objects', 'packed_objects', 'loose_objects', 'packs', 'refs', 'pushes', 'clones', 'fetches',
+          'last_push', 'updated')
+
+
+# The number of objects in a pack, read from the last entry of its index's fan-out table (version 1 or 2)
+def pack_index_count(idx_path):
+    with open(idx_path, 'rb') as f:
+        header = f.read(8)
+        f.seek(8 + 255 * 4 if header[:4] == b'\377tOc' else 255 * 4)
+        return struct.unpack('>I', f.read(4))[0]
+
+# Counts, objects and bytes of a repository's packs. One listdir and a small read per pack.
+def pack_stats(repo_path):
+    pack_dir = os.path.join(repo_path, 'objects', 'pack')
+    packs = objects = size = 0
+    try:
+        names = os.listdir(pack_dir)
+    except FileNotFoundError:
+        return {'packs': 0, 'packed_objects': 0, 'pack_bytes': 0}
+
+    for name in names:
+        if not name.endswith('.pack'):
+            continue
+        idx_path = os.path.join(pack_dir, name[:-5] + '.idx')
+        try:
+            size += os.stat(os.path.join(pack_dir, name)).st_size + os.stat(idx_path).st_size
+            objects += pack_index_count(idx_path)
+            packs += 1
+        except (OSError, struct.error):
+
+            # A pack that is still being written or was just repacked away
+            continue
+
+    return {'packs': packs, 'packed_objects': objects, 'pack_bytes': size}
+
+# Counts and bytes of a repository's loose objects. This walks the 256 fan-out folders, which is what the incremental
+# statistics avoid doing on every push.
+def loose_stats(repo_path):
+    objects_dir = os.path.join(repo_path, 'objects')
+    count = size = 0
+    for i in range(256):
+        try:
+            with os.scandir(os.path.join(objects_dir, f"{i:02x}")) as entries:
+                for entry in entries:
+                    try:
+                        size += entry.stat().st_size
+                        count += 1
+                    except FileNotFoundError:
+                        pass
+        except FileNotFoundError:
+            continue
+
+    return {'loose_objects': count, 'loose_bytes': size}
+
+# The number of refs, loose or packed
+def count_refs(repo_path):
+    names = set()
+    try:
+        with open(os.path.join(repo_path, 'packed-refs'), 'r', errors='replace') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and not line.startswith(('#', '^')):
+                    names.add(parts[1])
+    except FileNotFoundError:
+        pass
+
+    for dirpath, dirnames, filenames in os.walk(os.path.join(repo_path, 'refs')):
+        for name in filenames:
+            if not name.endswith('.lock'):
+                names.add(os.path.relpath(os.path.join(dirpath, name), repo_path).replace(os.sep, '/'))
+
+    return {'refs': len(names)}
+
+# Everything measured about a repository
+def scan(repo_path):
+    measured = {}
+    measured.update(pack_stats(repo_path))
+    measured.update(loose_stats(repo_path))
+    measured.update(count_refs(repo_path))
+    return measured
+
+# The reported fields of a statistics entry, with its totals worked out
+def summarize(entry):
+    totals = {'size': entry.get('pack_bytes', 0) + entry.get('loose_bytes', 0),
+              'objects': entry.get('packed_objects', 0) + entry.get('loose_objects', 0)}
+    return {name: totals.get(name, entry.get(name, 0 if name not in ('last_push', 'updated') else None))
+            for name in FIELDS}
+
+# Repository statistics persisted as a snapshot plus an append-only journal, both in the hag home.
+# Each change (the measurements taken after a push or maintenance run, or counter increments) is one small JSON line
+# appended to the journal, so recording it never rewrites the whole file, and readers catch up by reading the lines
+# added since they last looked. Once the journal outgrows journal_max bytes it's folded into a new snapshot.
+# Writers and readers share a lock file that compaction takes exclusively, so nobody sees a new snapshot together
+# with the journal lines already folded into it. Clone and fetch counts are added up in memory and appended every
+# flush_interval seconds.
+class StatsStore:
+
+    def __init__(self, path, journal_max=1048576, flush_interval=10.0):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.lock_path = path + '.lock'
+        self.journal_max = journal_max
+        self.flush_interval = flush_interval
+        self._entries = {}
+        self._snapshot_state = None
+        self._journal_inode = None
+        self._journal_offset = 0
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.RLock()
+
+    @contextlib.contextmanager
+    def _file_lock(self, exclusive=False):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def _apply(self, entries, change):
+        key = change.get('k')
+        if not key:
+            return
+        if change.get('del'):
+            entries.pop(key, None)
+            return
+
+        entry = entries.setdefault(key, {})
+        entry.update(change.get('set', {}))
+        for name, amount in change.get('add', {}).items():
+            entry[name] = entry.get(name, 0) + amount
+
+    # Catches up with the files; the caller holds the file lock
+    def _load(self):
+        try:
+            st = os.stat(self.path)
+            snapshot_state = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            snapshot_state = None
+
+        try:
+            journal_inode = os.stat(self.journal_path).st_ino
+        except FileNotFoundError:
+            journal_inode = None
+
+        if snapshot_state != self._snapshot_state or journal_inode != self._journal_inode:
+            entries = {}
+            if snapshot_state is not None:
+                try:
+                    with open(self.path, 'r') as f:
+                        entries = json.load(f).get('repos', {})
+                except (OSError, ValueError) as e:
+                    log.warning(f"Ignoring unreadable hag stats {self.path}: {e}")
+            self._entries = entries
+            self._snapshot_state = snapshot_state
+            self._journal_inode = journal_inode
+            self._journal_offset = 0
+
+        if journal_inode is None:
+            return
+
+        try:
+            with open(self.journal_path, 'rb') as f:
+                f.seek(self._journal_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        # A line that is still being appended is left for the next read
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            try:
+                self._apply(self._entries, json.loads(line))
+            except ValueError:
+                log.warning(f"Skipping a corrupt line of {self.journal_path}")
+        self._journal_offset += end
+
+    def _append(self, changes):
+        data = b''.join(json.dumps(change, separators=(',', ':')).encode('utf-8') + b'\n' for change in changes)
+        with self._lock:
+            with self._file_lock():
+                fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, data)
+                    size = os.fstat(fd).st_size
+                finally:
+                    os.close(fd)
+                self._load()
+
+            if size > self.journal_max:
+                self.compact()
+
+    # Folds the journal into a new snapshot and starts an empty journal
+    def compact(self):
+        with self._lock, self._file_lock(exclusive=True):
+            self._load()
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.stats', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'repos': self._entries}, f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.stats', suffix='.tmp')
+            os.close(fd)
+            os.replace(tmp_path, self.journal_path)
+            self._load()
+
+    # Records new measurements of a repository, and optionally adds to its counters
+    def update(self, key, measured, add=None):
+        change = {'k': key, 'set': {**measured, 'updated': time.time()}}
+        if add:
+            change['add'] = add
+        self._append([change])
+
+    # Drops a repository's statistics, including counts not written out yet
+    def forget(self, key):
+        with self._lock:
+            self._pending.pop(key, None)
+        self._append([{'k': key, 'del': True}])
+
+    # Adds to a repository's counters in memory; they're written out by the next flush
+    def count(self, key, name, amount=1):
+        with self._lock:
+            counters = self._pending.setdefault(key, {})
+            counters[name] = counters.get(name, 0) + amount
+            if self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._timer = None
+        if pending:
+            try:
+                self._append([{'k': key, 'add': counters} for key, counters in pending.items()])
+            except OSError as e:
+                log.warning(f"Unable to save hag stats {self.journal_path}: {e}")
+
+    def _with_pending(self, key, entry):
+        entry = dict(entry)
+        for name, amount in self._pending.get(key, {}).items():
+            entry[name] = entry.get(name, 0) + amount
+        return entry
+
+    # A repository's statistics (including counts not written out yet), or None if it has none
+    def get(self, key):
+        with self._lock:
+            with self._file_lock():
+                self._load()
+            entry = self._entries.get(key)
+            return None if entry is None else self._with_pending(key, entry)
+
+    # The statistics of every repository that has some, read in one go for fleet-wide reports
+    def entries(self):
+        with self._lock:
+            with self._file_lock():
+                self._load()
+            return {key: self._with_pending(key, entry) for key, entry in self._entries.items()}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+# Keeps a repository's statistics current after a push: its packs and refs are measured again (dulwich adds a pack
+# per push and never loose objects) and the loose objects are carried over, or measured in full the first time
+def record_push(store, user, repo, repo_path):
+    key = f"{user}/{repo}"
+    measured = {**pack_stats(repo_path), **count_refs(repo_path)}
+    entry = store.get(key)
+    if entry is None or 'loose_objects' not in entry:
+        measured.update(loose_stats(repo_path))
+    store.update(key, {**measured, 'last_push': time.time()}, add={'pushes': 1})
+
+# Measures a repository in full, e.g. after maintenance repacked it
+def record_scan(store, user, repo, repo_path):
+    store.update(f"{user}/{repo}", scan(repo_path))
+
+# The reported statistics of a repository, measured and recorded first if it has none yet (or on refresh). Without a
+# store the repository is measured every time.
+def repo_stats(store, user, repo, repo_path, entry=None, refresh=False):
+    if store is None:
+        return summarize(scan(repo_path))
+
+    if entry is None and not refresh:
+        entry = store.get(f"{user}/{repo}")
+    if entry is None or refresh:
+        record_scan(store, user, repo, repo_path)
+        entry = store.get(f"{user}/{repo}") or {}
+    return summarize(entry)
+
+_store = None
+_store_lock = threading.Lock()
+
+# The statistics of every repository, kept in the hag home
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = StatsStore(os.path.join(config.repos, '.stats'),
+                                journal_max=config.stats_journal_max,
+                                flush_interval=config.stats_flush_interval)
+        return _store
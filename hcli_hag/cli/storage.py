@@ -0,0 +1,367 @@
+import os
+import json
+import errno
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+import contextlib
+
+from hcli_hag.cli import config
+from hcli_hag.cli import maintenance
+
+from hcli_core import logger
+
+from dulwich.repo import Repo
+
+log = logger.Logger("hag")
+
+MOVE_LOCK_NAME = 'hag-move.lock'
+
+
+# Rendezvous (highest random weight) hashing of user/repo over the storage roots: each root scores the repository with
+# a hash of both and the highest score wins. Unlike a hash modulo the number of roots, adding a root only moves the
+# repositories that now score highest on it (about 1/n of them).
+def placement(roots, user, repo):
+    key = f"{user}/{repo}".encode('utf-8')
+    return max(roots, key=lambda root: hashlib.sha1(os.fsencode(root) + b'\0' + key).digest())
+
+# Optional record of where repositories live when that isn't their hashed placement (after hag mv, or for repositories
+# created before a root was added), so that finding them doesn't mean probing every root. It's a small JSON file that
+# is re-read when it changes, so every server process sees a move as soon as it's recorded.
+class PlacementIndex:
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._file_state = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._entries = {}
+            self._file_state = None
+            return
+
+        file_state = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if file_state == self._file_state:
+            return
+
+        try:
+            with open(self.path, 'r') as f:
+                self._entries = json.load(f).get('repos', {})
+            self._file_state = file_state
+        except (OSError, ValueError) as e:
+            log.warning(f"Ignoring unreadable hag placement index {self.path}: {e}")
+            self._entries = {}
+
+    def get(self, user, repo):
+        with self._lock:
+            self._load()
+            return self._entries.get(f"{user}/{repo}")
+
+    # Records the root of a repository, or forgets it when root is None. Writers in other processes are serialized
+    # with a lock file.
+    def set(self, user, repo, root):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock, open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load()
+            entries = dict(self._entries)
+            if root is None:
+                entries.pop(f"{user}/{repo}", None)
+            else:
+                entries[f"{user}/{repo}"] = root
+
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.placement', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'repos': entries}, f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._entries = entries
+            self._file_state = None
+
+# Repository storage spread over one or more roots, each holding <root>/<user>/<repo>.git.
+# The first root is the hag home; with a single root this is exactly the original layout.
+class Storage:
+
+    def __init__(self, roots, index=None):
+        self.roots = roots
+        self.index = index
+
+    def placed_root(self, user, repo):
+        if len(self.roots) == 1:
+            return self.roots[0]
+        return placement(self.roots, user, repo)
+
+    # The folder of a repository: where the placement index says it is, else its hashed placement, else whichever
+    # other root has it. That's a handful of stats however many repositories there are. A repository that doesn't
+    # exist resolves to its hashed placement, where it would be created.
+    def locate(self, user, repo):
+        if len(self.roots) == 1:
+            return os.path.join(self.roots[0], user, repo)
+
+        if self.index is not None:
+            root = self.index.get(user, repo)
+            if root is not None and os.path.isdir(os.path.join(root, user, repo)):
+                return os.path.join(root, user, repo)
+
+        placed = self.placed_root(user, repo)
+        if os.path.isdir(os.path.join(placed, user, repo)):
+            return os.path.join(placed, user, repo)
+
+        for root in self.roots:
+            if root != placed and os.path.isdir(os.path.join(root, user, repo)):
+                return os.path.join(root, user, repo)
+
+        return os.path.join(placed, user, repo)
+
+    def root_of(self, repo_path):
+        return os.path.dirname(os.path.dirname(repo_path))
+
+    # Holds a shared lock on a repository while a push writes to it, so that hag mv can wait for pushes in progress
+    # and keep new ones out while it switches the repository over. Yields the repository folder, resolved again when
+    # the repository was moved while the push waited.
+    @contextlib.contextmanager
+    def push_lock(self, user, repo):
+        while True:
+            repo_path = self.locate(user, repo)
+            lock_path = os.path.join(repo_path, MOVE_LOCK_NAME)
+            try:
+                lock = open(lock_path, 'a')
+            except (FileNotFoundError, NotADirectoryError):
+                yield repo_path
+                return
+
+            with lock:
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                try:
+                    moved = os.stat(lock_path).st_ino != os.fstat(lock.fileno()).st_ino
+                except FileNotFoundError:
+                    moved = True
+
+                if not moved:
+                    yield repo_path
+                    return
+
+    # Moves a repository to another root while it stays online. The repository is copied first while fetches and
+    # pushes carry on; then pushes are held off while the files that changed in the meantime are synced, the copy is
+    # switched in and the original is removed. Maintenance of the repository is locked out for the whole move.
+    # Returns the old and new repository folders.
+    def move(self, user, repo, root=None):
+        if root is None:
+            root = self.placed_root(user, repo)
+        root = os.path.abspath(root)
+        if root not in self.roots:
+            raise ValueError(f"{root} is not a storage root")
+
+        src = self.locate(user, repo)
+        if not os.path.isdir(src):
+            raise FileNotFoundError(f"No git repository was found at {user}/{repo}")
+
+        dst = os.path.join(root, user, repo)
+        if src == dst:
+            return src, dst
+        if os.path.exists(dst):
+            raise FileExistsError(f"{dst} already exists")
+
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = os.path.join(root, user, f".{repo}.move-{os.getpid()}")
+        hidden = os.path.join(os.path.dirname(src), f".{repo}.moved-{os.getpid()}")
+        ignore = shutil.ignore_patterns(MOVE_LOCK_NAME, maintenance.LOCK_NAME)
+
+        with open(os.path.join(src, maintenance.LOCK_NAME), 'a') as gc_lock:
+            try:
+                fcntl.flock(gc_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise maintenance.MaintenanceInProgress(f"Maintenance or a move is already running for {src}")
+
+            try:
+                shutil.copytree(src, tmp, symlinks=True, ignore=ignore)
+                with open(os.path.join(src, MOVE_LOCK_NAME), 'a') as move_lock:
+                    fcntl.flock(move_lock, fcntl.LOCK_EX)
+                    _sync_tree(src, tmp, (MOVE_LOCK_NAME, maintenance.LOCK_NAME))
+                    os.rename(tmp, dst)
+                    if self.index is not None:
+                        self.index.set(user, repo, None if root == self.placed_root(user, repo) else root)
+                    os.rename(src, hidden)
+            except BaseException:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+
+        shutil.rmtree(hidden, ignore_errors=True)
+        log.info(f"Moved {user}/{repo} from {self.root_of(src)} to {root}")
+        return src, dst
+
+    # Creates an empty bare repository on root (by default the root its name hashes to). It's made under a hidden name
+    # and renamed into place, so the git endpoints, which look repositories up on every request, serve it from then on
+    # and never see it half made. populate, if given, fills in the new repository before that. Returns its folder.
+    def create(self, user, repo, root=None, populate=None):
+        if os.path.isdir(self.locate(user, repo)):
+            raise FileExistsError(f"{user}/{repo} already exists")
+
+        root = os.path.abspath(root) if root is not None else self.placed_root(user, repo)
+        if root not in self.roots:
+            raise ValueError(f"{root} is not a storage root")
+
+        dst = os.path.join(root, user, repo)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(dst), prefix=f".{repo}.create-")
+        try:
+            Repo.init_bare(tmp).close()
+            if populate is not None:
+                populate(tmp)
+            try:
+                os.rename(tmp, dst)
+            except OSError as e:
+                if e.errno in (errno.EEXIST, errno.ENOTEMPTY):
+                    raise FileExistsError(f"{user}/{repo} already exists")
+                raise
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+        if self.index is not None and root != self.placed_root(user, repo):
+            self.index.set(user, repo, root)
+        log.info(f"Created {user}/{repo} on {root}")
+        return dst
+
+    # Creates user/repo as a fork of src_user/src_repo. The fork goes on its parent's root so that the two share their
+    # objects: packs and loose objects are hard linked rather than copied. Git never changes them once written, so
+    # each side's later pushes and repacks only add or unlink names of its own, and removing or moving either one
+    # leaves the other whole. Objects are copied where they can't be linked. Refs are copied before the objects are
+    # linked, so that everything they point to is there even if the parent is pushed to meanwhile; the parent's
+    # maintenance is locked out so that a repack doesn't remove packs mid-way. Returns the fork's folder and the number
+    # of object files linked and copied.
+    def fork(self, src_user, src_repo, user, repo):
+        src = self.locate(src_user, src_repo)
+        if not os.path.isdir(src):
+            raise FileNotFoundError(f"No git repository was found at {src_user}/{src_repo}")
+
+        counts = {'linked': 0, 'copied': 0}
+
+        def populate(dst):
+            for name in ('HEAD', 'config', 'packed-refs', 'description'):
+                if os.path.exists(os.path.join(src, name)):
+                    shutil.copy2(os.path.join(src, name), os.path.join(dst, name))
+            shutil.copytree(os.path.join(src, 'refs'), os.path.join(dst, 'refs'), symlinks=True, dirs_exist_ok=True,
+                            ignore=shutil.ignore_patterns('*.lock'))
+
+            objects = os.path.join(src, 'objects')
+            for dirpath, dirnames, filenames in os.walk(objects):
+                target_dir = os.path.join(dst, 'objects', os.path.relpath(dirpath, objects))
+                os.makedirs(target_dir, exist_ok=True)
+                for name in filenames:
+
+                    # Partial packs of a push in progress
+                    if name.startswith('tmp_'):
+                        continue
+                    counts['linked' if _link_or_copy(os.path.join(dirpath, name),
+                                                     os.path.join(target_dir, name)) else 'copied'] += 1
+
+        with open(os.path.join(src, maintenance.LOCK_NAME), 'a') as gc_lock:
+            try:
+                fcntl.flock(gc_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise maintenance.MaintenanceInProgress(f"Maintenance or a move is already running for {src}")
+
+            dst = self.create(user, repo, root=self.root_of(src), populate=populate)
+
+        log.info(f"Forked {src_user}/{src_repo} as {user}/{repo} ({counts['linked']} object files linked, "
+                 f"{counts['copied']} copied)")
+        return dst, counts['linked'], counts['copied']
+
+    # Removes a repository. Pushes in progress are waited for and later ones find it gone; maintenance or a move of
+    # it must not be running. It's renamed away first, so it's gone at once however long deleting its files takes.
+    # Forks hold links of their own to the object files they share with it, so they're unaffected. Returns the folder
+    # it was in.
+    def remove(self, user, repo):
+        repo_path = self.locate(user, repo)
+        if not os.path.isdir(repo_path):
+            raise FileNotFoundError(f"No git repository was found at {user}/{repo}")
+
+        hidden = tempfile.mkdtemp(dir=os.path.dirname(repo_path), prefix=f".{repo}.removed-")
+        with open(os.path.join(repo_path, maintenance.LOCK_NAME), 'a') as gc_lock:
+            try:
+                fcntl.flock(gc_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.rmdir(hidden)
+                raise maintenance.MaintenanceInProgress(f"Maintenance or a move is already running for {repo_path}")
+
+            with open(os.path.join(repo_path, MOVE_LOCK_NAME), 'a') as move_lock:
+                fcntl.flock(move_lock, fcntl.LOCK_EX)
+                os.rename(repo_path, hidden)
+                if self.index is not None:
+                    self.index.set(user, repo, None)
+
+        shutil.rmtree(hidden, ignore_errors=True)
+        log.info(f"Removed {user}/{repo} from {self.root_of(repo_path)}")
+        return repo_path
+
+# Hard links src as dst, or copies it where that isn't possible (another filesystem, or one without hard links).
+# Returns whether it was linked.
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+        return True
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    shutil.copy2(src, dst)
+    return False
+
+# Makes dst a copy of src again after src changed: new and modified files (by size and mtime) are copied and files
+# that are gone from src are removed. Git writes objects and packs once, so this mostly copies new objects and refs.
+def _sync_tree(src, dst, ignore):
+    seen = set()
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel = os.path.relpath(dirpath, src)
+        target_dir = os.path.normpath(os.path.join(dst, rel))
+        os.makedirs(target_dir, exist_ok=True)
+        seen.add(os.path.normpath(rel))
+        for name in filenames:
+            if name in ignore:
+                continue
+            source = os.path.join(dirpath, name)
+            target = os.path.join(target_dir, name)
+            seen.add(os.path.normpath(os.path.join(rel, name)))
+            st = os.lstat(source)
+            try:
+                tt = os.lstat(target)
+                if tt.st_size == st.st_size and tt.st_mtime_ns == st.st_mtime_ns:
+                    continue
+            except FileNotFoundError:
+                pass
+            shutil.copy2(source, target, follow_symlinks=False)
+
+    for dirpath, dirnames, filenames in os.walk(dst, topdown=False):
+        rel = os.path.relpath(dirpath, dst)
+        for name in filenames:
+            if os.path.normpath(os.path.join(rel, name)) not in seen:
+                os.unlink(os.path.join(dirpath, name))
+        if os.path.normpath(rel) not in seen:
+            os.rmdir(dirpath)
+
+_storage = None
+_storage_lock = threading.Lock()
+
+# The configured storage: the hag home followed by the hag.storage.roots folders
+def get_storage():
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            roots = [config.repos]
+            for root in config.storage_roots:
+                root = os.path.abspath(root)
+                if root not in roots:
+                    roots.append(root)
+
+            index = None
+            if config.storage_index:
+                index = PlacementIndex(os.path.join(config.repos, '.placement'))
+            _storage = Storage(roots, index)
+        return _storage
@@ -1,3 +1,6 @@
+import datetime
+
+
 class Formatting:
     SEPARATOR = "----"
     NEWLINES = "\n\n"
@@ -27,12 +30,16 @@ def format_row(user, repo):
 #    return f"{user_formatted}  {repo_formatted}"
     return f"{user_formatted}  {repo}"
 
+# Format the header row.
+def format_header():
+    return format_row("USER", "GIT REPO")
+
 # Format multiple context rows with a header.
 # The title column is not constrained and has no trailing dots.
 def format_rows(contexts):
 
     # Create header
-    header = format_row("USER", "GIT REPO")
+    header = format_header()
 
     # Format each row
     rows = [header]
@@ -45,3 +52,25 @@ def format_rows(contexts):
 
     # Join rows with newlines
     return "\n".join(rows)
+
+# Format a byte count with a binary unit, e.g. 1.5 MiB.
+def format_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024 or unit == "GiB":
+            break
+        size /= 1024
+    return f"{size} B" if unit == "B" else f"{size:.1f} {unit}"
+
+# Format a row of repository statistics with fixed-width columns; the repository name comes last and isn't truncated.
+def format_stat_row(repo, size, objects, packs, refs, last_push, clones):
+    return f"{size:>10}  {objects:>9}  {packs:>5}  {refs:>6}  {last_push:<20}  {clones:>7}  {repo}"
+
+# Format the header row of repository statistics.
+def format_stat_header():
+    return format_stat_row("REPO", "SIZE", "OBJECTS", "PACKS", "REFS", "LAST PUSH", "CLONES")
+
+# Format a Unix timestamp as a UTC date and time, or "-" when there is none.
+def format_time(timestamp):
+    if timestamp is None:
+        return "-"
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%SZ")
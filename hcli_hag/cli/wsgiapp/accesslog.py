@@ -0,0 +1,146 @@
+import sys
+import json
+import time
+import queue
+import random
+import logging
+import datetime
+import logging.handlers
+
+from hcli_core import config as c
+
+from hcli_hag.cli.wsgiapp import metrics
+from hcli_hag.cli.wsgiapp import ratelimit
+
+
+# Hands access log records to the writer thread as they are, so that nothing is formatted on the request thread. A
+# record that doesn't fit in the queue is dropped (and counted) rather than holding up the request.
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# Formats an access log record, whose message is the entry itself, as one line of JSON
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        return json.dumps(record.msg, separators=(',', ':'), default=str)
+
+# A JSON lines access log written by a QueueListener thread, to a file (reopened when it's rotated away) or to
+# stderr for "-". Entries go through a logger of their own that doesn't propagate to the hag log.
+class AccessLog:
+
+    def __init__(self, path, sample_rate=1.0, max_queue=10000):
+        self.path = path
+        self.sample_rate = sample_rate
+        if path == '-':
+            handler = logging.StreamHandler(sys.stderr)
+        else:
+            handler = logging.handlers.WatchedFileHandler(path, encoding='utf-8')
+        handler.setFormatter(JSONFormatter())
+
+        self.queue_handler = DroppingQueueHandler(queue.Queue(max(1, max_queue)))
+        self.listener = logging.handlers.QueueListener(self.queue_handler.queue, handler)
+        self.logger = logging.getLogger('hcli_hag.access')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        for existing in list(self.logger.handlers):
+            self.logger.removeHandler(existing)
+        self.logger.addHandler(self.queue_handler)
+
+    @property
+    def dropped(self):
+        return self.queue_handler.dropped
+
+    def start(self):
+        self.listener.start()
+
+    # Writes out what is queued and stops the writer thread
+    def stop(self):
+        self.listener.stop()
+
+    # Whether an entry is logged in full: errors and every request of a push (its ref advertisement included)
+    def always(self, entry):
+        return (entry['status'] >= 400 or entry['endpoint'] == 'git-receive-pack'
+                or entry['service'] == 'git-receive-pack')
+
+    # Logs errors and pushes, and other requests at the sampling rate. Sampled entries carry the rate they were
+    # sampled at so that counts can be scaled back up.
+    def write(self, entry):
+        if self.sample_rate < 1 and not self.always(entry):
+            if random.random() >= self.sample_rate:
+                return
+            entry['sample_rate'] = self.sample_rate
+        self.logger.info(entry)
+
+# Logs one entry per request to the repository endpoints: when it arrived, the client, the authenticated user, the
+# repository and endpoint, the status, the request and response body bytes and how long it took until the response was
+# sent. It's the outermost middleware, so the bytes are those on the wire and a streamed response is logged once it
+# has been sent.
+class AccessLogMiddleware:
+
+    def __init__(self, access_log, forwarded_hops=0):
+        self.access_log = access_log
+        self.forwarded_hops = forwarded_hops
+
+    def process_request(self, req, resp):
+        req.context.access_start = time.perf_counter()
+        req.context.access_time = time.time()
+        req.context.access_input = None
+        if req.content_length or req.get_header('Transfer-Encoding') or req.env.get('wsgi.input_terminated'):
+            counting = metrics.CountingInput(req.stream)
+            req.stream = counting
+            req.env['wsgi.input'] = counting
+            req.context.access_input = counting
+
+    def process_resource(self, req, resp, resource, params):
+        req.context.access_params = params
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        params = getattr(req.context, 'access_params', None)
+        if resource is None or params is None or 'user' not in params or 'repo' not in params:
+            return
+
+        # The current user is only set for this request on resources that authenticate
+        entry = {'time': datetime.datetime.fromtimestamp(req.context.access_time, datetime.timezone.utc)
+                                          .isoformat(timespec='milliseconds'),
+                 'ip': ratelimit.client_ip(req, self.forwarded_hops),
+                 'user': c.ServerContext.get_current_user() if getattr(resource, 'requires_authentication', False)
+                         else None,
+                 'method': req.method,
+                 'path': req.path,
+                 'endpoint': getattr(resource, 'endpoint', 'other'),
+                 'repo': f"{params['user']}/{params['repo']}",
+                 'service': req.get_param('service'),
+                 'user_agent': req.user_agent}
+
+        if resp.stream is not None and not hasattr(resp.stream, 'read'):
+            resp.stream = metrics.MeteredStream(resp.stream, lambda count: self._finish(req, resp, entry, count))
+            return
+
+        if resp.stream is not None:
+            sent = int(resp.content_length or 0)
+        elif resp.data is not None:
+            sent = len(resp.data)
+        elif resp.text is not None:
+            sent = len(resp.text.encode('utf-8'))
+        else:
+            sent = 0
+        self._finish(req, resp, entry, sent)
+
+    def _finish(self, req, resp, entry, sent):
+        entry['status'] = resp.status_code
+        entry['bytes_in'] = req.context.access_input.count if req.context.access_input is not None else 0
+        entry['bytes_out'] = sent
+        entry['duration'] = round(time.perf_counter() - req.context.access_start, 6)
+        self.access_log.write(entry)
@@ -0,0 +1,212 @@
+import os
+import sys
+import asyncio
+import functools
+import concurrent.futures
+
+import falcon.asgi
+
+from hcli_core import config as c
+from hcli_core import logger
+
+from hcli_hag.cli import config
+from hcli_hag.cli.wsgiapp import streaming
+
+log = logger.Logger("hag")
+
+# Request headers that WSGI carries in environ keys of their own rather than as HTTP_*
+ENVIRON_HEADERS = {'content-type': 'CONTENT_TYPE', 'content-length': 'CONTENT_LENGTH'}
+
+# Request headers about the connection rather than the request; the ASGI server has already decoded a chunked body
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'te', 'trailer', 'upgrade')
+
+
+# The WSGI environ of an ASGI HTTP request, with body as its wsgi.input. A body without a Content-Length is read
+# until it ends, as wsgi.input_terminated tells the app.
+def wsgi_environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client')
+    root_path = scope.get('root_path', '')
+    path = scope['path']
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+               'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+               'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+               'SERVER_NAME': server[0],
+               'SERVER_PORT': str(server[1] or 80),
+               'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+               'REMOTE_ADDR': client[0] if client else '',
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': body,
+               'wsgi.input_terminated': True,
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': True,
+               'wsgi.run_once': False}
+
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').lower()
+        if name in HOP_BY_HOP_HEADERS:
+            continue
+        key = ENVIRON_HEADERS.get(name) or 'HTTP_' + name.upper().replace('-', '_')
+        value = value.decode('latin-1')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+# The body of an ASGI request as a file for the WSGI app on its worker thread. Each read waits for the event loop to
+# receive the next piece of the body, so the client is only read from as fast as dulwich consumes the request.
+class BlockingInput:
+
+    def __init__(self, stream, loop, chunk_size=65536):
+        self._stream = stream
+        self._loop = loop
+        self._chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._eof = False
+
+    def _receive(self):
+        data = asyncio.run_coroutine_threadsafe(self._stream.read(self._chunk_size), self._loop).result()
+        if data:
+            self._buffer += data
+        else:
+            self._eof = True
+
+    def _take(self, size):
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while not self._eof:
+                self._receive()
+            return self._take(len(self._buffer))
+
+        while len(self._buffer) < size and not self._eof:
+            self._receive()
+        return self._take(size)
+
+    def readline(self, size=-1):
+        while True:
+            end = self._buffer.find(b'\n')
+            if end >= 0 and (size is None or size < 0 or end < size):
+                return self._take(end + 1)
+            if self._eof or (size is not None and 0 <= size <= len(self._buffer)):
+                return self._take(len(self._buffer) if size is None or size < 0 else size)
+            self._receive()
+
+    def close(self):
+        pass
+
+# A WSGI response body sent from the event loop, after anything the app wrote through start_response's write().
+# falcon closes it once the response is sent or the client went away, which closes the WSGI body and so releases
+# scheduler slots and completes the request's metrics.
+class ResponseBody:
+
+    def __init__(self, written, body, executor, chunk_size=65536):
+        self._written = written
+        self._body = body
+        self._executor = executor
+        self._chunk_size = chunk_size
+
+    async def __aiter__(self):
+        for data in self._written:
+            yield data
+        async for data in streaming.aiterate(self._body, self._executor, self._chunk_size):
+            if data:
+                yield data
+
+    async def close(self):
+        close = getattr(self._body, 'close', None)
+        if close is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, close)
+
+# Whether a request uploads a push's pack
+def is_push(req):
+    return req.method == 'POST' and req.path.endswith('/git-receive-pack')
+
+# Serves a WSGI falcon app, with all of its middleware and routes, from falcon's asyncio app.
+# Each request is handled on a bounded pool of threads until its response starts, which for a streamed git response is
+# as soon as dulwich has sent its headers, and the body is then sent from the event loop. Streamed git responses are
+# generated on a second bounded pool (offered to the app as hag.git_stream and hag.git_executor in the environ) and
+# spooled when the client is slow, so neither pool holds a thread for as long as a slow client takes to download.
+# A push can't be handled that way: receive-pack reads the pack as the client uploads it and only answers once it's
+# stored, so it holds its thread for the whole upload. Pushes get a third bounded pool so that slow uploads wait on
+# each other rather than taking the threads fetches are handled on.
+class WSGIBridge:
+
+    def __init__(self, app, server_type, workers=32, git_workers=8, push_workers=4):
+        self.app = app
+        self.server_type = server_type
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers),
+                                                              thread_name_prefix='hag-asgi')
+        self.git_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, git_workers),
+                                                                  thread_name_prefix='hag-asgi-git')
+        self.push_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, push_workers),
+                                                                   thread_name_prefix='hag-asgi-push')
+
+    def _call(self, environ, start_response):
+        c.ServerContext.set_current_server(self.server_type)
+        return self.app(environ, start_response)
+
+    async def handle(self, req, resp, **kwargs):
+        loop = asyncio.get_running_loop()
+        environ = wsgi_environ(req.scope, BlockingInput(req.stream, loop, config.stream_chunk_size))
+        environ['hag.git_stream'] = functools.partial(streaming.SpooledGitResponseStream,
+                                                      loop=loop,
+                                                      executor=self.git_executor,
+                                                      buffer_size=config.asgi_buffer_size,
+                                                      spool_size=config.asgi_spool_size,
+                                                      spool_dir=config.asgi_spool_dir,
+                                                      chunk_size=config.stream_chunk_size)
+        environ['hag.git_executor'] = self.git_executor
+
+        started = []
+        written = []
+        def start_response(status, response_headers, exc_info=None):
+            started[:] = [status, response_headers]
+            return written.append
+
+        executor = self.push_executor if is_push(req) else self.executor
+        body = await loop.run_in_executor(executor, self._call, environ, start_response)
+        status, response_headers = started
+        resp.status = status
+        for name, value in response_headers:
+            resp.append_header(name, value)
+        resp.stream = ResponseBody(written, body, self.executor, config.stream_chunk_size)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        self.git_executor.shutdown(wait=False)
+        self.push_executor.shutdown(wait=False)
+
+# Stops the bridge's thread pools when the ASGI server shuts down
+class LifespanMiddleware:
+
+    def __init__(self, bridge):
+        self.bridge = bridge
+
+    async def process_shutdown(self, scope, event):
+        self.bridge.shutdown()
+
+# Falcon's asyncio app serving a WSGI falcon app through a WSGIBridge
+def asgi_app(app, server_type, workers=32, git_workers=8, push_workers=4):
+    bridge = WSGIBridge(app, server_type, workers=workers, git_workers=git_workers, push_workers=push_workers)
+    server = falcon.asgi.App(middleware=[LifespanMiddleware(bridge)])
+    server.add_sink(bridge.handle, prefix='/')
+    return server
+
+# The ASGI counterpart of hcli_core's connector for the hag git endpoints, for an asyncio server such as uvicorn, e.g.
+# from a module holding: app = asgi.connector('/path/to/hcli_hag/cli', '/path/to/.hcli_core/etc/hag/config')
+def connector(plugin_path=None, config_path=None):
+    from hcli_hag.cli.wsgiapp.wsgiapp import WSGIApp
+
+    if plugin_path is None:
+        plugin_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    log.info(f"Serving the hag git endpoints over ASGI from {plugin_path}")
+    return WSGIApp('wsgiapp', os.path.abspath(plugin_path),
+                   os.path.abspath(config_path) if config_path is not None else None).asgi_server()
@@ -0,0 +1,177 @@
+import os
+import hmac
+import time
+import hashlib
+import threading
+
+from collections import OrderedDict
+from configparser import ConfigParser, Error as ConfigParserError
+
+from hcli_core import config as c
+from hcli_core import logger
+from hcli_core.auth.cli import authenticator
+
+log = logger.Logger("hag")
+
+
+# The fingerprints of the credentials in one credentials section: the stored password hash of a user and the stored
+# key hash of a valid API key. The admin bootstrap password ('*') isn't fingerprinted.
+def section_fingerprints(values):
+    fingerprints = {}
+    password = values.get('password')
+    if values.get('username') and password and password != '*':
+        fingerprints[('basic', values['username'])] = hashlib.sha256(password.encode('utf-8')).digest()
+    apikey = values.get('apikey')
+    if values.get('keyid') and apikey and values.get('status') == 'valid':
+        fingerprints[('bearer', values['keyid'])] = hashlib.sha256(apikey.encode('utf-8')).digest()
+    return fingerprints
+
+# A principal's fingerprint in hcli_core's parsed credentials ({section: [{name: value}, ...]})
+def credentials_fingerprint(credentials, scheme, principal):
+    for cred_list in (credentials or {}).values():
+        values = {k: v for cred in cred_list for k, v in cred.items()}
+        fingerprint = section_fingerprints(values).get((scheme, principal))
+        if fingerprint is not None:
+            return fingerprint
+    return None
+
+# What each principal's credential currently is, read from the hcli_core credentials file and re-read whenever the
+# file changes. A cached authentication is only honoured while the credential it was checked against is unchanged, so
+# changing a password (or revoking a key) invalidates it in every process right away.
+class CredentialFingerprints:
+
+    def __init__(self, path):
+        self.path = path
+        self._fingerprints = {}
+        self._file_state = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self._fingerprints = {}
+            self._file_state = None
+            return
+
+        file_state = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if file_state == self._file_state:
+            return
+
+        parser = ConfigParser(interpolation=None)
+        try:
+            parser.read(self.path)
+        except ConfigParserError as e:
+
+            # hcli_core rewrites the file in place, so we may have caught it half written; the next lookup retries
+            log.debug(f"Unable to read credentials {self.path}: {e}")
+            self._fingerprints = {}
+            self._file_state = None
+            return
+
+        fingerprints = {}
+        for section in parser.sections():
+            fingerprints.update(section_fingerprints(dict(parser.items(section))))
+
+        self._fingerprints = fingerprints
+        self._file_state = file_state
+
+    def get(self, scheme, principal):
+        with self._lock:
+            self._load()
+            return self._fingerprints.get((scheme, principal))
+
+# A bounded, time limited cache of successful authentications.
+# Entries are keyed by an HMAC of the Authorization header under a random per-process key, so the cache never holds
+# credentials and its keys are useless outside the process. Each entry remembers the principal and the fingerprint of
+# the credential it was verified against, and expires ttl seconds after the verification.
+class AuthCache:
+
+    def __init__(self, fingerprints, max_size=1024, ttl=300.0):
+        self.fingerprints = fingerprints
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._secret = os.urandom(32)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, header):
+        return hmac.new(self._secret, header.encode('utf-8'), hashlib.sha256).digest()
+
+    # The principal authenticated by a header, or None
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            scheme, principal, fingerprint, expires = entry
+            if time.monotonic() >= expires:
+                del self._entries[key]
+                self.misses += 1
+                return None
+
+        current = self.fingerprints.get(scheme, principal)
+        if current is None or not hmac.compare_digest(current, fingerprint):
+            with self._lock:
+                self._entries.pop(key, None)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return principal
+
+    # Caches an authentication along with the fingerprint of the credential it was verified against. Credentials
+    # without a fingerprint (remote hco credentials, the admin bootstrap password) are never cached.
+    def put(self, key, scheme, principal, fingerprint):
+        if self.max_size <= 0 or self.ttl <= 0 or fingerprint is None:
+            return
+
+        with self._lock:
+            self._entries[key] = (scheme, principal, fingerprint, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+# hcli_core's selective authentication with successful authentications served from an AuthCache, which saves the
+# password hash check (hundreds of milliseconds by design) on each of the round trips of a push or authenticated
+# fetch. The current user is set exactly as a full check would, so the owner checks of the resources are unchanged.
+# Failed attempts are never cached and go through (and are logged by) the full check.
+class CachingAuthenticationMiddleware(authenticator.SelectiveAuthenticationMiddleware):
+
+    def __init__(self, name, max_size=1024, ttl=300.0):
+        super().__init__(name)
+        self.cache = AuthCache(CredentialFingerprints(self.cm.credentials_file_path), max_size=max_size, ttl=ttl)
+
+    def is_authenticated(self, req, resp, client_ip):
+        header = req.get_header('Authorization')
+        if not header:
+            return super().is_authenticated(req, resp, client_ip)
+
+        key = self.cache.key(header)
+        principal = self.cache.get(key)
+        if principal is not None:
+            c.ServerContext.set_current_user(principal)
+            return True
+
+        # hcli_core may re-read its credentials during the check, so the principal's credential is looked up in its
+        # copy before and after; if it changed in between we can't tell which one was verified and don't cache
+        before = self.cm.credentials
+        authenticated = super().is_authenticated(req, resp, client_ip)
+        if authenticated:
+            scheme = header.split(' ', 1)[0].lower()
+            principal = c.ServerContext.get_current_user()
+            fingerprint = credentials_fingerprint(before, scheme, principal)
+            if fingerprint == credentials_fingerprint(self.cm.credentials, scheme, principal):
+                self.cache.put(key, scheme, principal, fingerprint)
+        return authenticated
@@ -0,0 +1,183 @@
+import os
+import time
+import stat
+import threading
+
+from collections import OrderedDict
+from threading import RLock
+
+from hcli_core import logger
+
+from dulwich.errors import NotGitRepository
+from dulwich.server import Backend
+from dulwich.repo import Repo
+
+log = logger.Logger("hag")
+
+
+# Splits a dulwich repository path (e.g. "/user/repo.git") into its user and repo segments.
+# Anything that isn't exactly /<user>/<repo>.git is rejected so that lookups can't escape the repos root.
+def parse_repo_path(path):
+    if isinstance(path, bytes):
+        path = os.fsdecode(path)
+
+    segments = [s for s in path.split('/') if s]
+    if len(segments) != 2:
+        raise NotGitRepository(f"Invalid repository path {path!r}")
+
+    user, repo = segments
+    for segment in segments:
+        if segment in ('.', '..') or segment.startswith('.') or os.sep in segment or '\0' in segment:
+            raise NotGitRepository(f"Invalid repository path {path!r}")
+
+    if not repo.endswith('.git'):
+        raise NotGitRepository(f"Invalid repository path {path!r}")
+
+    return user, repo
+
+# Tells a repository folder apart from one that was removed and created again at the same path, or None if there's no
+# folder
+def _dir_identity(repo_path):
+    try:
+        st = os.stat(repo_path)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino) if stat.S_ISDIR(st.st_mode) else None
+
+# A dulwich Backend that resolves /<user>/<repo>.git on the storage roots on demand.
+# Open repositories are kept in an LRU cache and are dropped when idle or when their directory disappears or is
+# replaced (which is also how a repository moved to another root, or removed and created again, is picked up).
+# dulwich reads pack files with a seek and a read on a shared file, so an open repository is only ever used by one
+# thread at a time: it's lent to the thread that opened it until release() at the end of that thread's git request
+# returns it to the cache, and a request that finds every open copy of a repository lent out opens another.
+# At most max_copies idle copies are kept per repository and max_size in all, least recently used repositories going
+# first. Copies that are dropped are closed, which releases their pack files and maps; a lent copy is closed when it's
+# given back instead.
+class RepoBackend(Backend):
+
+    def __init__(self, storage, max_size=128, idle_timeout=300, max_copies=4):
+        self.storage = storage
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_copies = max_copies
+        self.hits = 0
+        self.misses = 0
+        self._repos = OrderedDict()
+        self._idle = 0
+        self._lent = {}
+        self._lock = RLock()
+
+    def repo_path(self, path):
+        user, repo = parse_repo_path(path)
+        return self.storage.locate(user, repo)
+
+    def open_repository(self, path):
+        repo_path = self.repo_path(path)
+        now = time.monotonic()
+        dropped = []
+
+        try:
+            with self._lock:
+                self._evict_idle(now, dropped)
+                lent = self._lent.setdefault(threading.get_ident(), {})
+
+                if repo_path in lent:
+                    return lent[repo_path][0]
+
+                identity = _dir_identity(repo_path)
+                entry = self._repos.get(repo_path)
+                if entry is not None:
+                    if identity == entry[2]:
+                        self._repos[repo_path] = (entry[0], now, entry[2])
+                        self._repos.move_to_end(repo_path)
+                        if entry[0]:
+                            self.hits += 1
+                            self._idle -= 1
+                            lent[repo_path] = (entry[0].pop(), entry[0])
+                            return lent[repo_path][0]
+                    else:
+                        log.info(f"Repository {repo_path} disappeared or was replaced. Dropping it from the cache")
+                        self._drop(repo_path, dropped)
+
+                self.misses += 1
+        finally:
+            _close(dropped)
+
+        if identity is None:
+            raise NotGitRepository(f"No git repository was found at {path}")
+
+        # We open outside of the lock so that a slow disk doesn't stall lookups of other repositories
+        repo_obj = Repo(repo_path)
+
+        with self._lock:
+            entry = self._repos.get(repo_path)
+            idle = entry[0] if entry is not None and entry[2] == identity else []
+            self._repos[repo_path] = (idle, now, identity)
+            self._repos.move_to_end(repo_path)
+            lent[repo_path] = (repo_obj, idle)
+
+        return repo_obj
+
+    # Returns the repositories the current thread opened to the cache, once its git request is done with them.
+    # Repositories that were invalidated, evicted or replaced meanwhile, or that would go over the limits, are closed.
+    def release(self):
+        lent = self._lent.pop(threading.get_ident(), None)
+        if not lent:
+            return
+
+        dropped = []
+        with self._lock:
+            for repo_path, (repo_obj, idle) in lent.items():
+                entry = self._repos.get(repo_path)
+                if entry is not None and entry[0] is idle and len(idle) < max(self.max_copies, 0):
+                    idle.append(repo_obj)
+                    self._idle += 1
+                else:
+                    dropped.append(repo_obj)
+
+            # Over the limit, the least recently used repository gives up a copy
+            while self._idle > max(self.max_size, 0) and self._repos:
+                repo_path, (idle, last_used, identity) = next(iter(self._repos.items()))
+                if len(idle) > 1:
+                    dropped.append(idle.pop(0))
+                    self._idle -= 1
+                else:
+                    self._drop(repo_path, dropped)
+        _close(dropped)
+
+    # Removes a repository from the cache, collecting its idle copies in dropped to be closed
+    def _drop(self, repo_path, dropped):
+        entry = self._repos.pop(repo_path, None)
+        if entry is not None:
+            dropped.extend(entry[0])
+            self._idle -= len(entry[0])
+            entry[0].clear()
+
+    # Entries are ordered by last use so we only need to walk from the least recently used end.
+    def _evict_idle(self, now, dropped):
+        if not self.idle_timeout or self.idle_timeout <= 0:
+            return
+
+        while self._repos:
+            repo_path, (idle, last_used, identity) = next(iter(self._repos.items()))
+            if now - last_used < self.idle_timeout:
+                break
+            self._drop(repo_path, dropped)
+
+    def invalidate(self, path):
+        dropped = []
+        with self._lock:
+            self._drop(self.repo_path(path), dropped)
+        _close(dropped)
+
+    def __len__(self):
+        with self._lock:
+            return self._idle
+
+# Closes repositories that were dropped from the cache
+def _close(repos):
+    for repo_obj in repos:
+        try:
+            repo_obj.close()
+        except Exception as e:
+            log.warning(f"Unable to close repository {repo_obj.path}: {e}")
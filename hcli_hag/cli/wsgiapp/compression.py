@@ -0,0 +1,111 @@
+import zlib
+
+from hcli_hag.cli.wsgiapp import streaming
+
+
+# Whether an Accept-Encoding header allows a gzip-encoded response (explicitly or through *, with a non-zero q-value)
+def accepts_gzip(header):
+    if not header:
+        return False
+
+    accepted = {}
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.strip().lower()] = quality
+
+    for coding in ('gzip', 'x-gzip', '*'):
+        if coding in accepted:
+            return accepted[coding] > 0
+    return False
+
+# Gzip-compresses a response body as the WSGI server iterates over it. Each chunk of the source is deflated as it
+# comes, in steps of at most chunk_size, so neither the uncompressed nor the compressed body is held in full.
+class GzipStream:
+
+    def __init__(self, source, level=6, chunk_size=65536):
+        self._source = source
+        self._level = level
+        self._chunk_size = chunk_size
+        self.uncompressed = 0
+
+    def _compress(self, compressor, data):
+        self.uncompressed += len(data)
+        view = memoryview(data)
+        for i in range(0, len(view), self._chunk_size):
+            compressed = compressor.compress(view[i:i + self._chunk_size])
+            if compressed:
+                yield compressed
+
+    def __iter__(self):
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for data in self._source:
+            yield from self._compress(compressor, data)
+        yield compressor.flush()
+
+    async def __aiter__(self):
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        async for data in streaming.aiterate(self._source):
+            for compressed in self._compress(compressor, data):
+                yield compressed
+        yield compressor.flush()
+
+    def close(self):
+        close = getattr(self._source, 'close', None)
+        if close is not None:
+            close()
+
+# Compresses ref advertisements and other small non-pack responses for clients that send Accept-Encoding: gzip.
+# Packs are already zlib-compressed and are left alone, as are file responses, which the WSGI server sends with
+# wsgi.file_wrapper. Resources can ask for a response to be compressed with req.context.compress_response.
+class GzipCompressionMiddleware:
+
+    def __init__(self, level=6, min_size=1024, chunk_size=65536):
+        self.level = level
+        self.min_size = min_size
+        self.chunk_size = chunk_size
+
+    def compressible(self, req, resp):
+        if req.method == 'HEAD' or resp.status_code != 200 or resp.get_header('Content-Encoding'):
+            return False
+
+        if not getattr(req.context, 'compress_response', False):
+            content_type = (resp.content_type or '').split(';')[0].strip()
+            if not (content_type == 'text/plain' or
+                    (content_type.startswith('application/x-git-') and content_type.endswith('-advertisement'))):
+                return False
+
+        return accepts_gzip(req.get_header('Accept-Encoding'))
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if not req_succeeded or not self.compressible(req, resp):
+            return
+
+        if resp.stream is not None:
+            if hasattr(resp.stream, 'read'):
+                return
+            source = resp.stream
+        else:
+            data = resp.render_body()
+            if data is None or len(data) < self.min_size:
+                return
+            source = [data]
+            resp.data = None
+            resp.text = None
+
+        resp.stream = GzipStream(source, self.level, self.chunk_size)
+        resp.delete_header('Content-Length')
+        resp.set_header('Content-Encoding', 'gzip')
+        resp.append_header('Vary', 'Accept-Encoding')
+
+        # The compressed body is a different representation, so a strong validator can't be shared with it
+        etag = resp.get_header('ETag')
+        if etag is not None and not etag.startswith('W/'):
+            resp.set_header('ETag', 'W/' + etag)
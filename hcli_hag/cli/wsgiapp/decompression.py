@@ -0,0 +1,84 @@
+import time
+import zlib
+
+from hcli_problem_details import *
+
+
+# A read-only file-like object that inflates a gzip-compressed stream on demand.
+# Only as much of the compressed body as the reader asks for is pulled from the source, so
+# neither the compressed nor the decompressed body is ever fully held in memory.
+class GzipInputStream:
+
+    def __init__(self, source, max_size=0, chunk_size=65536):
+        self._source = source
+        self._max_size = max_size
+        self._chunk_size = chunk_size
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._buffer = bytearray()
+        self._eof = False
+        self.decompressed = 0
+        self.elapsed = 0.0
+
+    def _fill(self, size):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            compressed = self._decompressor.unconsumed_tail
+            if not compressed:
+                compressed = self._source.read(self._chunk_size)
+                if not compressed:
+                    self._finish()
+                    break
+
+            # We bound each inflate step so that a small compressed chunk can't balloon in memory
+            want = self._chunk_size if size < 0 else max(size - len(self._buffer), 1)
+            start = time.perf_counter()
+            try:
+                data = self._decompressor.decompress(compressed, want)
+            except zlib.error as e:
+                raise BadRequestError(detail=f"The gzip-compressed request body could not be decompressed: {e}")
+            finally:
+                self.elapsed += time.perf_counter() - start
+
+            self._append(data)
+
+            if self._decompressor.eof:
+                self._finish()
+
+    def _finish(self):
+        if not self._eof:
+            if not self._decompressor.eof:
+                raise BadRequestError(detail="The gzip-compressed request body is truncated.")
+            self._eof = True
+
+    def _append(self, data):
+        self.decompressed += len(data)
+        if self._max_size and self.decompressed > self._max_size:
+            raise PayloadTooLargeError(detail=f"The decompressed request body exceeds the {self._max_size} byte limit.")
+        self._buffer.extend(data)
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        self._fill(size)
+        if size < 0 or size >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        return data
+
+    def readline(self, size=-1):
+        while b'\n' not in self._buffer and not self._eof:
+            if 0 <= size <= len(self._buffer):
+                break
+            self._fill(len(self._buffer) + self._chunk_size)
+        end = self._buffer.find(b'\n')
+        end = len(self._buffer) if end < 0 else end + 1
+        if 0 <= size < end:
+            end = size
+        data = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return data
+
+    def close(self):
+        self._buffer.clear()
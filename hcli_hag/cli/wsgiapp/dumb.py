@@ -0,0 +1,163 @@
+import os
+import re
+import binascii
+
+import falcon
+
+from hcli_problem_details import *
+
+PACK_NAME = re.compile(r'^pack-([0-9a-f]{40}|[0-9a-f]{64})\.(pack|idx)$')
+LOOSE_DIR = re.compile(r'^[0-9a-f]{2}$')
+LOOSE_NAME = re.compile(r'^([0-9a-f]{38}|[0-9a-f]{62})$')
+
+PACK_CONTENT_TYPES = {
+    'pack': 'application/x-git-packed-objects',
+    'idx': 'application/x-git-packed-objects-toc',
+}
+LOOSE_CONTENT_TYPE = 'application/x-git-loose-object'
+
+# Pack, idx and loose object files never change once written, so clients and proxies may keep them.
+# This mirrors git http-backend.
+CACHE_FOREVER = 'public, max-age=31536000, immutable'
+NO_CACHE = 'no-cache, max-age=0, must-revalidate'
+
+
+# Reads the checksum trailer of a pack or idx file. A pack ends with the hash of its contents and an idx ends
+# with its own hash, so the trailer identifies the exact bytes and makes a strong ETag.
+def trailer_checksum(f, size, length):
+    if size < length:
+        return None
+    return binascii.hexlify(os.pread(f.fileno(), length, size - length)).decode('ascii')
+
+# Parses a single "bytes=first-last" range against a resource of the given size into (start, length).
+# Returns None when the header should be ignored (absent, another unit or several ranges), in which case the
+# full representation is served as RFC 9110 allows. Raises ValueError when the range can't be satisfied.
+def parse_range(value, size):
+    if not value:
+        return None
+
+    unit, sep, spec = value.partition('=')
+    if not sep or unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    first, sep, last = spec.strip().partition('-')
+    try:
+        start = int(first) if first else None
+        end = int(last) if last else None
+    except ValueError:
+        return None
+
+    if not sep or (start is None and end is None) or (start is not None and start < 0):
+        return None
+    if start is not None and end is not None and end < start:
+        return None
+
+    # A suffix range ("bytes=-500") asks for the last bytes of the file
+    if start is None:
+        if end <= 0:
+            raise ValueError("the suffix range is empty")
+        start = max(size - end, 0)
+        end = size - 1
+
+    if start >= size:
+        raise ValueError(f"the range starts past the end of the {size} byte file")
+
+    if end is None:
+        end = size - 1
+    end = min(end, size - 1)
+    return start, end - start + 1
+
+# A read-only window onto an open file. It keeps fileno() so that servers whose wsgi.file_wrapper uses sendfile
+# (e.g. gunicorn) can still send it without copying through Python: they start at the current offset and send
+# Content-Length bytes. Other servers fall back to read(), which stops at the end of the window.
+class FileRange:
+
+    def __init__(self, f, start, length):
+        self._file = f
+        self._remaining = length
+        f.seek(start)
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self._remaining:
+            size = self._remaining
+        if size <= 0:
+            return b''
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        self._file.close()
+
+# Answers a GET or HEAD for a static repository file, with conditional (ETag) and Range support.
+# The body is handed to the server as a file object so that it goes through wsgi.file_wrapper.
+def serve_file(req, resp, f, content_type, etag=None, cache_control=NO_CACHE):
+    size = os.fstat(f.fileno()).st_size
+
+    resp.content_type = content_type
+    resp.accept_ranges = 'bytes'
+    if etag is not None:
+        resp.etag = etag
+
+        if req.if_none_match and ('*' in req.if_none_match or etag in req.if_none_match):
+            f.close()
+            resp.cache_control = [cache_control]
+            resp.status = falcon.HTTP_304
+            return
+
+    start, length = 0, size
+
+    # If-Range asks for the range only if the client's copy is still current; otherwise the whole file is sent
+    if_range = req.get_header('If-Range')
+    if if_range is None or (etag is not None and if_range.strip() == f'"{etag}"'):
+        try:
+            requested = parse_range(req.get_header('Range'), size)
+        except ValueError as e:
+            f.close()
+            resp.set_header('Content-Range', f'bytes */{size}')
+            raise RangeNotSatisfiableError(detail=str(e), instance=req.path)
+
+        if requested is not None:
+            start, length = requested
+            resp.status = falcon.HTTP_206
+            resp.set_header('Content-Range', f'bytes {start}-{start + length - 1}/{size}')
+
+    resp.cache_control = [cache_control]
+    resp.content_length = length
+    if req.method == 'HEAD':
+        f.close()
+        return
+
+    resp.stream = FileRange(f, start, length)
+
+# Opens a file for reading, mapping a missing file (or one that isn't a regular file) to a 404.
+def open_file(req, path):
+    try:
+        f = open(path, 'rb')
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        raise NotFoundError(detail=f"{req.path} was not found.", instance=req.path)
+
+    if not os.path.isfile(path):
+        f.close()
+        raise NotFoundError(detail=f"{req.path} was not found.", instance=req.path)
+
+    return f
+
+# Builds objects/info/packs from the packs that are complete (have their idx) so that it never goes stale.
+def info_packs(repo_path):
+    pack_dir = os.path.join(repo_path, 'objects', 'pack')
+    try:
+        names = os.listdir(pack_dir)
+    except FileNotFoundError:
+        names = []
+
+    lines = []
+    for name in sorted(names):
+        match = PACK_NAME.match(name)
+        if match and match.group(2) == 'pack' and name[:-5] + '.idx' in names:
+            lines.append(f"P {name}\n")
+    lines.append("\n")
+    return ''.join(lines).encode('ascii')
@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import heapq
+import importlib
+import threading
+import subprocess
+
+from collections import deque
+
+from hcli_core import logger
+
+from dulwich.server import ReceivePackHandler
+
+log = logger.Logger("hag")
+
+
+# A receive-pack handler that reports the ref updates a push applied through on_receive(user, repo, repo_path, updates),
+# with updates as (old, new, ref) tuples of str. Only refs that were written successfully are reported.
+# It's bound to a callback with functools.partial before being handed to HTTPGitApplication.
+class NotifyingReceivePackHandler(ReceivePackHandler):
+
+    def __init__(self, backend, args, proto, stateless_rpc=False, advertise_refs=False, on_receive=None):
+        super().__init__(backend, args, proto, stateless_rpc=stateless_rpc, advertise_refs=advertise_refs)
+        self.repo_path = backend.repo_path(args[0])
+        self.on_receive = on_receive
+        self._written = set()
+
+    def _apply_pack(self, refs):
+        for name, status in super()._apply_pack(refs):
+            if name != b'unpack' and status == b'ok':
+                self._written.add(name)
+            yield name, status
+
+    def _on_post_receive(self, client_refs):
+        super()._on_post_receive(client_refs)
+
+        updates = [(old.decode('ascii'), new.decode('ascii'), ref.decode('utf-8'))
+                   for old, new, ref in client_refs if ref in self._written]
+        if updates and self.on_receive is not None:
+            user = os.path.basename(os.path.dirname(self.repo_path))
+            repo = os.path.basename(self.repo_path)
+            try:
+                self.on_receive(user, repo, self.repo_path, updates)
+            except Exception as e:
+                log.error(f"Unable to queue post-receive event for {user}/{repo}: {e}")
+
+# Runs an executable the way git runs a post-receive hook: one "old new ref" line per update on stdin, from the
+# repository folder with GIT_DIR set. A non-zero exit status counts as a failure and is retried.
+class ScriptHook:
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.name = path
+        self.timeout = timeout
+
+    def __call__(self, event):
+        stdin = ''.join(f"{u['old']} {u['new']} {u['ref']}\n" for u in event['updates'])
+        env = dict(os.environ,
+                   GIT_DIR=event['repo_path'],
+                   HAG_USER=event['user'],
+                   HAG_REPO=event['repo'],
+                   HAG_EVENT_ID=event['id'])
+
+        result = subprocess.run([self.path], input=stdin, cwd=event['repo_path'], env=env, capture_output=True,
+                                text=True, timeout=self.timeout)
+        if result.returncode != 0:
+            raise RuntimeError(f"exited with status {result.returncode}: {result.stderr.strip()[-500:]}")
+
+# Wraps a Python callable. It's called with the event dict (id, user, repo, repo_path, created, attempts and updates,
+# a list of {ref, old, new}) and fails by raising.
+class CallableHook:
+
+    def __init__(self, fn, name=None):
+        self.fn = fn
+        self.name = name or f"{fn.__module__}.{getattr(fn, '__qualname__', repr(fn))}"
+
+    def __call__(self, event):
+        self.fn(event)
+
+# Builds the configured hooks: executables by path and Python callables as "module:attribute".
+def load_hooks(scripts, callables, timeout=60.0):
+    hooks = [ScriptHook(path, timeout) for path in scripts]
+    for spec in callables:
+        module_name, sep, attribute = spec.partition(':')
+        if not sep:
+            raise ValueError(f"Invalid hook {spec!r}, expected module:attribute")
+        fn = importlib.import_module(module_name)
+        for part in attribute.split('.'):
+            fn = getattr(fn, part)
+        hooks.append(CallableHook(fn, spec))
+    return hooks
+
+# Asynchronous post-receive hook delivery.
+# A push's ref updates are written to an event file in the spool folder before submit() returns, so the push never
+# waits on hooks and events survive restarts; spooled events are picked up again on startup. Events are delivered
+# by a pool of worker threads from a bounded in-memory queue. When the queue is full new events stay in the spool
+# and are loaded once it drains. A hook that fails is retried with exponential backoff (hooks that already succeeded
+# for the event are not run again) and after the last retry the event is moved to spool/failed.
+# Delivery is at least once. Event files are locked while they are delivered, so several server processes can
+# share a spool folder without delivering the same event concurrently.
+class HookPipeline:
+
+    def __init__(self, spool_dir, hooks=(), workers=2, max_queue=1000, retries=5, backoff=1.0, max_backoff=300.0):
+        self.spool_dir = spool_dir
+        self.failed_dir = os.path.join(spool_dir, 'failed')
+        self.hooks = list(hooks)
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+        self._ready = deque()
+        self._delayed = []
+        self._known = set()
+        self._overflow = False
+        self._cond = threading.Condition()
+        self._threads = []
+
+        os.makedirs(self.failed_dir, exist_ok=True)
+
+    def register(self, hook):
+        if not hasattr(hook, 'name'):
+            hook = CallableHook(hook)
+        self.hooks.append(hook)
+
+    @property
+    def queued(self):
+        with self._cond:
+            return len(self._ready) + len(self._delayed)
+
+    # Loads events left in the spool by an earlier run and starts the workers
+    def start(self):
+        with self._cond:
+            self._overflow = True
+            self._refill()
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name=f"hag-hooks-{len(self._threads)}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def submit(self, user, repo, repo_path, updates):
+        event_id = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+        event = {
+            'id': event_id,
+            'user': user,
+            'repo': repo,
+            'repo_path': repo_path,
+            'created': time.time(),
+            'attempts': 0,
+            'done': [],
+            'updates': [{'ref': ref, 'old': old, 'new': new} for old, new, ref in updates],
+        }
+
+        name = event_id + '.json'
+        tmp = os.path.join(self.spool_dir, '.' + name)
+        with open(tmp, 'w') as f:
+            json.dump(event, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.spool_dir, name))
+
+        with self._cond:
+            if len(self._ready) + len(self._delayed) >= self.max_queue:
+                if not self._overflow:
+                    log.warning(f"Post-receive queue is full ({self.max_queue}), leaving events in {self.spool_dir}")
+                self._overflow = True
+            else:
+                self._known.add(name)
+                self._ready.append(name)
+                self._cond.notify()
+
+        return event_id
+
+    # Queues spooled events that aren't already known to this process, oldest first, while there's room.
+    # Called with the condition held.
+    def _refill(self):
+        try:
+            names = sorted(n for n in os.listdir(self.spool_dir) if n.endswith('.json') and not n.startswith('.'))
+        except FileNotFoundError:
+            names = []
+
+        for name in names:
+            if name in self._known:
+                continue
+            if len(self._ready) + len(self._delayed) >= self.max_queue:
+                return
+            self._known.add(name)
+            self._ready.append(name)
+
+        self._overflow = False
+
+    def _next(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    self._ready.append(heapq.heappop(self._delayed)[1])
+
+                if not self._ready and self._overflow:
+                    self._refill()
+                if self._ready:
+                    return self._ready.popleft()
+
+                self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+
+    def _retry_later(self, name, delay):
+        with self._cond:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, name))
+            self._cond.notify()
+
+    def _forget(self, name):
+        with self._cond:
+            self._known.discard(name)
+
+    def _work(self):
+        while True:
+            name = self._next()
+            try:
+                delay = self._deliver(name)
+            except Exception as e:
+                log.error(f"Unable to deliver post-receive event {name}: {e}")
+                delay = None
+
+            if delay is None:
+                self._forget(name)
+            else:
+                self._retry_later(name, delay)
+
+    # Runs the hooks that haven't succeeded yet for an event. Returns the delay before the next attempt, or None
+    # once the event is done with (delivered, failed for good, or taken by another process).
+    def _deliver(self, name):
+        path = os.path.join(self.spool_dir, name)
+        try:
+            f = open(path, 'r+')
+        except FileNotFoundError:
+            return None
+
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+
+            # Another process may have delivered and removed the event between our open() and flock()
+            try:
+                if os.stat(path).st_ino != os.fstat(f.fileno()).st_ino:
+                    return None
+            except FileNotFoundError:
+                return None
+
+            try:
+                event = json.load(f)
+            except ValueError as e:
+                log.error(f"Corrupt post-receive event {name}: {e}")
+                os.replace(path, os.path.join(self.failed_dir, name))
+                return None
+
+            errors = []
+            for hook in self.hooks:
+                if hook.name in event['done']:
+                    continue
+                try:
+                    hook(dict(event))
+                    event['done'].append(hook.name)
+                except Exception as e:
+                    errors.append(f"{hook.name}: {e}")
+
+            if not errors:
+                os.unlink(path)
+                with self._cond:
+                    self.delivered += 1
+                return None
+
+            event['attempts'] += 1
+            event['errors'] = errors
+            f.seek(0)
+            f.truncate()
+            json.dump(event, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+            if event['attempts'] > self.retries:
+                log.error(f"Giving up on post-receive event {name} for {event['user']}/{event['repo']} "
+                          f"after {event['attempts']} attempts: {'; '.join(errors)}")
+                os.replace(path, os.path.join(self.failed_dir, name))
+                with self._cond:
+                    self.failed += 1
+                return None
+
+            delay = min(self.backoff * 2 ** (event['attempts'] - 1), self.max_backoff)
+            log.warning(f"Post-receive event {name} for {event['user']}/{event['repo']} failed "
+                        f"(attempt {event['attempts']}), retrying in {delay:.1f}s: {'; '.join(errors)}")
+            with self._cond:
+                self.retried += 1
+            return delay
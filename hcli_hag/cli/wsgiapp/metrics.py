@@ -0,0 +1,349 @@
+import math
+import time
+import bisect
+import threading
+
+from collections import OrderedDict
+
+from hcli_hag.cli.wsgiapp import streaming
+
+# Latency buckets in seconds, from fast ref advertisements up to multi-minute clones
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+# Size buckets in bytes, from a small incremental fetch (1 KiB) up to a full clone of a very large repository (16 GiB)
+BYTE_BUCKETS = tuple(1024 * 4 ** i for i in range(13))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if math.isnan(value):
+            return 'NaN'
+        return repr(value)
+    return str(value)
+
+def _format_sample(name, labelnames, labelvalues, value):
+    if labelnames:
+        labels = ','.join(f'{n}="{_escape(v)}"' for n, v in zip(labelnames, labelvalues))
+        return f"{name}{{{labels}}} {_format_value(value)}"
+    return f"{name} {_format_value(value)}"
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {_escape(self.documentation)}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return lines
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield _format_sample(self.name, self.labelnames, key, value)
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items())
+
+        labelnames = self.labelnames + ('le',)
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield _format_sample(self.name + '_bucket', labelnames, key + (_format_value(float(bound)),), cumulative)
+            yield _format_sample(self.name + '_bucket', labelnames, key + ('+Inf',), count)
+            yield _format_sample(self.name + '_sum', self.labelnames, key, total)
+            yield _format_sample(self.name + '_count', self.labelnames, key, count)
+
+# A metric whose samples are read from live objects (e.g. cache counters) at scrape time.
+# The callback returns an iterable of (label values, value) pairs.
+class CallbackMetric(_Metric):
+
+    def __init__(self, name, documentation, type, labelnames, callback):
+        super().__init__(name, documentation, labelnames)
+        self.type = type
+        self.callback = callback
+
+    def samples(self):
+        for key, value in self.callback():
+            yield _format_sample(self.name, self.labelnames, tuple(str(v) for v in key), value)
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None and not isinstance(metric, CallbackMetric):
+                return existing
+
+            # Callbacks are replaced so that a new app instance reports its own caches
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, type, labelnames, callback):
+        return self.register(CallbackMetric(name, documentation, type, labelnames, callback))
+
+    # Renders every metric in the Prometheus text exposition format.
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+registry = Registry()
+
+requests_total = registry.counter('hag_http_requests_total',
+                                  'HTTP requests handled, by endpoint, method and status code.',
+                                  ('endpoint', 'method', 'status'))
+request_duration = registry.histogram('hag_http_request_duration_seconds',
+                                      'Time from receiving a request until its response was fully sent.',
+                                      ('endpoint',))
+repo_requests_total = registry.counter('hag_repo_requests_total',
+                                       'Git requests handled, by endpoint and repository.',
+                                       ('endpoint', 'repo'))
+repo_request_duration = registry.histogram('hag_repo_request_duration_seconds',
+                                           'Git request latency by endpoint and repository.',
+                                           ('endpoint', 'repo'))
+requests_in_flight = registry.gauge('hag_http_requests_in_flight',
+                                    'Requests currently being handled, including responses still being sent.')
+request_bytes = registry.counter('hag_http_request_bytes_total',
+                                 'Request body bytes received on the wire, by endpoint.',
+                                 ('endpoint',))
+response_bytes = registry.counter('hag_http_response_bytes_total',
+                                  'Response body bytes sent, by endpoint.',
+                                  ('endpoint',))
+pack_generation = registry.histogram('hag_git_generation_seconds',
+                                     'Time dulwich spent producing a git service response.',
+                                     ('service',))
+transfer_duration = registry.histogram('hag_http_transfer_seconds',
+                                       'Time spent sending a response body after the handler returned.',
+                                       ('endpoint',))
+decompression_duration = registry.histogram('hag_gzip_decompression_seconds',
+                                            'Time spent inflating gzip-compressed request bodies.')
+decompressed_bytes = registry.counter('hag_gzip_decompressed_bytes_total',
+                                      'Bytes produced by inflating gzip-compressed request bodies.')
+upload_pack_bytes = registry.histogram('hag_upload_pack_bytes',
+                                       'Bytes sent per git-upload-pack request, by kind (clone or fetch) and shape '
+                                       '(full, shallow, filtered or shallow+filtered).',
+                                       ('kind', 'shape'), buckets=BYTE_BUCKETS)
+receive_rejected = registry.counter('hag_receive_rejected_total',
+                                    'Pushes aborted while their pack was read, by the limit they broke (pack_size, '
+                                    'blob_size or quota).',
+                                    ('reason',))
+
+# Counts the raw request body bytes as they are read, before any decompression.
+class CountingInput:
+
+    def __init__(self, stream):
+        self._stream = stream
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.count += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self._stream.readline(size)
+        self.count += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+# Counts the response bytes handed to the WSGI server and reports once the server closes the response.
+class MeteredStream:
+
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+        self.count = 0
+
+    def __iter__(self):
+        for chunk in self._stream:
+            self.count += len(chunk)
+            yield chunk
+
+    async def __aiter__(self):
+        async for chunk in streaming.aiterate(self._stream):
+            self.count += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self._stream, 'close'):
+                self._stream.close()
+        finally:
+            self._on_close(self.count)
+
+# Records request counts, latency, bytes in/out and decompression time for every request.
+# Repository labels are capped at max_repos distinct values; later repos are reported as "other".
+class MetricsMiddleware:
+
+    def __init__(self, max_repos=1000):
+        self.max_repos = max_repos
+        self._repos = set()
+        self._lock = threading.Lock()
+
+    def _repo_label(self, user, repo):
+        label = f"{user}/{repo}"
+        with self._lock:
+            if label in self._repos:
+                return label
+            if len(self._repos) < self.max_repos:
+                self._repos.add(label)
+                return label
+        return 'other'
+
+    def process_request(self, req, resp):
+        req.context.metrics_start = time.perf_counter()
+        req.context.metrics_endpoint = 'other'
+        req.context.metrics_repo = None
+        req.context.metrics_input = None
+        requests_in_flight.inc()
+
+        if req.content_length or req.get_header('Transfer-Encoding') or req.env.get('wsgi.input_terminated'):
+            counting = CountingInput(req.stream)
+            req.stream = counting
+            req.env['wsgi.input'] = counting
+            req.context.metrics_input = counting
+
+    def process_resource(self, req, resp, resource, params):
+        req.context.metrics_endpoint = getattr(resource, 'endpoint', 'other')
+        if resource is not None and 'user' in params and 'repo' in params:
+            req.context.metrics_repo = self._repo_label(params['user'], params['repo'])
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if getattr(req.context, 'metrics_start', None) is None:
+            return
+
+        handled = time.perf_counter()
+
+        # Streamed bodies are sent after we return, so the request is only accounted for once they are closed
+        if resp.stream is not None and not hasattr(resp.stream, 'read'):
+            resp.stream = MeteredStream(resp.stream, lambda count: self._finish(req, resp, handled, count))
+            return
+
+        if resp.stream is not None:
+            sent = int(resp.content_length or 0)
+        elif resp.data is not None:
+            sent = len(resp.data)
+        elif resp.text is not None:
+            sent = len(resp.text.encode('utf-8'))
+        else:
+            sent = 0
+        self._finish(req, resp, handled, sent)
+
+    def _finish(self, req, resp, handled, sent):
+        now = time.perf_counter()
+        endpoint = req.context.metrics_endpoint
+        elapsed = now - req.context.metrics_start
+
+        requests_in_flight.dec()
+        requests_total.inc(endpoint=endpoint, method=req.method, status=resp.status_code)
+        request_duration.observe(elapsed, endpoint=endpoint)
+        transfer_duration.observe(now - handled, endpoint=endpoint)
+        response_bytes.inc(sent, endpoint=endpoint)
+
+        if req.context.metrics_input is not None:
+            request_bytes.inc(req.context.metrics_input.count, endpoint=endpoint)
+
+        if req.context.metrics_repo is not None:
+            repo_requests_total.inc(endpoint=endpoint, repo=req.context.metrics_repo)
+            repo_request_duration.observe(elapsed, endpoint=endpoint, repo=req.context.metrics_repo)
+
+        fetch = getattr(req.context, 'fetch_request', None)
+        if fetch is not None and resp.status_code == 200:
+            upload_pack_bytes.observe(sent, kind=fetch.kind, shape=fetch.shape)
+
+        gzip_input = getattr(req.context, 'gzip_input', None)
+        if gzip_input is not None:
+            decompression_duration.observe(gzip_input.elapsed)
+            decompressed_bytes.inc(gzip_input.decompressed)
+
+class MetricsResource:
+    endpoint = 'metrics'
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def on_get(self, req, resp):
+        resp.content_type = CONTENT_TYPE
+        resp.data = self.registry.render()
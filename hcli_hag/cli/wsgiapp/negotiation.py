@@ -0,0 +1,84 @@
+# What an upload-pack request asks for, collected from its pkt-lines as dulwich reads them: how many wants and haves
+# it sends and whether it's shallow (deepen, deepen-since, deepen-not or existing shallow commits) or filtered
+# (partial clone). Works for protocol v0/v1 and v2 fetch requests since they share these argument lines.
+class FetchRequest:
+
+    def __init__(self):
+        self.wants = 0
+        self.haves = 0
+        self.shallow = 0
+        self.deepen = None
+        self.filter = None
+        self._buffer = bytearray()
+        self._broken = False
+
+    # A clone starts from nothing; a fetch tells the server what the client has (or where its history is cut)
+    @property
+    def kind(self):
+        return 'fetch' if self.haves or self.shallow else 'clone'
+
+    @property
+    def shape(self):
+        shallow = self.deepen is not None or self.shallow > 0
+        if shallow and self.filter is not None:
+            return 'shallow+filtered'
+        if shallow:
+            return 'shallow'
+        if self.filter is not None:
+            return 'filtered'
+        return 'full'
+
+    def feed(self, data):
+        if self._broken or not data:
+            return
+
+        buffer = self._buffer
+        buffer += data
+        i = 0
+        while len(buffer) - i >= 4:
+            try:
+                length = int(buffer[i:i + 4], 16)
+            except ValueError:
+                self._broken = True
+                break
+
+            # flush, delim and response-end packets carry no payload
+            if length < 4:
+                i += 4
+                continue
+            if len(buffer) - i < length:
+                break
+
+            self._line(bytes(buffer[i + 4:i + length]).rstrip(b'\n'))
+            i += length
+
+        del buffer[:i]
+
+    def _line(self, line):
+        if line.startswith(b'want '):
+            self.wants += 1
+        elif line.startswith(b'have '):
+            self.haves += 1
+        elif line.startswith(b'shallow '):
+            self.shallow += 1
+        elif line.startswith(b'deepen'):
+            self.deepen = line.decode('utf-8', 'replace')
+        elif line.startswith(b'filter '):
+            self.filter = line[7:].decode('utf-8', 'replace')
+
+# Passes the request body through to dulwich while feeding it to a FetchRequest
+class SniffingInput:
+
+    def __init__(self, stream, request):
+        self._stream = stream
+        self.request = request
+
+    def read(self, size=-1):
+        data = self._stream.read(size)
+        self.request.feed(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self._stream.readline(size)
+        self.request.feed(data)
+        return data
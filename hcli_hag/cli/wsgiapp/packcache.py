@@ -0,0 +1,422 @@
+import os
+import io
+import shutil
+import asyncio
+import hashlib
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+from hcli_core import logger
+
+from dulwich.errors import GitProtocolError
+from dulwich.protocol import Protocol
+
+from hcli_hag.cli.wsgiapp import streaming
+from hcli_hag.cli.wsgiapp import protocolv2
+
+log = logger.Logger("hag")
+
+
+# Reads the upload-pack request body, up to limit bytes, so that it can be inspected and then replayed to dulwich.
+# Returns the bytes read and whether the whole body fit within the limit.
+def read_request_body(environ, limit):
+    stream = environ['wsgi.input']
+    length = environ.get('CONTENT_LENGTH')
+    remaining = int(length) if length else None
+
+    chunks = []
+    total = 0
+    while total <= limit:
+        size = limit + 1 - total
+        if remaining is not None:
+            size = min(size, remaining - total)
+            if size <= 0:
+                break
+        chunk = stream.read(min(size, 65536))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        total += len(chunk)
+
+    return b''.join(chunks), total <= limit
+
+# Replays an already consumed prefix of the request body before handing reads back to the original stream.
+class ReplayInput:
+
+    def __init__(self, prefix, stream=None):
+        self._prefix = io.BytesIO(prefix)
+        self._stream = stream
+
+    def read(self, size=-1):
+        data = self._prefix.read(size)
+        if self._stream is None or (size is not None and 0 <= size <= len(data)):
+            return data
+        if size is None or size < 0:
+            return data + self._stream.read()
+        return data + self._stream.read(size - len(data))
+
+    def readline(self, size=-1):
+        data = self._prefix.readline(size)
+        if self._stream is None or data.endswith(b'\n') or (size is not None and 0 <= size <= len(data)):
+            return data
+        if size is None or size < 0:
+            return data + self._stream.readline()
+        return data + self._stream.readline(size - len(data))
+
+def pkt_lines(data):
+    i = 0
+    while i + 4 <= len(data):
+        length = int(data[i:i + 4], 16)
+        if length == 0:
+            yield None
+            i += 4
+            continue
+        if length < 4 or i + length > len(data):
+            raise ValueError("malformed pkt-line")
+        yield data[i + 4:i + length]
+        i += length
+
+# Builds the cache key of a complete (done) protocol v0/v1 upload-pack request from its sorted wants and haves,
+# the capabilities and any shallow/deepen/filter lines. Returns None for requests that can't be cached.
+# version keeps the responses of the protocol versions apart, as the same request is answered differently in each.
+def request_key(repo_path, body, version=b'0'):
+    wants = set()
+    haves = set()
+    others = set()
+    capabilities = b''
+    done = False
+
+    try:
+        for line in pkt_lines(body):
+            if line is None:
+                continue
+            line = line.rstrip(b'\n')
+            if line.startswith(b'want '):
+                parts = line.split(b' ', 2)
+                wants.add(parts[1])
+                if len(parts) > 2:
+                    capabilities = b' '.join(sorted(parts[2].split()))
+            elif line.startswith(b'have '):
+                haves.add(line[5:])
+            elif line == b'done':
+                done = True
+            elif line.startswith(b'command='):
+                return v2_request_key(repo_path, body)
+            else:
+                others.add(line)
+    except ValueError:
+        return None
+
+    if not done or not wants:
+        return None
+
+    digest = hashlib.sha256()
+    digest.update(os.fsencode(repo_path) + b'\0')
+    digest.update(b'version\0' + version + b'\0')
+    for name, values in ((b'want', wants), (b'have', haves), (b'other', others)):
+        digest.update(name + b'\0' + b'\n'.join(sorted(values)) + b'\0')
+    digest.update(b'caps\0' + capabilities)
+    return digest.hexdigest()
+
+# Keys a protocol v2 fetch on the v0 request it is translated into. Other v2 commands aren't cached.
+def v2_request_key(repo_path, body):
+    try:
+        command, capabilities, args = protocolv2.read_command(Protocol(io.BytesIO(body).read, None))
+        if command != b'fetch':
+            return None
+        translated, done = protocolv2.fetch_request(args)
+    except (GitProtocolError, ValueError):
+        return None
+    return request_key(repo_path, translated, version=b'2')
+
+# On disk cache of generated upload-pack responses with a size budget and LRU eviction.
+# Files live under <root>/<repo digest>/<request key>.pack so that a push can drop a repo's entries at once.
+class PackCache:
+
+    def __init__(self, root, max_size=1073741824):
+        self.root = root
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._index = OrderedDict()
+        self._size = 0
+        self._inflight = {}
+        self._lock = threading.RLock()
+
+        os.makedirs(self.root, exist_ok=True)
+        self._load()
+
+    # We rebuild the LRU order from file mtimes, which are bumped on every hit, and clean up abandoned writes.
+    def _load(self):
+        entries = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if filename.endswith('.tmp'):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                elif filename.endswith('.pack'):
+                    try:
+                        st = os.stat(path)
+                        entries.append((st.st_mtime, path, st.st_size))
+                    except OSError:
+                        pass
+
+        for mtime, path, size in sorted(entries):
+            self._index[path] = size
+            self._size += size
+        self._evict()
+
+    def _repo_dir(self, repo_path):
+        return os.path.join(self.root, hashlib.sha1(os.fsencode(repo_path)).hexdigest())
+
+    def path(self, repo_path, key):
+        return os.path.join(self._repo_dir(repo_path), key + '.pack')
+
+    # Returns an open file for a cached response, or None if it isn't cached.
+    def open(self, repo_path, key):
+        path = self.path(repo_path, key)
+        with self._lock:
+            if path not in self._index:
+                return None
+            self._index.move_to_end(path)
+
+        try:
+            f = open(path, 'rb')
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._forget(path)
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return f
+
+    # Returns a PackReader of the response being generated for key. Identical requests are coalesced: the first one
+    # starts a PackFill with start(path) and the others read the same one, so dulwich generates the pack only once.
+    def fill(self, repo_path, key, start):
+        with self._lock:
+            fill = self._inflight.get(key)
+            if fill is None:
+                self.misses += 1
+                fill = start(self.path(repo_path, key))
+                self._inflight[key] = fill
+            else:
+                self.hits += 1
+            return PackReader(fill)
+
+    # Publishes a completed fill, unless a push made it stale or it's over the size budget, and stops coalescing on it
+    def _complete(self, fill, success):
+        with self._lock:
+            if self._inflight.get(fill.key) is fill:
+                del self._inflight[fill.key]
+            if not success or fill.stale or fill.size > self.max_size:
+                return False
+            try:
+                os.replace(fill.tmp_path, fill.path)
+            except OSError as e:
+                log.warning(f"Unable to store pack in cache: {e}")
+                return False
+            self._store(fill.path, fill.size)
+            return True
+
+    def _store(self, path, size):
+        with self._lock:
+            self._forget(path)
+            self._index[path] = size
+            self._size += size
+            self._evict()
+
+    def _forget(self, path):
+        size = self._index.pop(path, None)
+        if size is not None:
+            self._size -= size
+
+    def _evict(self):
+        while self._index and self._size > self.max_size:
+            path, size = self._index.popitem(last=False)
+            self._size -= size
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    # Drops every cached response of a repository (e.g. after a push). Packs still being generated are served to
+    # the requests reading them but never published, and new requests no longer join them.
+    def invalidate(self, repo_path):
+        repo_dir = self._repo_dir(repo_path)
+        with self._lock:
+            for key, fill in list(self._inflight.items()):
+                if os.path.dirname(fill.path) == repo_dir:
+                    fill.stale = True
+                    del self._inflight[key]
+            for path in [p for p in self._index if os.path.dirname(p) == repo_dir]:
+                self._forget(path)
+        shutil.rmtree(repo_dir, ignore_errors=True)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._index)
+
+# Generates an upload-pack response into a temporary file next to its cache entry at dulwich's own pace, independently
+# of the clients reading it. Every request for the pack, the one that started it included, streams the growing file
+# with a PackReader. The entry is published as soon as dulwich finished without error, even if no client is left.
+# The file is read through a descriptor shared by the readers, which stays valid once the file is renamed or unlinked.
+class PackFill(streaming.GitResponseStream):
+
+    def __init__(self, cache, path, key, git_app, environ, on_finish=None, executor=None):
+        self.cache = cache
+        self.path = path
+        self.key = key
+        self.size = 0
+        self.stale = False
+        self._executor = executor
+        self._readers = 0
+        self._done = False
+        self._cond = threading.Condition()
+        self._waiters = set()
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._fd, self.tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            super().__init__(git_app, environ, on_finish=on_finish)
+        except Exception:
+            self._discard()
+            raise
+
+    def _launch(self, git_app, environ):
+        if self._executor is None:
+            super()._launch(git_app, environ)
+        else:
+            self._executor.submit(self._run, git_app, environ)
+
+    def _put(self, item):
+        if item is streaming._EOF:
+            self._finish()
+            return
+
+        view = memoryview(item)
+        while view:
+            written = os.pwrite(self._fd, view, self.size)
+            view = view[written:]
+            with self._cond:
+                self.size += written
+                self._notify()
+
+    def _finish(self):
+        success = self.error is None and self.status is not None and self.status.startswith('200')
+        published = self.cache._complete(self, success)
+        if not published:
+            try:
+                os.unlink(self.tmp_path)
+            except OSError:
+                pass
+
+        with self._cond:
+            self._done = True
+            self._notify()
+            if not self._readers:
+                os.close(self._fd)
+
+    def _discard(self):
+        os.close(self._fd)
+        try:
+            os.unlink(self.tmp_path)
+        except OSError:
+            pass
+
+    def _notify(self):
+        self._cond.notify_all()
+        for loop, event in self._waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                pass
+
+    def attach(self):
+        with self._cond:
+            self._readers += 1
+
+    def detach(self):
+        with self._cond:
+            self._readers -= 1
+            if self._done and not self._readers:
+                os.close(self._fd)
+
+    # Up to size bytes of the response from offset, b'' at its end, or None when wait is False and dulwich hasn't
+    # written them yet
+    def read(self, offset, size, wait=True):
+        with self._cond:
+            while offset >= self.size and not self._done:
+                if not wait:
+                    return None
+                self._cond.wait()
+            if offset >= self.size:
+                return b''
+            size = min(size, self.size - offset)
+        return os.pread(self._fd, size, offset)
+
+    # Waits on the event loop until dulwich has written past offset or finished
+    async def written(self, offset):
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._cond:
+            if offset < self.size or self._done:
+                return
+            self._waiters.add(waiter)
+        try:
+            await waiter[1].wait()
+        finally:
+            with self._cond:
+                self._waiters.discard(waiter)
+
+    # dulwich's output goes to the file, so there is nothing to stop when one of the clients goes away
+    def close(self):
+        pass
+
+# Streams a PackFill's response to one client as it is generated. A failure of dulwich is raised once everything
+# written before it has been sent, as GitResponseStream does, so that the server aborts the response.
+class PackReader:
+
+    def __init__(self, fill, chunk_size=65536):
+        self.fill = fill
+        self._chunk_size = chunk_size
+        self._offset = 0
+        self._closed = False
+        fill.attach()
+
+    def __iter__(self):
+        while not self._closed:
+            data = self.fill.read(self._offset, self._chunk_size)
+            if not data:
+                break
+            self._offset += len(data)
+            yield data
+        self._end()
+
+    async def __aiter__(self):
+        while not self._closed:
+            data = self.fill.read(self._offset, self._chunk_size, wait=False)
+            if data is None:
+                await self.fill.written(self._offset)
+                continue
+            if not data:
+                break
+            self._offset += len(data)
+            yield data
+        self._end()
+
+    def _end(self):
+        closed = self._closed
+        self.close()
+        if self.fill.error is not None and not closed:
+            raise self.fill.error
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.fill.detach()
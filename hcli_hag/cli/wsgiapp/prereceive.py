@@ -0,0 +1,287 @@
+import os
+import zlib
+
+from hcli_core import logger
+from hcli_problem_details import *
+
+from hcli_hag.cli import stats
+from hcli_hag.cli.wsgiapp import metrics
+
+log = logger.Logger("hag")
+
+# Pack object types
+BLOB = 3
+OFS_DELTA = 6
+REF_DELTA = 7
+
+# The prefix of the temporary file dulwich writes an incoming pack to, in the repository's objects folder
+PARTIAL_PACK_PREFIX = 'tmp_pack_'
+
+
+# Reads a size varint (7 bits per byte, least significant first) at the start of data. Returns the size and the number
+# of bytes it took, or None if data ends before the varint does.
+def read_varint(data, pos=0):
+    size = shift = 0
+    while pos < len(data):
+        byte = data[pos]
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        pos += 1
+        if not byte & 0x80:
+            return size, pos
+    return None
+
+# Parses the header of a pack object at the start of data: its type, its (inflated) size and the length of the header,
+# delta base included. Returns None if data ends before the header does.
+def read_object_header(data, hash_size=20):
+    if not data:
+        return None
+
+    byte = data[0]
+    kind = (byte >> 4) & 7
+    size = byte & 0x0f
+    shift = 4
+    pos = 1
+    while byte & 0x80:
+        if pos >= len(data):
+            return None
+        byte = data[pos]
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        pos += 1
+
+    if kind == OFS_DELTA:
+        while True:
+            if pos >= len(data):
+                return None
+            pos += 1
+            if not data[pos - 1] & 0x80:
+                break
+    elif kind == REF_DELTA:
+        pos += hash_size
+        if pos > len(data):
+            return None
+    return kind, size, pos
+
+# Follows a receive-pack request body as it is read: the pkt-line ref update commands up to their flush, then the
+# pack. pack_bytes counts what has arrived of the pack. With on_blob, objects are also followed one by one, inflating
+# each to find where it ends, and on_blob is called with the size of every blob and with the size every delta resolves
+# to (its type is only known once its base is, so a delta may be a blob). Input that isn't a well-formed pack is
+# left to dulwich to reject.
+class PackInspector:
+
+    def __init__(self, on_blob=None, hash_size=20, chunk_size=65536):
+        self.on_blob = on_blob
+        self.hash_size = hash_size
+        self.chunk_size = chunk_size
+        self.pack_bytes = 0
+        self.objects = None
+        self.seen = 0
+        self._state = 'commands'
+        self._buffer = bytearray()
+        self._inflate = None
+        self._delta_header = None
+
+    def feed(self, data):
+        if not data:
+            return
+        if self._state == 'commands':
+            self._buffer += data
+            self._commands()
+        else:
+            self.pack_bytes += len(data)
+            self._pack(data)
+
+    def _commands(self):
+        while len(self._buffer) >= 4:
+            try:
+                length = int(self._buffer[:4], 16)
+            except ValueError:
+                self._state = 'done'
+                return
+
+            if length == 0:
+                rest = bytes(self._buffer[4:])
+                self._buffer.clear()
+                self._state = 'header' if self.on_blob is not None else 'counting'
+                self.pack_bytes += len(rest)
+                self._pack(rest)
+                return
+            if length < 4:
+                self._state = 'done'
+                return
+            if len(self._buffer) < length:
+                return
+            del self._buffer[:length]
+
+    def _pack(self, data):
+        if self._state not in ('header', 'object', 'inflate'):
+            return
+
+        if self._state == 'inflate':
+            self._feed_inflate(data)
+        else:
+            self._buffer += data
+        try:
+            while self._step():
+                pass
+        except zlib.error:
+            self._state = 'done'
+            self._buffer.clear()
+
+    # Parses what is buffered for the current state; returns whether it got anywhere
+    def _step(self):
+        if self._state == 'header':
+            if len(self._buffer) < 12:
+                return False
+            if self._buffer[:4] != b'PACK':
+                self._state = 'done'
+                return False
+
+            self.objects = int.from_bytes(self._buffer[8:12], 'big')
+            del self._buffer[:12]
+            self._state = 'object' if self.objects else 'done'
+            return True
+
+        if self._state == 'object':
+            header = read_object_header(self._buffer, self.hash_size)
+            if header is None:
+                return False
+
+            kind, size, length = header
+            del self._buffer[:length]
+            if kind == BLOB:
+                self.on_blob(size)
+            self._delta_header = bytearray() if kind in (OFS_DELTA, REF_DELTA) else None
+            self._inflate = zlib.decompressobj()
+            self._state = 'inflate'
+            data = bytes(self._buffer)
+            self._buffer.clear()
+            return self._feed_inflate(data)
+
+        return False
+
+    # Inflates the current object as far as data goes. Returns True once the object ended, with whatever followed it
+    # buffered for the next one.
+    def _feed_inflate(self, data):
+        while True:
+            out = self._inflate.decompress(data, self.chunk_size)
+            if self._delta_header is not None and out:
+
+                # A delta starts with the size of its base and the size of the object it resolves to
+                self._delta_header += out[:32]
+                sizes = read_varint(self._delta_header)
+                target = read_varint(self._delta_header, sizes[1]) if sizes is not None else None
+                if target is not None:
+                    self._delta_header = None
+                    self.on_blob(target[0])
+
+            if self._inflate.eof:
+                self._buffer += self._inflate.unused_data
+                self._inflate = None
+                self.seen += 1
+                self._state = 'object' if self.seen < self.objects else 'done'
+                if self._state == 'done':
+                    self._buffer.clear()
+                return True
+
+            data = self._inflate.unconsumed_tail
+            if not data:
+                return False
+
+# The limits a push is held to as its pack arrives. quotas are (what, quota, used) for each disk quota that applies,
+# used being the bytes stored already. A limit of 0 is no limit.
+class ReceiveLimits:
+
+    def __init__(self, max_pack_size=0, max_blob_size=0, quotas=(), instance=None):
+        self.max_pack_size = max_pack_size
+        self.max_blob_size = max_blob_size
+        self.quotas = [(what, quota, used) for what, quota, used in quotas if quota > 0]
+        self.instance = instance
+        self.rejected = None
+
+    def __bool__(self):
+        return bool(self.max_pack_size > 0 or self.max_blob_size > 0 or self.quotas)
+
+    def _reject(self, reason, error):
+        self.rejected = reason
+        metrics.receive_rejected.inc(reason=reason)
+        log.warning(f"Rejecting the push to {self.instance}: {error.detail}")
+        raise error
+
+    def check_pack(self, pack_bytes):
+        if 0 < self.max_pack_size < pack_bytes:
+            self._reject('pack_size', PayloadTooLargeError(
+                detail=f"The pushed pack is larger than the {self.max_pack_size} byte limit.",
+                instance=self.instance))
+
+        for what, quota, used in self.quotas:
+            if used + pack_bytes > quota:
+                self._reject('quota', InsufficientStorageError(
+                    detail=f"The push would take {what} over its {quota} byte quota ({used} bytes used).",
+                    instance=self.instance))
+
+    def check_blob(self, size):
+        if 0 < self.max_blob_size < size:
+            self._reject('blob_size', PayloadTooLargeError(
+                detail=f"The push contains an object of {size} bytes, over the {self.max_blob_size} byte limit.",
+                instance=self.instance))
+
+# A receive-pack request body that is checked against ReceiveLimits as dulwich reads it. The first read past a limit
+# raises a problem detail, which isn't one of the errors dulwich reports as a failed unpack, so the push is abandoned
+# right there and answered with the error; what dulwich wrote of the pack is removed by remove_partial_packs.
+class ReceiveInput:
+
+    def __init__(self, stream, limits, hash_size=20, chunk_size=65536):
+        self._stream = stream
+        self._limits = limits
+        self.inspector = PackInspector(limits.check_blob if limits.max_blob_size > 0 else None, hash_size, chunk_size)
+
+    def _inspect(self, data):
+        self.inspector.feed(data)
+        self._limits.check_pack(self.inspector.pack_bytes)
+        return data
+
+    def read(self, size=-1):
+        return self._inspect(self._stream.read(size))
+
+    def readline(self, size=-1):
+        return self._inspect(self._stream.readline(size))
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+# The bytes stored for a repository
+def repo_usage(store, user, repo, repo_path):
+    return stats.repo_stats(store, user, repo, repo_path)['size']
+
+# The bytes stored for all of a user's repositories, in every storage root
+def user_usage(store, storage, user):
+    entries = store.entries() if store is not None else {}
+    total = 0
+    for root in storage.roots:
+        try:
+            names = os.listdir(os.path.join(root, user))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+
+        for name in names:
+            if name.endswith('.git') and not name.startswith('.'):
+                total += stats.repo_stats(store, user, name, os.path.join(root, user, name),
+                                          entry=entries.get(f"{user}/{name}"))['size']
+    return total
+
+# The names of the partial packs in a repository's objects folder
+def partial_packs(repo_path):
+    try:
+        return {name for name in os.listdir(os.path.join(repo_path, 'objects')) if name.startswith(PARTIAL_PACK_PREFIX)}
+    except FileNotFoundError:
+        return set()
+
+# Removes the partial packs of a rejected push, i.e. those that weren't there before it (known)
+def remove_partial_packs(repo_path, known):
+    for name in partial_packs(repo_path) - known:
+        try:
+            os.remove(os.path.join(repo_path, 'objects', name))
+        except FileNotFoundError:
+            pass
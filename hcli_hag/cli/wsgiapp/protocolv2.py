@@ -0,0 +1,272 @@
+from dulwich.errors import GitProtocolError
+from dulwich.protocol import pkt_line
+from dulwich.refs import SymrefLoop
+
+from hcli_hag import package
+
+DELIM_PKT = b'0001'
+
+# What the fetch command supports when translated onto dulwich's protocol v0 upload-pack
+FETCH_FEATURES = b'shallow filter'
+
+# Shallow arguments that the shallow feature implies but dulwich has no equivalent for
+UNSUPPORTED_DEEPEN = (b'deepen-since', b'deepen-not', b'deepen-relative')
+
+
+# Whether a Git-Protocol header (colon separated key=value pairs) asks for protocol version 2
+def requested(header):
+    return header is not None and 'version=2' in header.split(':')
+
+# The capability advertisement answered to GET /info/refs?service=git-upload-pack in protocol v2.
+# Refs aren't advertised up front any more; clients ask for the ones they need with ls-refs.
+def capability_advertisement(object_format):
+    lines = [b'version 2\n',
+             b'agent=hag/' + package.__version__.encode('ascii') + b'\n',
+             b'ls-refs=unborn\n',
+             b'fetch=' + FETCH_FEATURES + b'\n',
+             b'object-format=' + object_format.encode('ascii') + b'\n']
+    return b''.join(pkt_line(line) for line in lines) + pkt_line(None)
+
+# Reads the first pkt-line of a request body to learn the v2 command, then puts it back for dulwich.
+# Returns None for a body that isn't a v2 command request.
+def peek_command(environ, replay):
+    stream = environ['wsgi.input']
+    header = stream.read(4)
+    prefix = header
+    command = None
+    try:
+        length = int(header, 16) if len(header) == 4 else 0
+    except ValueError:
+        length = 0
+
+    if length > 4:
+        line = stream.read(length - 4)
+        prefix += line
+        if line.startswith(b'command='):
+            command = line[8:].rstrip(b'\n').decode('ascii', 'replace')
+
+    environ['wsgi.input'] = replay(prefix, stream)
+    return command
+
+# Reads a v2 command request: the command, its capability lines up to the delim-pkt and its arguments up to the
+# flush-pkt. dulwich reads both packets as None; a request without arguments ends after the first.
+def read_command(proto):
+    command = None
+    capabilities = []
+    line = proto.read_pkt_line()
+    while line is not None:
+        line = line.rstrip(b'\n')
+        if line.startswith(b'command='):
+            command = line[8:]
+        else:
+            capabilities.append(line)
+        line = proto.read_pkt_line()
+
+    args = []
+    if not proto.eof():
+        line = proto.read_pkt_line()
+        while line is not None:
+            args.append(line.rstrip(b'\n'))
+            line = proto.read_pkt_line()
+
+    return command, capabilities, args
+
+# Names of the refs that may match the ls-refs prefixes. Only the folders a prefix points into are listed, so a
+# client fetching one branch doesn't make us resolve every ref of the repository.
+def _candidate_refs(refs, prefixes):
+    if not prefixes or any(b'refs/'.startswith(prefix) for prefix in prefixes):
+        return refs.allkeys()
+
+    names = set()
+    for prefix in prefixes:
+        if b'HEAD'.startswith(prefix):
+            names.add(b'HEAD')
+        if prefix.startswith(b'refs/'):
+            base = prefix[:prefix.rindex(b'/')]
+            names.update(base + b'/' + name for name in refs.subkeys(base))
+    return names
+
+# Answers the ls-refs command: "<oid> <name>[ symref-target:<target>][ peeled:<oid>]" for each ref matching one
+# of the ref-prefix arguments (or every ref without any), in name order.
+def ls_refs(repo, args, write):
+    prefixes = [arg[len(b'ref-prefix '):] for arg in args if arg.startswith(b'ref-prefix ')]
+    symrefs = b'symrefs' in args
+    peel = b'peel' in args
+    unborn = b'unborn' in args
+
+    refs = repo.refs
+    for name in sorted(_candidate_refs(refs, prefixes)):
+        if prefixes and not any(name.startswith(prefix) for prefix in prefixes):
+            continue
+
+        target = None
+        if symrefs or name == b'HEAD':
+            value = refs.read_ref(name)
+            if value is not None and value.startswith(b'ref: '):
+                target = value[5:].strip()
+
+        try:
+            sha = refs[name]
+        except (KeyError, SymrefLoop):
+            if name == b'HEAD' and unborn and target is not None:
+                write(pkt_line(b'unborn HEAD symref-target:' + target + b'\n'))
+            continue
+
+        line = sha + b' ' + name
+        if symrefs and target is not None:
+            line += b' symref-target:' + target
+        if peel:
+            peeled = repo.get_peeled(name)
+            if peeled is not None and peeled != sha:
+                line += b' peeled:' + peeled
+        write(pkt_line(line + b'\n'))
+
+    write(pkt_line(None))
+
+# Translates the arguments of a v2 fetch into the equivalent stateless v0 upload-pack request for dulwich.
+# Returns the request body and whether the client is done negotiating. Raises GitProtocolError for arguments that
+# can't be translated.
+def fetch_request(args):
+    wants = []
+    haves = []
+    shallow = []
+    deepen = None
+    filter_spec = None
+    done = False
+    capabilities = [b'multi_ack_detailed', b'side-band-64k', b'no-done']
+
+    for arg in args:
+        if arg.startswith(b'want '):
+            wants.append(arg[5:])
+        elif arg.startswith(b'have '):
+            haves.append(arg[5:])
+        elif arg == b'done':
+            done = True
+        elif arg in (b'thin-pack', b'ofs-delta', b'no-progress', b'include-tag'):
+            capabilities.append(arg)
+        elif arg.startswith(b'shallow '):
+            shallow.append(arg[8:])
+        elif arg.startswith(b'deepen '):
+            deepen = arg[7:]
+        elif arg.startswith(b'filter '):
+            filter_spec = arg[7:]
+        elif arg.split(b' ', 1)[0] in UNSUPPORTED_DEEPEN:
+            raise GitProtocolError(f"{arg.split(b' ', 1)[0].decode('ascii')} is not supported, fetch with --depth")
+        else:
+            raise GitProtocolError(f"Unsupported fetch argument {arg.decode('utf-8', 'replace')!r}")
+
+    if filter_spec is not None:
+        capabilities.append(b'filter')
+    if deepen is not None:
+        capabilities.append(b'shallow')
+
+    lines = []
+    for i, want in enumerate(wants):
+        lines.append(b'want ' + want + (b' ' + b' '.join(capabilities) if i == 0 else b'') + b'\n')
+    if filter_spec is not None:
+        lines.append(b'filter ' + filter_spec + b'\n')
+
+    # dulwich only handles shallow lines along with a depth. Without one the haves (which include the client's
+    # shallow commits) already bound what is sent.
+    if deepen is not None:
+        lines.extend(b'shallow ' + sha + b'\n' for sha in shallow)
+        lines.append(b'deepen ' + deepen + b'\n')
+
+    body = [pkt_line(line) for line in lines]
+    body.append(pkt_line(None))
+    body.extend(pkt_line(b'have ' + have + b'\n') for have in haves)
+    body.append(pkt_line(b'done\n') if done else pkt_line(None))
+    return b''.join(body), done
+
+# The error packet that ends a response the request can't be answered with, which the client reports as a remote error
+def error_line(message):
+    return pkt_line(b'ERR ' + message.encode('utf-8', 'replace') + b'\n')
+
+# Re-frames the output of dulwich's v0 upload-pack (multi_ack_detailed, side-band-64k, no-done) as a v2 fetch
+# response. The shallow and ACK lines that precede the pack are collected and written as the acknowledgments and
+# shallow-info sections once the pack starts (or the response ends); the pack itself is passed straight through.
+class FetchResponseWriter:
+
+    def __init__(self, write, done):
+        self._write = write
+        self._done = done
+        self._buffer = bytearray()
+        self._common = []
+        self._shallow = []
+        self._ready = False
+        self._in_pack = False
+
+    def write(self, data):
+        if self._in_pack:
+            self._write(data)
+            return len(data)
+
+        buffer = self._buffer
+        buffer += data
+        i = 0
+        while len(buffer) - i >= 4:
+            length = int(buffer[i:i + 4], 16)
+            if length < 4:
+                i += 4
+                continue
+            if len(buffer) - i < length:
+                break
+
+            payload = bytes(buffer[i + 4:i + length])
+
+            # An error packet ends the response in either protocol version, so it is passed on as it is
+            if payload.startswith(b'ERR '):
+                self._in_pack = True
+                self._write(bytes(buffer[i:]))
+                buffer.clear()
+                return len(data)
+
+            if payload[:1] in (b'\x01', b'\x02', b'\x03'):
+                self._in_pack = True
+                self._write(self._sections() + pkt_line(b'packfile\n') + bytes(buffer[i:]))
+                buffer.clear()
+                return len(data)
+
+            self._line(payload.rstrip(b'\n'))
+            i += length
+
+        del buffer[:i]
+        return len(data)
+
+    def _line(self, line):
+        if line.startswith(b'shallow ') or line.startswith(b'unshallow '):
+            self._shallow.append(line)
+        elif line.startswith(b'ACK '):
+            parts = line.split()
+            if len(parts) == 3 and parts[2] in (b'common', b'ready'):
+                if parts[1] not in self._common:
+                    self._common.append(parts[1])
+                if parts[2] == b'ready':
+                    self._ready = True
+
+    def _acknowledgments(self):
+        lines = [b'acknowledgments\n']
+        lines.extend(b'ACK ' + sha + b'\n' for sha in self._common)
+        if not self._common:
+            lines.append(b'NAK\n')
+        if self._ready:
+            lines.append(b'ready\n')
+        return b''.join(pkt_line(line) for line in lines)
+
+    # The sections that go before the packfile section
+    def _sections(self):
+        sections = b''
+        if not self._done:
+            sections += self._acknowledgments() + DELIM_PKT
+        if self._shallow:
+            sections += b''.join(pkt_line(line) for line in [b'shallow-info\n'] +
+                                 [line + b'\n' for line in self._shallow]) + DELIM_PKT
+        return sections
+
+    # Ends a response that didn't include a pack: negotiation goes on in the client's next request
+    def finish(self):
+        if self._in_pack:
+            return
+        if not self._done:
+            self._write(self._acknowledgments())
+        self._write(pkt_line(None))
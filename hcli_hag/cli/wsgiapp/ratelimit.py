@@ -0,0 +1,236 @@
+import math
+import time
+import asyncio
+import threading
+
+from collections import OrderedDict
+
+from hcli_core import config as c
+from hcli_core import logger
+from hcli_problem_details import *
+
+from hcli_hag.cli.wsgiapp import streaming
+
+log = logger.Logger("hag")
+
+# What requests are limited by: the authenticated user, the client address and the repository
+KINDS = ('user', 'ip', 'repo')
+
+
+# A token bucket: tokens accrue at rate per second up to burst. Request buckets are only debited when there is a token
+# to take; byte buckets are debited by what was sent and may go into debt, which the sender pays off by waiting.
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    # Seconds until n tokens are available
+    def wait(self, n, now):
+        self.refill(now)
+        return 0.0 if self.tokens >= n else (n - self.tokens) / self.rate
+
+    def take(self, n, now):
+        self.refill(now)
+        self.tokens -= n
+
+    # Seconds until the bucket is out of debt
+    def debt(self, now):
+        self.refill(now)
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+# Request rate and bandwidth limits, applied separately to each user, client address and repository.
+# limits maps a kind (user, ip or repo) to its (requests per second, bytes per second); 0 means unlimited. A bucket
+# holds up to burst seconds worth of its rate (and at least one request). Buckets are created on first use and the
+# least recently used are dropped beyond max_keys, which only forgets their history.
+class RateLimiter:
+
+    def __init__(self, limits, burst=10.0, max_delay=30.0, max_keys=10000):
+        self.limits = {}
+        self.burst = burst
+        self.max_delay = max_delay
+        self.max_keys = max_keys
+        self.rejected = {kind: 0 for kind in KINDS}
+        self.throttled = 0.0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.configure(limits, burst, max_delay, max_keys)
+
+    # Changes the limits of a running limiter. The buckets start over when a limit changes.
+    def configure(self, limits, burst=10.0, max_delay=30.0, max_keys=10000):
+        limits = {kind: (float(limits.get(kind, (0, 0))[0]), float(limits.get(kind, (0, 0))[1])) for kind in KINDS}
+        with self._lock:
+            if limits != self.limits or burst != self.burst:
+                self._buckets.clear()
+            self.limits = limits
+            self.burst = burst
+            self.max_delay = max_delay
+            self.max_keys = max_keys
+
+    @property
+    def limits_bandwidth(self):
+        return any(rate > 0 for _, rate in self.limits.values())
+
+    def _bucket(self, unit, kind, key, rate, now):
+        name = (unit, kind, key)
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            burst = rate * self.burst
+            if unit == 'requests':
+                burst = max(1.0, burst)
+            bucket = self._buckets[name] = TokenBucket(rate, burst, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(name)
+        return bucket
+
+    # Admits a request for keys ({kind: key}, kinds without a key aren't limited). Returns 0 and takes a request token
+    # from each bucket, or returns how long (seconds) to wait and the kind that is over its limit. A key is also over
+    # its limit while it owes more than max_delay seconds of bandwidth.
+    def admit(self, keys):
+        now = time.monotonic()
+        with self._lock:
+            waits = []
+            for kind, key in keys.items():
+                requests, bandwidth = self.limits[kind]
+                if requests > 0:
+                    waits.append((self._bucket('requests', kind, key, requests, now).wait(1, now), kind))
+                if bandwidth > 0:
+                    debt = self._bucket('bytes', kind, key, bandwidth, now).debt(now)
+                    waits.append((debt - self.max_delay, kind))
+
+            wait, kind = max(waits, default=(0.0, None))
+            if wait > 0:
+                self.rejected[kind] += 1
+                return wait, kind
+
+            for kind, key in keys.items():
+                requests, _ = self.limits[kind]
+                if requests > 0:
+                    self._bucket('requests', kind, key, requests, now).take(1, now)
+            return 0.0, None
+
+    # Accounts for n bytes sent for keys. Returns how long (seconds) the sender should wait to keep to the limits.
+    def consume(self, keys, n):
+        now = time.monotonic()
+        with self._lock:
+            delay = 0.0
+            for kind, key in keys.items():
+                _, bandwidth = self.limits[kind]
+                if bandwidth > 0:
+                    bucket = self._bucket('bytes', kind, key, bandwidth, now)
+                    bucket.take(n, now)
+                    delay = max(delay, bucket.debt(now))
+            return delay
+
+    def __len__(self):
+        with self._lock:
+            return len(self._buckets)
+
+# Paces a response body to the bandwidth limits of its request. The body is sent in pieces of at most chunk_size and
+# each piece waits until the keys are out of debt, so a client gets its burst right away and the configured rate after
+# that. File bodies are read through as well, which means a throttled response isn't sent with sendfile.
+class ThrottledStream:
+
+    def __init__(self, source, limiter, keys, chunk_size=65536):
+        self._source = source
+        self._limiter = limiter
+        self._keys = keys
+        self._chunk_size = chunk_size
+
+    def _chunks(self):
+        if hasattr(self._source, 'read'):
+            while True:
+                data = self._source.read(self._chunk_size)
+                if not data:
+                    return
+                yield data
+        else:
+            yield from self._source
+
+    def _pieces(self, data):
+        view = memoryview(data)
+        for i in range(0, len(view), self._chunk_size):
+            piece = view[i:i + self._chunk_size]
+            delay = self._limiter.consume(self._keys, len(piece))
+            if delay > 0:
+                self._limiter.throttled += delay
+            yield bytes(piece), delay
+
+    def __iter__(self):
+        for data in self._chunks():
+            for piece, delay in self._pieces(data):
+                if delay > 0:
+                    time.sleep(delay)
+                yield piece
+
+    # On the asyncio server the wait is a sleep of the coroutine sending the response
+    async def __aiter__(self):
+        async for data in streaming.aiterate(self._source, chunk_size=self._chunk_size):
+            for piece, delay in self._pieces(data):
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                yield piece
+
+    def close(self):
+        close = getattr(self._source, 'close', None)
+        if close is not None:
+            close()
+
+# The client address of a request. Behind hops proxies that each append the address they got the request from to
+# X-Forwarded-For, the client is the entry hops from the right; entries further left come from the client, which can
+# send any. With no hops the header isn't trusted at all.
+def client_ip(req, hops=0):
+    if hops > 0:
+        forwarded_for = req.get_header('X-Forwarded-For')
+        entries = [entry.strip() for entry in forwarded_for.split(',')] if forwarded_for else []
+        entries = [entry for entry in entries if entry]
+        if entries:
+            return entries[-min(hops, len(entries))]
+    return req.remote_addr or '0.0.0.0'
+
+# Applies a RateLimiter to the repository endpoints. It runs after authentication so that requests to resources that
+# require it are limited by their user as well; other requests are limited by client address and repository. Requests
+# over a limit are answered with a 429 and a Retry-After rather than queued, and response bodies are paced to the
+# bandwidth limits.
+class RateLimitMiddleware:
+
+    def __init__(self, limiter, chunk_size=65536, forwarded_hops=0):
+        self.limiter = limiter
+        self.chunk_size = chunk_size
+        self.forwarded_hops = forwarded_hops
+
+    def process_resource(self, req, resp, resource, params):
+        if resource is None or 'user' not in params or 'repo' not in params:
+            return
+
+        keys = {'ip': client_ip(req, self.forwarded_hops), 'repo': f"{params['user']}/{params['repo']}"}
+        if getattr(resource, 'requires_authentication', False):
+            user = c.ServerContext.get_current_user()
+            if user:
+                keys['user'] = user
+
+        wait, kind = self.limiter.admit(keys)
+        if wait > 0:
+            retry_after = max(1, math.ceil(wait))
+            log.warning(f"Rate limiting {req.method} {req.path} for {kind} {keys[kind]}")
+            resp.set_header('Retry-After', str(retry_after))
+            raise TooManyRequestsError(detail=f"Rate limit exceeded for {kind} {keys[kind]}. "
+                                              f"Retry in {retry_after} seconds.", instance=req.path)
+
+        req.context.rate_limit_keys = keys
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        keys = getattr(req.context, 'rate_limit_keys', None)
+        if keys is None or resp.stream is None or not self.limiter.limits_bandwidth:
+            return
+
+        resp.stream = ThrottledStream(resp.stream, self.limiter, keys, self.chunk_size)
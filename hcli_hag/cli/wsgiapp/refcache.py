@@ -0,0 +1,102 @@
+import os
+import time
+import hashlib
+
+from collections import OrderedDict
+from threading import RLock
+
+from hcli_core import logger
+
+log = logger.Logger("hag")
+
+
+# Snapshot of what a ref advertisement depends on: HEAD, packed-refs and every directory under refs/.
+# Loose ref updates are written through a lock file and renamed into place, which bumps the mtime of the
+# containing directory, so we only need to stat directories and never read ref files.
+def refs_state(repo_path):
+    state = []
+    for name in ('HEAD', 'packed-refs'):
+        try:
+            st = os.stat(os.path.join(repo_path, name))
+            state.append((name, st.st_ino, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            state.append((name, None))
+
+    refs = os.path.join(repo_path, 'refs')
+    for dirpath, dirnames, filenames in os.walk(refs):
+        st = os.stat(dirpath)
+        state.append((os.path.relpath(dirpath, refs), st.st_ino, st.st_mtime_ns))
+
+    return tuple(state)
+
+class RefAdvertisement:
+
+    def __init__(self, status, headers, body, state):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.state = state
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.checked = time.monotonic()
+
+# Per repo cache of serialized /info/refs advertisements.
+# An entry is trusted without touching the disk for ttl seconds after it was last validated; after that it is
+# revalidated against refs_state(). Pushes handled by this process invalidate entries right away.
+# A ttl of 0 revalidates on every request; a larger ttl can hand out tips that were replaced outside of hag,
+# and clients then fail with "want" lines that upload-pack no longer accepts.
+class RefAdvertisementCache:
+
+    def __init__(self, max_size=1024, ttl=0.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = RLock()
+
+    def state(self, repo_path):
+        return refs_state(repo_path)
+
+    def get(self, repo_path, variant):
+        key = (repo_path, variant)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is not None:
+            now = time.monotonic()
+            if now - entry.checked >= self.ttl:
+                if self.state(repo_path) == entry.state:
+                    entry.checked = now
+                else:
+                    entry = None
+                    with self._lock:
+                        self._entries.pop(key, None)
+
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+
+        return entry
+
+    def put(self, repo_path, variant, entry):
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[(repo_path, variant)] = entry
+            self._entries.move_to_end((repo_path, variant))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, repo_path):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == repo_path]:
+                del self._entries[key]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,305 @@
+import os
+import hmac
+import json
+import time
+import queue
+import threading
+import http.client
+import urllib.parse
+
+import falcon
+
+from hcli_core import logger
+from hcli_problem_details import *
+
+from dulwich.client import HttpGitClient
+from dulwich.errors import NotGitRepository
+from dulwich.repo import Repo
+
+from hcli_hag.cli.wsgiapp import backend
+
+log = logger.Logger("hag")
+
+TOKEN_HEADER = 'X-Hag-Replica-Token'
+
+# Request headers passed on to the primary when a push is proxied; the body is re-sent as it was received
+FORWARDED_HEADERS = ('Authorization', 'Content-Type', 'Accept', 'Git-Protocol', 'User-Agent')
+
+# Response headers that describe the connection to the primary rather than the response
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'transfer-encoding', 'te', 'trailer', 'upgrade',
+                      'proxy-authenticate', 'proxy-authorization')
+
+
+# Whether a request is part of a push, which a replica hands to its primary
+def is_push(req):
+    return req.path.endswith('/git-receive-pack') or req.get_param('service') == 'git-receive-pack'
+
+# A post-receive hook that tells one replica which repository a push updated. The hook pipeline spools the event and
+# retries a replica that is down with backoff, so a replica that was unreachable still hears of every push.
+class ReplicaNotifier:
+
+    def __init__(self, replica, token=None, timeout=10.0):
+        self.replica = replica.rstrip('/')
+        self.name = f"replica:{self.replica}"
+        self.token = token
+        self.timeout = timeout
+
+    def __call__(self, event):
+        url = urllib.parse.urlsplit(self.replica)
+        repo = urllib.parse.quote(event['repo'])
+        body = json.dumps({'id': event['id'], 'created': event['created'], 'updates': event['updates']}).encode('utf-8')
+        headers = {'Content-Type': 'application/json', 'Content-Length': str(len(body))}
+        if self.token:
+            headers[TOKEN_HEADER] = self.token
+
+        connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        connection = connection_class(url.netloc, timeout=self.timeout)
+        try:
+            connection.request('POST', f"{url.path}/{urllib.parse.quote(event['user'])}/{repo}/hag-replicate",
+                               body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status >= 300:
+                raise RuntimeError(f"{self.replica} answered {response.status} {response.reason}")
+        finally:
+            connection.close()
+
+# A replica's copy of the primary's repositories.
+# Push notifications queue a repository for a sync, which fetches what's new from the primary over smart HTTP into
+# the local repository (creating it on the first sync) and then sets the local refs to the primary's. Syncs run on a
+# small pool of threads; a repository notified again while it syncs is synced once more afterwards, so bursts of
+# pushes coalesce. Each repository's lag is the time since the oldest push it hasn't caught up with yet.
+class Replicator:
+
+    def __init__(self, primary, storage, on_synced=None, workers=2, timeout=60.0):
+        self.primary = primary.rstrip('/')
+        self.storage = storage
+        self.on_synced = on_synced
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.syncs = 0
+        self.failures = 0
+        self._status = {}
+        self._queued = set()
+        self._running = set()
+        self._again = set()
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _client(self):
+        return HttpGitClient(self.primary, timeout=self.timeout)
+
+    # Records a push to user/repo (made at created, by the primary's clock) and queues a sync
+    def notify(self, user, repo, created=None):
+        key = f"{user}/{repo}"
+        now = time.time()
+        with self._lock:
+            status = self._status.setdefault(key, {'synced': None, 'behind_since': None, 'last_lag': None,
+                                                   'error': None})
+            since = min(created or now, now)
+            if status['behind_since'] is None or since < status['behind_since']:
+                status['behind_since'] = since
+
+            if key in self._running:
+                self._again.add(key)
+                return
+            if key in self._queued:
+                return
+            self._queued.add(key)
+            self._start()
+
+        self._queue.put((user, repo))
+
+    def _start(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work, name=f"hag-replica-{len(self._threads)}", daemon=True)
+            self._threads.append(thread)
+            thread.start()
+
+    def _work(self):
+        while True:
+            user, repo = self._queue.get()
+            key = f"{user}/{repo}"
+            with self._lock:
+                self._queued.discard(key)
+                self._running.add(key)
+                started = time.time()
+
+            error = None
+            try:
+                self.sync(user, repo)
+            except Exception as e:
+                error = str(e)
+                log.error(f"Replication of {key} from {self.primary} failed: {e}")
+
+            with self._lock:
+                self._running.discard(key)
+                status = self._status[key]
+                status['error'] = error
+                if error is None:
+                    self.syncs += 1
+                    status['synced'] = time.time()
+
+                    # Pushes notified after this sync started may not be in it
+                    if key not in self._again:
+                        if status['behind_since'] is not None:
+                            status['last_lag'] = status['synced'] - status['behind_since']
+                        status['behind_since'] = None
+                else:
+                    self.failures += 1
+
+                again = key in self._again
+                self._again.discard(key)
+                if again and key not in self._queued:
+                    self._queued.add(key)
+                    self._queue.put((user, repo))
+
+            if error is not None and not again:
+
+                # The primary or the network may be back shortly; a later push notification also retries
+                retry = threading.Timer(min(self.timeout, 30.0), self.notify, args=(user, repo, started))
+                retry.daemon = True
+                retry.start()
+
+    # Brings the local copy of user/repo up to date with the primary. Refs that are gone from the primary are
+    # removed. Runs under the repository's push lock, so a hag mv on the replica waits for it.
+    def sync(self, user, repo):
+        with self.storage.push_lock(user, repo) as repo_path:
+            if not os.path.isdir(repo_path):
+                os.makedirs(os.path.dirname(repo_path), exist_ok=True)
+                Repo.init_bare(repo_path, mkdir=True).close()
+                log.info(f"Created replica of {user}/{repo} at {repo_path}")
+
+            local = Repo(repo_path)
+            try:
+                # Protocol v0, where the client asks for the thin packs and offset deltas dulwich's upload-pack sends
+                result = self._client().fetch(f"/{user}/{repo}", local, protocol_version=0)
+                remote_refs = {name: sha for name, sha in result.refs.items()
+                               if name != b'HEAD' and not name.endswith(b'^{}') and sha is not None}
+                local_refs = local.refs.as_dict()
+
+                for name, sha in remote_refs.items():
+                    if local_refs.get(name) != sha:
+                        local.refs[name] = sha
+                for name in local_refs:
+                    if name != b'HEAD' and name not in remote_refs:
+                        local.refs.remove_if_equals(name, None)
+
+                head = result.symrefs.get(b'HEAD')
+                if head is not None:
+                    local.refs.set_symbolic_ref(b'HEAD', head)
+            finally:
+                local.close()
+
+        log.info(f"Replicated {user}/{repo} from {self.primary}")
+        if self.on_synced is not None:
+            self.on_synced(user, repo, repo_path)
+
+    # The replication state of every repository heard of: when it last synced, how far behind the primary it is
+    # (0 when caught up), the lag of the last completed sync and the last error
+    def status(self):
+        now = time.time()
+        with self._lock:
+            return {key: {'synced': status['synced'],
+                          'lag': now - status['behind_since'] if status['behind_since'] is not None else 0.0,
+                          'last_lag': status['last_lag'],
+                          'pending': status['behind_since'] is not None,
+                          'error': status['error']}
+                    for key, status in sorted(self._status.items())}
+
+# Hands pushes to the primary: either redirects the client there (git follows the redirect of the initial ref
+# advertisement and pushes to the primary directly) or proxies the request, streaming the pack both ways.
+def forward(req, resp, primary, mode='proxy', timeout=60.0):
+    target = primary.rstrip('/') + req.relative_uri
+    if mode == 'redirect':
+        raise falcon.HTTPTemporaryRedirect(target)
+
+    url = urllib.parse.urlsplit(target)
+    headers = {name: req.get_header(name) for name in FORWARDED_HEADERS if req.get_header(name)}
+    body = None
+    if req.method == 'POST':
+        length = req.env.get('CONTENT_LENGTH')
+        if length:
+            headers['Content-Length'] = length
+            body = req.bounded_stream
+        else:
+
+            # A gzip body has been decompressed already, so its length isn't known
+            headers['Transfer-Encoding'] = 'chunked'
+            stream = req.env['wsgi.input']
+            body = iter(lambda: stream.read(65536), b'')
+
+    connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+    connection = connection_class(url.netloc, timeout=timeout)
+    try:
+        connection.request(req.method, url.path + (f"?{url.query}" if url.query else ''), body=body, headers=headers,
+                           encode_chunked='Transfer-Encoding' in headers)
+        response = connection.getresponse()
+    except (OSError, http.client.HTTPException) as e:
+        connection.close()
+        log.error(f"Unable to forward {req.method} {req.path} to the primary {primary}: {e}")
+        raise BadGatewayError(detail=f"The primary is unreachable: {e}", instance=req.path)
+
+    resp.status = f"{response.status} {response.reason}"
+    for name, value in response.getheaders():
+        if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != 'content-length':
+            resp.append_header(name, value)
+    resp.stream = ProxiedResponse(response, connection)
+
+# Streams a response from the primary and closes the connection once it's sent
+class ProxiedResponse:
+
+    def __init__(self, response, connection, chunk_size=65536):
+        self._response = response
+        self._connection = connection
+        self._chunk_size = chunk_size
+
+    def __iter__(self):
+        while True:
+            data = self._response.read1(self._chunk_size)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self._connection.close()
+
+# Push notifications from the primary: POST /<user>/<repo>/hag-replicate queues a sync of the repository
+class ReplicateResource:
+    endpoint = 'replicate'
+
+    def __init__(self, replicator, token=None):
+        self.replicator = replicator
+        self.token = token
+
+    def on_post(self, req, resp, user, repo):
+        if self.token and not hmac.compare_digest(req.get_header(TOKEN_HEADER) or '', self.token):
+            raise AuthorizationError(detail="invalid replica token", instance=req.path)
+
+        if not repo.endswith('.git'):
+            repo += '.git'
+        try:
+            backend.parse_repo_path(f"/{user}/{repo}")
+        except NotGitRepository:
+            raise BadRequestError(detail=f"invalid repository {user}/{repo}", instance=req.path)
+
+        try:
+            event = json.load(req.bounded_stream)
+            created = float(event.get('created')) if event.get('created') is not None else None
+        except (ValueError, TypeError, AttributeError):
+            raise BadRequestError(detail="invalid replication event", instance=req.path)
+
+        self.replicator.notify(user, repo, created)
+        resp.status = falcon.HTTP_202
+        resp.media = {'queued': f"{user}/{repo}"}
+
+# A replica's replication state per repository, as JSON
+class ReplicationStatusResource:
+    endpoint = 'replication'
+
+    def __init__(self, replicator):
+        self.replicator = replicator
+
+    def on_get(self, req, resp):
+        resp.media = {'primary': self.replicator.primary, 'repos': self.replicator.status()}
@@ -0,0 +1,133 @@
+import time
+import threading
+
+from hcli_core import logger
+from hcli_problem_details import *
+
+log = logger.Logger("hag")
+
+
+class _RepoState:
+
+    def __init__(self):
+        self.readers = 0
+        self.writer = False
+        self.waiting = 0
+
+    @property
+    def active(self):
+        return self.readers + (1 if self.writer else 0)
+
+# A granted admission. Released exactly once, either when the request completes or when its response stream closes.
+class Ticket:
+
+    def __init__(self, scheduler, repo_path, exclusive):
+        self._scheduler = scheduler
+        self.repo_path = repo_path
+        self.exclusive = exclusive
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._scheduler._release(self)
+
+# Admission control for the git endpoints.
+# A receive-pack holds its repo exclusively against other receive-packs only: upload-packs read packs that a push never
+# changes and refs it updates atomically, so they run alongside it, and a push neither waits on the clones in flight
+# nor holds up new ones. On top of that, the number of active requests is bounded globally, and the number of
+# upload-packs per repo, and requests that can't run right away wait in a bounded queue. When the queue is full, or a
+# request waits longer than wait_timeout, it's turned away with a 503 and Retry-After.
+class RequestScheduler:
+
+    def __init__(self, max_active=0, max_active_per_repo=0, max_queue=64, wait_timeout=30.0, retry_after=5):
+        self.max_active = max_active
+        self.max_active_per_repo = max_active_per_repo
+        self.max_queue = max_queue
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._repos = {}
+        self._cond = threading.Condition(threading.Lock())
+
+    # Changes the limits of a running scheduler. Waiting requests are re-checked against the new limits.
+    def configure(self, max_active=0, max_active_per_repo=0, max_queue=64, wait_timeout=30.0, retry_after=5):
+        with self._cond:
+            self.max_active = max_active
+            self.max_active_per_repo = max_active_per_repo
+            self.max_queue = max_queue
+            self.wait_timeout = wait_timeout
+            self.retry_after = retry_after
+            self._cond.notify_all()
+
+    def _can_run(self, state, exclusive):
+        if self.max_active > 0 and self.active >= self.max_active:
+            return False
+        if exclusive:
+            return not state.writer
+        return not (self.max_active_per_repo > 0 and state.readers >= self.max_active_per_repo)
+
+    def acquire(self, resp, repo_path, exclusive=False):
+        with self._cond:
+            state = self._repos.get(repo_path)
+            if state is None:
+                state = self._repos[repo_path] = _RepoState()
+
+            if not self._can_run(state, exclusive):
+                if self.waiting >= self.max_queue:
+                    self._reject(resp, state, repo_path, "too many queued git requests")
+
+                self.waiting += 1
+                state.waiting += 1
+
+                rejected = None
+                try:
+                    deadline = time.monotonic() + self.wait_timeout
+                    while not self._can_run(state, exclusive):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            rejected = "timed out waiting for a git request slot"
+                            break
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+                    state.waiting -= 1
+
+                if rejected is not None:
+                    self._reject(resp, state, repo_path, rejected)
+
+            if exclusive:
+                state.writer = True
+            else:
+                state.readers += 1
+            self.active += 1
+
+        return Ticket(self, repo_path, exclusive)
+
+    def _reject(self, resp, state, repo_path, reason):
+        self.rejected += 1
+        self._forget(repo_path, state)
+        log.warning(f"Rejecting git request for {repo_path}: {reason}")
+        resp.set_header('Retry-After', str(self.retry_after))
+        raise ServiceUnavailableError(detail=f"The server is busy ({reason}). Retry later.")
+
+    def _forget(self, repo_path, state):
+        if state.active == 0 and state.waiting == 0:
+            self._repos.pop(repo_path, None)
+
+    def _release(self, ticket):
+        with self._cond:
+            state = self._repos.get(ticket.repo_path)
+            if state is not None:
+                if ticket.exclusive:
+                    state.writer = False
+                else:
+                    state.readers -= 1
+                self._forget(ticket.repo_path, state)
+            self.active -= 1
+            self._cond.notify_all()
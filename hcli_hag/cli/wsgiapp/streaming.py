@@ -0,0 +1,255 @@
+import os
+import time
+import queue
+import asyncio
+import tempfile
+import threading
+
+from collections import deque
+
+from hcli_core import logger
+
+log = logger.Logger("hag")
+
+_EOF = object()
+
+
+class StreamClosed(Exception):
+    pass
+
+# dulwich's HTTPGitApplication pushes service output through the write() callable returned by start_response.
+# GitResponseStream runs dulwich on a producer thread and hands chunks over a bounded queue so that
+# the WSGI server can pull the pack as it is generated. The bounded queue pauses dulwich when the client is slow.
+class GitResponseStream:
+
+    def __init__(self, git_app, environ, queue_size=16, on_finish=None):
+        self.status = None
+        self.headers = []
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._started = threading.Event()
+        self._closed = threading.Event()
+        self.error = None
+        self.elapsed = None
+        self._on_finish = on_finish
+        self._launch(git_app, environ)
+
+    def _launch(self, git_app, environ):
+        self._thread = threading.Thread(target=self._run, args=(git_app, environ), daemon=True)
+        self._thread.start()
+
+    def _start_response(self, status, response_headers, exc_info=None):
+        self.status = status
+        self.headers = list(response_headers)
+        self._started.set()
+        return self._write
+
+    def _write(self, data):
+        if data:
+            self._put(data)
+
+    def _put(self, item):
+        while True:
+            if self._closed.is_set():
+                raise StreamClosed("client went away before the response completed")
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _run(self, git_app, environ):
+        start = time.perf_counter()
+        try:
+            result = git_app(environ, self._start_response)
+            try:
+                for chunk in result:
+                    self._write(chunk)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except StreamClosed as e:
+            log.warning(f"Git response aborted: {e}")
+        except Exception as e:
+            log.error(f"Error generating git response: {e}")
+            self.error = e
+        finally:
+            self.elapsed = time.perf_counter() - start
+            if self._on_finish is not None:
+                self._on_finish(self.elapsed)
+            self._started.set()
+            try:
+                self._put(_EOF)
+            except StreamClosed:
+                pass
+
+    # Block until dulwich has started the response (status and headers are known) or failed.
+    def wait(self):
+        self._started.wait()
+        if self.status is None:
+            if self.error is not None:
+                raise self.error
+            raise RuntimeError("git application finished without starting a response")
+
+    # A failure after the response started is raised once what was written before it has been sent, so that the
+    # server aborts the response instead of ending it as if the pack were complete
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is _EOF:
+                break
+            yield item
+        if self.error is not None:
+            raise self.error
+
+    # Called by the WSGI server once the response is done or the client disconnected.
+    def close(self):
+        self._closed.set()
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+# Runs a callback once the WSGI server closes the response iterable (e.g. to release a scheduler slot).
+class ClosingStream:
+
+    def __init__(self, stream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def __aiter__(self):
+        return aiterate(self._stream)
+
+    def close(self):
+        try:
+            if hasattr(self._stream, 'close'):
+                self._stream.close()
+        finally:
+            self._on_close()
+
+# GitResponseStream for the asyncio server. dulwich runs on a bounded executor rather than a thread of its own, and its
+# output is buffered in memory up to buffer_size bytes and spooled to a temporary file past that, so a slow client
+# doesn't hold an executor thread for the whole transfer: dulwich only waits once spool_size bytes are spooled too.
+# The response is read with async iteration on the event loop, which is woken whenever dulwich has written.
+class SpooledGitResponseStream(GitResponseStream):
+
+    def __init__(self, git_app, environ, queue_size=16, on_finish=None, loop=None, executor=None,
+                 buffer_size=1048576, spool_size=8388608, spool_dir=None, chunk_size=65536):
+        self._loop = loop
+        self._executor = executor
+        self._buffer_size = buffer_size
+        self._spool_size = spool_size
+        self._spool_dir = spool_dir
+        self._chunk_size = chunk_size
+        self._chunks = deque()
+        self._buffered = 0
+        self._spool = None
+        self._spool_start = 0
+        self._spool_end = 0
+        self._eof = False
+        self._cond = threading.Condition()
+        self._ready = asyncio.Event()
+        super().__init__(git_app, environ, queue_size, on_finish)
+
+    def _launch(self, git_app, environ):
+        self._executor.submit(self._run, git_app, environ)
+
+    def _put(self, item):
+        with self._cond:
+            while True:
+                if self._closed.is_set():
+                    raise StreamClosed("client went away before the response completed")
+                if item is _EOF:
+                    self._eof = True
+                    break
+
+                # Once something is spooled everything after it is too, until the client has caught up
+                spooled = self._spool_end - self._spool_start
+                if not spooled and (not self._chunks or self._buffered + len(item) <= self._buffer_size):
+                    self._chunks.append(item)
+                    self._buffered += len(item)
+                    break
+                if not spooled or spooled + len(item) <= self._spool_size:
+                    if self._spool is None:
+                        self._spool = tempfile.TemporaryFile(dir=self._spool_dir)
+                    os.pwrite(self._spool.fileno(), item, self._spool_end)
+                    self._spool_end += len(item)
+                    break
+                self._cond.wait(1)
+
+        self._loop.call_soon_threadsafe(self._ready.set)
+
+    # The next piece of the response, _EOF at the end, or None if dulwich hasn't written it yet
+    def _take(self):
+        with self._cond:
+            if self._closed.is_set():
+                return _EOF
+            if self._chunks:
+                data = self._chunks.popleft()
+                self._buffered -= len(data)
+            elif self._spool_end > self._spool_start:
+                data = os.pread(self._spool.fileno(), min(self._chunk_size, self._spool_end - self._spool_start),
+                                self._spool_start)
+                self._spool_start += len(data)
+                if self._spool_start == self._spool_end:
+                    self._spool.truncate(0)
+                    self._spool_start = self._spool_end = 0
+            elif self._eof:
+                return _EOF
+            else:
+                return None
+            self._cond.notify()
+            return data
+
+    def __iter__(self):
+        raise TypeError("a spooled git response is read with async iteration")
+
+    async def __aiter__(self):
+        while True:
+            self._ready.clear()
+            data = self._take()
+            if data is _EOF:
+                break
+            if data is None:
+                await self._ready.wait()
+                continue
+            yield data
+        if self.error is not None and not self._closed.is_set():
+            raise self.error
+
+    def close(self):
+        with self._cond:
+            self._closed.set()
+            self._chunks.clear()
+            self._buffered = 0
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+            self._spool_start = self._spool_end = 0
+            self._cond.notify_all()
+
+# Iterates over a response body from a coroutine. Bodies that support async iteration are read on the event loop;
+# anything else is read a piece at a time on an executor thread, so a blocking source never stalls the loop.
+async def aiterate(source, executor=None, chunk_size=65536):
+    if hasattr(source, '__aiter__'):
+        async for data in source:
+            yield data
+        return
+
+    loop = asyncio.get_running_loop()
+    if hasattr(source, 'read'):
+        while True:
+            data = await loop.run_in_executor(executor, source.read, chunk_size)
+            if not data:
+                return
+            yield data
+
+    iterator = iter(source)
+    while True:
+        data = await loop.run_in_executor(executor, next, iterator, _EOF)
+        if data is _EOF:
+            return
+        yield data
@@ -0,0 +1,183 @@
+import io
+
+from collections import deque
+
+from dulwich import server
+from dulwich.errors import GitProtocolError
+from dulwich.objects import Commit, Tag, Tree, S_ISGITLINK
+from dulwich.protocol import Protocol
+
+from hcli_hag.cli.wsgiapp import protocolv2
+
+CAPABILITY_ALLOW_TIP_SHA1_IN_WANT = b'allow-tip-sha1-in-want'
+CAPABILITY_ALLOW_REACHABLE_SHA1_IN_WANT = b'allow-reachable-sha1-in-want'
+
+
+# Lets the start of a request be looked at before dulwich parses it, replaying the lines it read ahead
+class ReadAheadProtocol:
+
+    def __init__(self, proto):
+        self._proto = proto
+        self._lines = deque()
+        self._wants = None
+
+    def __getattr__(self, name):
+        return getattr(self._proto, name)
+
+    def read_pkt_line(self):
+        if self._lines:
+            return self._lines.popleft()
+        return self._proto.read_pkt_line()
+
+    def unread_pkt_line(self, data):
+        self._lines.appendleft(data)
+
+    def eof(self):
+        return not self._lines and self._proto.eof()
+
+    # The i-th line ahead, without consuming it
+    def peek(self, i=0):
+        while len(self._lines) <= i:
+            self._lines.append(self._proto.read_pkt_line())
+        return self._lines[i]
+
+    # The object ids of the request's leading want lines
+    def wants(self):
+        if self._wants is None:
+            self._wants = []
+            i = 0
+            while True:
+                line = self.peek(i)
+                if line is None or not line.startswith(b'want '):
+                    break
+                self._wants.append(line.split()[1])
+                i += 1
+        return self._wants
+
+# Which of wants can be reached from the ref tips. The walk goes breadth first, so recent history is looked at first,
+# and only enters trees when a tree or blob is wanted; it stops as soon as every want has been found.
+def reachable(object_store, tips, wants):
+    missing = set(wants)
+    if not missing:
+        return set()
+
+    trees = any(not isinstance(object_store[sha], (Commit, Tag)) for sha in missing)
+    seen = set(tips)
+    queue = deque(tips)
+    while queue and missing:
+        sha = queue.popleft()
+        missing.discard(sha)
+        try:
+            obj = object_store[sha]
+        except KeyError:
+            continue
+
+        if isinstance(obj, Commit):
+            children = list(obj.parents) + ([obj.tree] if trees else [])
+        elif isinstance(obj, Tag):
+            children = [obj.object[1]]
+        elif isinstance(obj, Tree):
+            children = [entry.sha for entry in obj.iteritems() if not S_ISGITLINK(entry.mode)]
+        else:
+            children = []
+
+        for child in children:
+            if child not in seen:
+                seen.add(child)
+                queue.append(child)
+
+    return set(wants) - missing
+
+# Presents the objects a client wants as if they were advertised refs, so that dulwich accepts wants for any object
+# reachable from the advertised refs and not just ref tips (git's uploadpack.allowReachableSHA1InWant). A want that
+# can't be reached, such as a commit left behind by a force push, is still refused.
+# Like git, objects that are asked for by id are always sent: a request that names trees or blobs (a partial clone
+# fetching what it's missing, with its filter) is served without the filter, which would otherwise drop them.
+class AnyWantRepo:
+
+    def __init__(self, repo, handler):
+        self._repo = repo
+        self._handler = handler
+
+    def __getattr__(self, name):
+        return getattr(self._repo, name)
+
+    def find_missing_objects(self, determine_wants, graph_walker, progress, **kwargs):
+        def wants(refs, depth=None):
+            store = self._repo.object_store
+            tips = set(refs.values())
+            candidates = [sha for sha in self._handler.proto.wants() if sha not in tips]
+            found = reachable(store, tips, [sha for sha in candidates if sha in store])
+
+            # Refused like git does, with an error packet the client reports, before dulwich gives up on the request
+            for sha in candidates:
+                if sha not in found:
+                    message = f"upload-pack: not our ref {sha.decode('ascii', 'replace')}"
+                    self._handler.proto.write(protocolv2.error_line(message))
+                    raise GitProtocolError(message)
+
+            extra = {b'refs/hag/want/' + sha: sha for sha in found}
+            result = determine_wants({**refs, **extra} if extra else refs, depth)
+
+            if self._handler.filter_spec is not None and any(
+                    not isinstance(self._repo.object_store[sha], (Commit, Tag)) for sha in extra.values()):
+                self._handler.filter_spec = None
+            return result
+
+        return self._repo.find_missing_objects(wants, graph_walker, progress, **kwargs)
+
+# dulwich's upload-pack with uploadpack.allowReachableSHA1InWant semantics and protocol v2 requests.
+# Partial clones need the former: a blobless clone fetches the blobs it's missing later on by object id, and shallow
+# clones deepen from commits that may no longer be ref tips. Only stateless (HTTP) requests are affected; the
+# advertisement just gains the matching capabilities.
+# Protocol v2 requests (a body starting with command=) are answered here: ls-refs directly and fetch by running the
+# equivalent v0 request through dulwich and re-framing its response.
+class UploadPackHandler(server.UploadPackHandler):
+
+    def __init__(self, backend, args, proto, stateless_rpc=False, advertise_refs=False, any_want=True):
+        if stateless_rpc and not advertise_refs:
+            proto = ReadAheadProtocol(proto)
+        super().__init__(backend, args, proto, stateless_rpc=stateless_rpc, advertise_refs=advertise_refs)
+        self.backend = backend
+        self.args = args
+        self.any_want = any_want
+        if any_want and isinstance(proto, ReadAheadProtocol):
+            self.repo = AnyWantRepo(self.repo, self)
+
+    def capabilities(self):
+        capabilities = super().capabilities()
+        if self.any_want:
+            capabilities += [CAPABILITY_ALLOW_TIP_SHA1_IN_WANT, CAPABILITY_ALLOW_REACHABLE_SHA1_IN_WANT]
+        return capabilities
+
+    def handle(self):
+        if isinstance(self.proto, ReadAheadProtocol):
+            first = self.proto.peek()
+            if first is not None and first.startswith(b'command='):
+                self.handle_v2()
+                return
+
+        super().handle()
+
+    def handle_v2(self):
+        command, capabilities, args = protocolv2.read_command(self.proto)
+
+        if command == b'ls-refs':
+            protocolv2.ls_refs(self.repo, args, self.proto.write)
+        elif command == b'fetch':
+
+            # A fetch that can't be translated is refused before anything is written, with an error packet rather than
+            # a response that ends where the client expects a section
+            try:
+                body, done = protocolv2.fetch_request(args)
+            except GitProtocolError as e:
+                self.proto.write(protocolv2.error_line(str(e)))
+                return
+
+            writer = protocolv2.FetchResponseWriter(self.proto.write, done)
+            handler = UploadPackHandler(self.backend, self.args, Protocol(io.BytesIO(body).read, writer.write),
+                                        stateless_rpc=True, any_want=self.any_want)
+            handler.handle()
+            writer.finish()
+        else:
+            raise GitProtocolError(f"Unknown command {command!r}")
@@ -1,8 +1,9 @@
 import os
-import io
+import time
+import atexit
 import inspect
+import functools
 import falcon
-import gzip
 
 from hcli_core import config as c
 from hcli_core import logger
@@ -12,39 +13,109 @@ from hcli_core.auth.cli.authenticator import requires_authentication, requires_a
 from hcli_core.handler import HCLIErrorHandler
 from hcli_problem_details import *
 
-from dulwich.web import HTTPGitApplication
-from dulwich.server import DictBackend
-from dulwich.repo import Repo
-
-from threading import RLock
+from dulwich.web import HTTPGitApplication, NO_CACHE_HEADERS
+from dulwich.errors import NotGitRepository
 
 from hcli_hag.cli import config
+from hcli_hag.cli import maintenance
+from hcli_hag.cli import storage
+from hcli_hag.cli import stats
+from hcli_hag.cli.wsgiapp import streaming
+from hcli_hag.cli.wsgiapp import decompression
+from hcli_hag.cli.wsgiapp import compression
+from hcli_hag.cli.wsgiapp import backend
+from hcli_hag.cli.wsgiapp import refcache
+from hcli_hag.cli.wsgiapp import packcache
+from hcli_hag.cli.wsgiapp import scheduler
+from hcli_hag.cli.wsgiapp import metrics
+from hcli_hag.cli.wsgiapp import dumb
+from hcli_hag.cli.wsgiapp import hooks
+from hcli_hag.cli.wsgiapp import negotiation
+from hcli_hag.cli.wsgiapp import uploadpack
+from hcli_hag.cli.wsgiapp import protocolv2
+from hcli_hag.cli.wsgiapp import authcache
+from hcli_hag.cli.wsgiapp import ratelimit
+from hcli_hag.cli.wsgiapp import replica
+from hcli_hag.cli.wsgiapp import asgi
+from hcli_hag.cli.wsgiapp import prereceive
+from hcli_hag.cli.wsgiapp import accesslog
 
 log = logger.Logger("hag")
 
 
-def get_repos():
+# The git service a request is for (info/refs, git-upload-pack or git-receive-pack), used to label timings
+def git_service(req):
+    if req.path.endswith('/info/refs'):
+        return 'info/refs'
+    return req.path.rsplit('/', 1)[-1]
+
+# Starts dulwich on a producer thread and copies its status and headers onto the response. The asyncio server offers
+# a stream of its own, which runs dulwich on its executor, as hag.git_stream.
+def start_git_stream(req, resp, git_app):
+    stream_class = req.env.get('hag.git_stream', streaming.GitResponseStream)
+    git_stream = stream_class(git_app, req.env.copy(), config.stream_queue_size, on_finish=git_finish(req, git_app))
+    git_stream.wait()
+    resp.status = git_stream.status
+    for name, value in git_stream.headers:
+        resp.set_header(name, value)
+    return git_stream
+
+# The callback run once dulwich is done with a request, on the thread that ran it
+def git_finish(req, git_app):
+    service = git_service(req)
+
+    def finish(elapsed):
+        git_app.backend.release()
+        metrics.pack_generation.observe(elapsed, service=service)
+
+    return finish
+
+# The configured (requests per second, bytes per second) of each kind of rate limit
+def rate_limits():
+    return {'user': (config.ratelimit_user_requests, config.ratelimit_user_bytes),
+            'ip': (config.ratelimit_ip_requests, config.ratelimit_ip_bytes),
+            'repo': (config.ratelimit_repo_requests, config.ratelimit_repo_bytes)}
+
+# How many proxies in front of hag append to X-Forwarded-For, or 0 when the header isn't trusted
+def forwarded_hops():
+    return max(1, config.ratelimit_forwarded_hops) if config.ratelimit_trust_forwarded else 0
+
+# Maps a request's user and repo to the repository folder, or None if they don't name a valid repository
+def resolve_repo_path(backend, user, repo):
+    try:
+        return backend.repo_path(f"/{user}/{repo}")
+    except NotGitRepository:
+        return None
+
+# Runs handle() once the scheduler admits the request. The slot is held until a streamed response is closed
+# so that the repo lock covers pack generation; file responses (cached packs) don't need it.
+def run_scheduled(scheduler, resp, repo_path, exclusive, handle):
+    if scheduler is None or repo_path is None:
+        handle()
+        return
+
+    ticket = scheduler.acquire(resp, repo_path, exclusive=exclusive)
     try:
-        repos = {}
-        for user in os.listdir(config.repos):
-            user_path = os.path.join(config.repos, user)
-            if os.path.isdir(user_path):
-                for repo in os.listdir(user_path):
-                    if repo.endswith('.git'):
-                        repo_path = os.path.join(user_path, repo)
-                        try:
-                            repo_obj = Repo(repo_path)
-                            repos[f"/{user}/{repo}"] = repo_obj
-                        except Exception as e:
-                            log.error(f"Error loading repo {user}/{repo}: {e}")
-        return repos
-    except Exception as e:
-        log.error(f"Error scanning repos: {e}")
-        return {}
+        handle()
+    except BaseException:
+        ticket.release()
+        raise
+
+    if resp.stream is not None and not hasattr(resp.stream, 'read'):
+        resp.stream = streaming.ClosingStream(resp.stream, ticket.release)
+    else:
+        ticket.release()
 
 # Shared utility for handling Git requests
-def handle_git_request(req, resp, path, git_app):
+def handle_git_request(req, resp, path, git_app, stream=False):
+
+    # We hand dulwich's output to falcon as it is generated so that large packs never sit in memory
+    if stream:
+        resp.stream = start_git_stream(req, resp, git_app)
+        return
+
     environ = req.env.copy()
+
     response_data = []
     def start_response(status, response_headers, exc_info=None):
         resp.status = status
@@ -53,31 +124,190 @@ def handle_git_request(req, resp, path, git_app):
         def write(data):
             response_data.append(data)
         return write
-    result = git_app(environ, start_response)
-    response_data.extend(result)
+    start = time.perf_counter()
+    try:
+        result = git_app(environ, start_response)
+        response_data.extend(result)
+    finally:
+        git_app.backend.release()
     resp.data = b''.join(response_data)
+    metrics.pack_generation.observe(time.perf_counter() - start, service=git_service(req))
+
+# Answers a request from a cached ref advertisement, or with a 304 if the client already has it
+def respond_ref_advertisement(req, resp, entry):
+    resp.status = entry.status
+    for name, value in entry.headers:
+        resp.set_header(name, value)
+    resp.etag = entry.etag
+
+    if req.if_none_match and ('*' in req.if_none_match or entry.etag in req.if_none_match):
+        resp.status = falcon.HTTP_304
+        return
+
+    resp.data = entry.body
 
 class GitInfoRefsResource:
+    endpoint = 'info/refs'
 
-    def __init__(self, git_app):
+    def __init__(self, git_app, backend, ref_cache, primary=None):
         self.git_app = git_app
+        self.backend = backend
+        self.ref_cache = ref_cache
+        self.primary = primary
 
     def on_get(self, req, resp, user, repo):
-        handle_git_request(req, resp, f"{user}/{repo}/info/refs", self.git_app)
+
+        # A replica's refs may trail the primary's, so a push starts from the primary's advertisement
+        if self.primary is not None and replica.is_push(req):
+            replica.forward(req, resp, self.primary, config.replica_push, config.replica_timeout)
+            return
+
+        repo_path = resolve_repo_path(self.backend, user, repo)
+        if repo_path is None or not os.path.isdir(repo_path):
+            handle_git_request(req, resp, f"{user}/{repo}/info/refs", self.git_app)
+            return
+
+        # A protocol v2 advertisement lists capabilities only; the refs are asked for with ls-refs
+        if (config.protocol_v2 and req.get_param('service') == 'git-upload-pack' and
+                protocolv2.requested(req.get_header('Git-Protocol'))):
+            try:
+                object_format = self.backend.open_repository(f"/{user}/{repo}").object_format.name
+            finally:
+                self.backend.release()
+            resp.content_type = 'application/x-git-upload-pack-advertisement'
+            for name, value in NO_CACHE_HEADERS:
+                resp.set_header(name, value)
+            resp.data = protocolv2.capability_advertisement(object_format)
+            return
+
+        variant = (req.get_param('service'), req.get_header('Git-Protocol'))
+        entry = self.ref_cache.get(repo_path, variant)
+        if entry is None:
+
+            # We snapshot the refs state before generating so that a concurrent update is caught on revalidation
+            state = self.ref_cache.state(repo_path)
+            handle_git_request(req, resp, f"{user}/{repo}/info/refs", self.git_app)
+            if not resp.status.startswith('200'):
+                return
+
+            entry = refcache.RefAdvertisement(resp.status, list(resp.headers.items()), resp.data, state)
+            self.ref_cache.put(repo_path, variant, entry)
+
+        respond_ref_advertisement(req, resp, entry)
 
 class GitUploadPackResource:
+    endpoint = 'git-upload-pack'
 
-    def __init__(self, git_app):
+    def __init__(self, git_app, backend, pack_cache=None, scheduler=None, stats_store=None):
         self.git_app = git_app
+        self.backend = backend
+        self.pack_cache = pack_cache
+        self.scheduler = scheduler
+        self.stats_store = stats_store
 
     def on_post(self, req, resp, user, repo):
-        handle_git_request(req, resp, f"{user}/{repo}/git-upload-pack", self.git_app)
+        repo_path = resolve_repo_path(self.backend, user, repo)
+
+        # A v2 ls-refs answer is a ref listing like an advertisement, so it's compressed like one and isn't a fetch
+        command = None
+        if config.protocol_v2 and protocolv2.requested(req.get_header('Git-Protocol')):
+            command = protocolv2.peek_command(req.env, packcache.ReplayInput)
+            req.context.compress_response = command == 'ls-refs'
+
+        # The request's wants, depth and filter are picked up as the body is read so that the bytes sent can be
+        # reported per kind of clone or fetch, and clones and fetches counted in the repo statistics
+        if (config.metrics or self.stats_store is not None) and command != 'ls-refs':
+            req.context.fetch_request = negotiation.FetchRequest()
+            req.env['wsgi.input'] = negotiation.SniffingInput(req.env['wsgi.input'], req.context.fetch_request)
+
+        def handle():
+            if self.pack_cache is not None and repo_path is not None:
+                if self.handle_cached(req, resp, user, repo, repo_path):
+                    return
+
+            handle_git_request(req, resp, f"{user}/{repo}/git-upload-pack", self.git_app,
+                               stream=config.stream_upload_pack)
+
+        run_scheduled(self.scheduler, resp, repo_path, False, handle)
+
+        if self.stats_store is not None and repo_path is not None and command != 'ls-refs':
+            self.count_fetch(req, resp, user, os.path.basename(repo_path))
+
+    # Counts a clone or fetch in the repo statistics once its request has been read, which for a streamed response
+    # is only certain when the stream is closed
+    def count_fetch(self, req, resp, user, repo):
+        def count():
+            fetch = req.context.fetch_request
+            if resp.status_code == 200 and fetch.wants:
+                self.stats_store.count(f"{user}/{repo}", 'clones' if fetch.kind == 'clone' else 'fetches')
+
+        if resp.stream is not None and not hasattr(resp.stream, 'read'):
+            resp.stream = streaming.ClosingStream(resp.stream, count)
+        else:
+            count()
+
+    # Serves a complete clone/fetch request from the pack cache. Identical concurrent requests are coalesced:
+    # the first one has dulwich generate the pack into the cache and all of them stream it as it is written.
+    # Returns False when the request has to be handled by dulwich without the cache.
+    def handle_cached(self, req, resp, user, repo, repo_path):
+        body, complete = packcache.read_request_body(req.env, config.pack_cache_request_max)
+        if not complete:
+            req.env['wsgi.input'] = packcache.ReplayInput(body, req.env['wsgi.input'])
+            return False
+
+        req.env['wsgi.input'] = packcache.ReplayInput(body)
+        req.env['CONTENT_LENGTH'] = str(len(body))
+        req.env.pop('HTTP_TRANSFER_ENCODING', None)
+
+        key = packcache.request_key(repo_path, body)
+        if key is None or not os.path.isdir(repo_path):
+            return False
+
+        cached = self.pack_cache.open(repo_path, key)
+        if cached is not None:
+            resp.status = falcon.HTTP_200
+            resp.content_type = 'application/x-git-upload-pack-result'
+            for name, value in NO_CACHE_HEADERS:
+                resp.set_header(name, value)
+            resp.content_length = os.fstat(cached.fileno()).st_size
+            resp.stream = cached
+            return True
+
+        def start(path):
+            return packcache.PackFill(self.pack_cache, path, key, self.git_app, req.env.copy(),
+                                      on_finish=git_finish(req, self.git_app), executor=req.env.get('hag.git_executor'))
+
+        try:
+            reader = self.pack_cache.fill(repo_path, key, start)
+        except OSError as e:
+            log.warning(f"Unable to cache pack for {user}/{repo}: {e}")
+            return False
+
+        try:
+            reader.fill.wait()
+        except Exception:
+            reader.close()
+            raise
+
+        resp.status = reader.fill.status
+        for name, value in reader.fill.headers:
+            resp.set_header(name, value)
+        resp.stream = reader
+        return True
 
 @requires_authentication
 class GitReceivePackResource:
+    endpoint = 'git-receive-pack'
 
-    def __init__(self, git_app):
+    def __init__(self, git_app, backend, ref_cache, pack_cache=None, scheduler=None, maintenance=None,
+                 stats_store=None):
         self.git_app = git_app
+        self.backend = backend
+        self.ref_cache = ref_cache
+        self.pack_cache = pack_cache
+        self.scheduler = scheduler
+        self.maintenance = maintenance
+        self.stats_store = stats_store
 
     def on_post(self, req, resp, user, repo):
 
@@ -92,42 +322,451 @@ class GitReceivePackResource:
                 instance=req.path
             )
 
-        handle_git_request(req, resp, f"{user}/{repo}/git-receive-pack", self.git_app)
+        # Pushes hold the repo exclusively against other pushes so that concurrent ref updates can't race (fetches
+        # carry on alongside), and keep it from being moved to another storage root while they write
+        repo_path = resolve_repo_path(self.backend, user, repo)
+        if repo_path is None:
+            handle_git_request(req, resp, f"{user}/{repo}/git-receive-pack", self.git_app)
+            return
+
+        with self.backend.storage.push_lock(user, repo) as repo_path:
+            limits = self.receive_limits(req, user, repo_path)
+            if not limits:
+                run_scheduled(self.scheduler, resp, repo_path, True,
+                              lambda: handle_git_request(req, resp, f"{user}/{repo}/git-receive-pack", self.git_app))
+            else:
+                req.env['wsgi.input'] = prereceive.ReceiveInput(req.env['wsgi.input'], limits,
+                                                                self.hash_size(user, repo, limits),
+                                                                config.stream_chunk_size)
+                partial_packs = prereceive.partial_packs(repo_path)
+                try:
+                    run_scheduled(self.scheduler, resp, repo_path, True,
+                                  lambda: handle_git_request(req, resp, f"{user}/{repo}/git-receive-pack",
+                                                             self.git_app))
+                finally:
+                    if limits.rejected:
+                        prereceive.remove_partial_packs(repo_path, partial_packs)
+
+        # Refs may have moved so the cached advertisement and packs for this repo can no longer be trusted
+        if resp.status.startswith('200') and repo_path is not None:
+            self.ref_cache.invalidate(repo_path)
+            if self.pack_cache is not None:
+                self.pack_cache.invalidate(repo_path)
+            if self.maintenance is not None:
+                self.maintenance.record_push(repo_path)
+            if self.stats_store is not None:
+                try:
+                    stats.record_push(self.stats_store, user, os.path.basename(repo_path), repo_path)
+                except OSError as e:
+                    log.warning(f"Unable to update the statistics of {user}/{repo}: {e}")
+
+    # The limits a push to repo_path is held to while its pack is read. The quotas are worked out from the repository
+    # statistics, measuring repositories that have none yet.
+    def receive_limits(self, req, user, repo_path):
+        quotas = []
+        try:
+            if config.quota_repo > 0:
+                used = prereceive.repo_usage(self.stats_store, user, os.path.basename(repo_path), repo_path)
+                quotas.append((f"{user}/{os.path.basename(repo_path)}", config.quota_repo, used))
+            if config.quota_user > 0:
+                used = prereceive.user_usage(self.stats_store, self.backend.storage, user)
+                quotas.append((f"user {user}", config.quota_user, used))
+        except OSError as e:
+            log.warning(f"Unable to measure the disk usage of {user}: {e}")
+
+        return prereceive.ReceiveLimits(max_pack_size=config.receive_max_pack_size,
+                                        max_blob_size=config.receive_max_blob_size,
+                                        quotas=quotas,
+                                        instance=req.path)
+
+    # The length of the object ids in the repository's packs, which only matters to following objects one by one
+    def hash_size(self, user, repo, limits):
+        if limits.max_blob_size <= 0:
+            return 20
+        try:
+            return self.backend.open_repository(f"/{user}/{repo}").object_format.oid_length
+        finally:
+            self.backend.release()
+
+# A replica's git-receive-pack: pushes go to the primary, which authenticates them
+class GitReceivePackForwardingResource:
+    endpoint = 'git-receive-pack'
+
+    def __init__(self, primary):
+        self.primary = primary
+
+    def on_post(self, req, resp, user, repo):
+        replica.forward(req, resp, self.primary, config.replica_push, config.replica_timeout)
+
+# Resolves the repository folder for a dumb HTTP request, or answers 404
+def dumb_repo_path(req, backend, user, repo):
+    repo_path = resolve_repo_path(backend, user, repo)
+    if repo_path is None or not os.path.isdir(repo_path):
+        raise NotFoundError(detail=f"No git repository was found at {user}/{repo}", instance=req.path)
+    return repo_path
+
+# Dumb HTTP transport: static repository files for clients and mirrors that don't speak the smart protocol.
+# Files are served through wsgi.file_wrapper so that the WSGI server can sendfile them.
+class GitDumbHeadResource:
+    endpoint = 'dumb'
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def on_get(self, req, resp, user, repo):
+        repo_path = dumb_repo_path(req, self.backend, user, repo)
+        f = dumb.open_file(req, os.path.join(repo_path, 'HEAD'))
+        dumb.serve_file(req, resp, f, 'text/plain')
+
+    on_head = on_get
+
+class GitDumbInfoPacksResource:
+    endpoint = 'dumb'
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def on_get(self, req, resp, user, repo):
+        repo_path = dumb_repo_path(req, self.backend, user, repo)
+        resp.content_type = 'text/plain; charset=utf-8'
+        resp.cache_control = [dumb.NO_CACHE]
+        resp.data = dumb.info_packs(repo_path)
+
+    on_head = on_get
+
+class GitDumbPackResource:
+    endpoint = 'dumb'
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def on_get(self, req, resp, user, repo, name):
+        match = dumb.PACK_NAME.match(name)
+        if not match:
+            raise NotFoundError(detail=f"{req.path} was not found.", instance=req.path)
+
+        repo_path = dumb_repo_path(req, self.backend, user, repo)
+        f = dumb.open_file(req, os.path.join(repo_path, 'objects', 'pack', name))
+        try:
+            etag = dumb.trailer_checksum(f, os.fstat(f.fileno()).st_size, len(match.group(1)) // 2)
+        except OSError:
+            f.close()
+            raise
+
+        dumb.serve_file(req, resp, f, dumb.PACK_CONTENT_TYPES[match.group(2)], etag, dumb.CACHE_FOREVER)
+
+    on_head = on_get
+
+class GitDumbLooseObjectResource:
+    endpoint = 'dumb'
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def on_get(self, req, resp, user, repo, prefix, suffix):
+        if not dumb.LOOSE_DIR.match(prefix) or not dumb.LOOSE_NAME.match(suffix):
+            raise NotFoundError(detail=f"{req.path} was not found.", instance=req.path)
+
+        # Loose objects are named by their id so the id is a stable validator
+        repo_path = dumb_repo_path(req, self.backend, user, repo)
+        f = dumb.open_file(req, os.path.join(repo_path, 'objects', prefix, suffix))
+        dumb.serve_file(req, resp, f, dumb.LOOSE_CONTENT_TYPE, prefix + suffix, dumb.CACHE_FOREVER)
+
+    on_head = on_get
 
 class GzipDecompressionMiddleware:
     def process_request(self, req, resp):
         # Check if the request has a Content-Encoding: gzip header
         if req.get_header('Content-Encoding') == 'gzip':
-            try:
-
-                # Read and decompress the request body
-                compressed_data = req.bounded_stream.read()
-                decompressed_data = gzip.decompress(compressed_data)
 
-                # Update the WSGI environment with the decompressed data
-                req.env['wsgi.input'] = io.BytesIO(decompressed_data)
+            # Decompress the request body on demand as dulwich reads from it
+            req.env['wsgi.input'] = decompression.GzipInputStream(req.bounded_stream,
+                                                                  max_size=config.gzip_max_size,
+                                                                  chunk_size=config.stream_chunk_size)
+            req.context.gzip_input = req.env['wsgi.input']
 
-                # Update Content-Length to reflect the decompressed data size
-                req.env['CONTENT_LENGTH'] = str(len(decompressed_data))
+            # The decompressed length isn't known up front so the body is read until the gzip stream ends
+            req.env.pop('CONTENT_LENGTH', None)
 
-                # Remove the Content-Encoding header to prevent downstream confusion
-                del req.headers['Content-Encoding'.upper()]
-
-            except gzip.BadGzipFile as e:
-                raise BadRequestError( detail=f"The gzip-compressed request body could not be decompressed.")
+            # Remove the Content-Encoding header to prevent downstream confusion
+            req.env.pop('HTTP_CONTENT_ENCODING', None)
 
 class WSGIApp(HCLICoreWSGIApp):
     def __init__(self, name, plugin_path=None, config_path=None):
         super().__init__(name, plugin_path, config_path)
-        self.git_app = HTTPGitApplication(backend=DictBackend(get_repos()))
+        self.backend = backend.RepoBackend(storage.get_storage(),
+                                           max_size=config.repo_cache_size,
+                                           idle_timeout=config.repo_cache_idle,
+                                           max_copies=config.repo_cache_copies)
+
+        # Pushes are handed to the post-receive pipeline from dulwich's receive-pack handler, where the applied
+        # ref updates are known
+        # A primary's replicas are notified of pushes by the same pipeline
+        self.hook_pipeline = None
+        handlers = {b'git-upload-pack': functools.partial(uploadpack.UploadPackHandler,
+                                                          any_want=config.upload_any_want)}
+        if config.hooks_scripts or config.hooks_callables or config.replica_peers:
+            notifiers = [replica.ReplicaNotifier(peer, token=config.replica_token, timeout=config.replica_timeout)
+                         for peer in config.replica_peers]
+            self.hook_pipeline = hooks.HookPipeline(config.hooks_spool_dir,
+                                                    hooks.load_hooks(config.hooks_scripts, config.hooks_callables,
+                                                                     timeout=config.hooks_timeout) + notifiers,
+                                                    workers=config.hooks_workers,
+                                                    max_queue=config.hooks_queue_size,
+                                                    retries=config.hooks_retries,
+                                                    backoff=config.hooks_backoff,
+                                                    max_backoff=config.hooks_backoff_max)
+            self.hook_pipeline.start()
+            handlers[b'git-receive-pack'] = functools.partial(hooks.NotifyingReceivePackHandler,
+                                                              on_receive=self.hook_pipeline.submit)
+        self.git_app = HTTPGitApplication(backend=self.backend, handlers=handlers)
+        self.ref_cache = refcache.RefAdvertisementCache(max_size=config.refs_cache_size,
+                                                        ttl=config.refs_cache_ttl)
+        self.pack_cache = None
+        if config.pack_cache:
+            self.pack_cache = packcache.PackCache(config.pack_cache_dir, max_size=config.pack_cache_size)
+        self.scheduler = scheduler.RequestScheduler(max_active=config.scheduler_max_active,
+                                                    max_active_per_repo=config.scheduler_max_active_repo,
+                                                    max_queue=config.scheduler_queue_size,
+                                                    wait_timeout=config.scheduler_queue_timeout,
+                                                    retry_after=config.scheduler_retry_after)
+        self.stats_store = stats.get_store() if config.stats else None
+        self.replicator = None
+        if config.replica_primary:
+            self.replicator = replica.Replicator(config.replica_primary, self.backend.storage,
+                                                 on_synced=self.replica_synced,
+                                                 workers=config.replica_workers,
+                                                 timeout=config.replica_timeout)
+        self.rate_limiter = None
+        if config.ratelimit:
+            self.rate_limiter = ratelimit.RateLimiter(rate_limits(),
+                                                      burst=config.ratelimit_burst,
+                                                      max_delay=config.ratelimit_max_delay,
+                                                      max_keys=config.ratelimit_max_keys)
+        self.maintenance = None
+        if config.maintenance:
+            self.maintenance = maintenance.Maintenance(scheduler=self.scheduler,
+                                                       on_done=self.maintenance_done,
+                                                       workers=config.maintenance_workers,
+                                                       push_threshold=config.maintenance_pushes,
+                                                       loose_threshold=config.maintenance_loose_objects,
+                                                       pack_threshold=config.maintenance_packs,
+                                                       max_active=config.maintenance_max_active,
+                                                       idle_wait=config.maintenance_idle_wait,
+                                                       max_wait=config.maintenance_max_wait,
+                                                       grace_period=config.maintenance_prune_grace,
+                                                       max_size=config.maintenance_max_size)
+        self.access_log = None
+        if config.access_log:
+            self.access_log = accesslog.AccessLog(config.access_log,
+                                                  sample_rate=config.access_log_sample,
+                                                  max_queue=config.access_log_queue_size)
+            self.access_log.start()
+            atexit.register(self.access_log.stop)
+        self.auth_cache = None
+        self.access_log_middleware = None
+        self.rate_limit_middleware = None
+        self.compression = None
+        self.metrics_middleware = None
+        self.register_metrics()
+        config.settings.on_reload(self.apply_config)
+
+    # Pushes the knobs that can be tuned on a running server into the long lived objects that hold them, after the
+    # config file changed. Shrunk caches are trimmed on their next insertion.
+    def apply_config(self):
+        self.backend.max_size = config.repo_cache_size
+        self.backend.max_copies = config.repo_cache_copies
+        self.backend.idle_timeout = config.repo_cache_idle
+        self.ref_cache.max_size = config.refs_cache_size
+        self.ref_cache.ttl = config.refs_cache_ttl
+        if self.pack_cache is not None:
+            self.pack_cache.max_size = config.pack_cache_size
+        self.scheduler.configure(max_active=config.scheduler_max_active,
+                                 max_active_per_repo=config.scheduler_max_active_repo,
+                                 max_queue=config.scheduler_queue_size,
+                                 wait_timeout=config.scheduler_queue_timeout,
+                                 retry_after=config.scheduler_retry_after)
+        if self.stats_store is not None:
+            self.stats_store.journal_max = config.stats_journal_max
+            self.stats_store.flush_interval = config.stats_flush_interval
+        if self.rate_limiter is not None:
+            self.rate_limiter.configure(rate_limits(),
+                                        burst=config.ratelimit_burst,
+                                        max_delay=config.ratelimit_max_delay,
+                                        max_keys=config.ratelimit_max_keys)
+        if self.rate_limit_middleware is not None:
+            self.rate_limit_middleware.chunk_size = config.stream_chunk_size
+            self.rate_limit_middleware.forwarded_hops = forwarded_hops()
+        if self.maintenance is not None:
+            self.maintenance.push_threshold = config.maintenance_pushes
+            self.maintenance.loose_threshold = config.maintenance_loose_objects
+            self.maintenance.pack_threshold = config.maintenance_packs
+            self.maintenance.max_active = config.maintenance_max_active
+            self.maintenance.idle_wait = config.maintenance_idle_wait
+            self.maintenance.max_wait = config.maintenance_max_wait
+            self.maintenance.grace_period = config.maintenance_prune_grace
+            self.maintenance.max_size = config.maintenance_max_size
+        if self.hook_pipeline is not None:
+            self.hook_pipeline.max_queue = config.hooks_queue_size
+            self.hook_pipeline.retries = config.hooks_retries
+            self.hook_pipeline.backoff = config.hooks_backoff
+            self.hook_pipeline.max_backoff = config.hooks_backoff_max
+        if self.auth_cache is not None:
+            self.auth_cache.max_size = config.auth_cache_size
+            self.auth_cache.ttl = config.auth_cache_ttl
+        if self.compression is not None:
+            self.compression.level = config.gzip_level
+            self.compression.min_size = config.gzip_min_size
+            self.compression.chunk_size = config.stream_chunk_size
+        if self.metrics_middleware is not None:
+            self.metrics_middleware.max_repos = config.metrics_max_repos
+        if self.access_log is not None:
+            self.access_log.sample_rate = config.access_log_sample
+        if self.access_log_middleware is not None:
+            self.access_log_middleware.forwarded_hops = forwarded_hops()
+
+    # After a repack the cached repo object still lists the removed packs, so it's reopened on next use, and the
+    # repo's statistics are measured again
+    def maintenance_done(self, repo_path):
+        user, repo = os.path.basename(os.path.dirname(repo_path)), os.path.basename(repo_path)
+        self.backend.invalidate(f"/{user}/{repo}")
+        self.ref_cache.invalidate(repo_path)
+        if self.stats_store is not None:
+            try:
+                stats.record_scan(self.stats_store, user, repo, repo_path)
+            except OSError as e:
+                log.warning(f"Unable to update the statistics of {user}/{repo}: {e}")
+
+    # A replica's copy of a repo changed like it does after a push
+    def replica_synced(self, user, repo, repo_path):
+        self.backend.invalidate(f"/{user}/{repo}")
+        self.ref_cache.invalidate(repo_path)
+        if self.pack_cache is not None:
+            self.pack_cache.invalidate(repo_path)
+        if self.maintenance is not None:
+            self.maintenance.record_push(repo_path)
+        if self.stats_store is not None:
+            stats.record_push(self.stats_store, user, repo, repo_path)
+
+    # Exposes the cache and scheduler counters, which are read from the live objects at scrape time
+    def register_metrics(self):
+        def caches():
+            yield 'repos', self.backend
+            yield 'refs', self.ref_cache
+            if self.pack_cache is not None:
+                yield 'packs', self.pack_cache
+            if self.auth_cache is not None:
+                yield 'auth', self.auth_cache
+
+        def ratio(cache):
+            total = cache.hits + cache.misses
+            return cache.hits / total if total else 0.0
+
+        registry = metrics.registry
+        registry.callback('hag_cache_hits_total', 'Cache lookups that were answered from the cache.', 'counter',
+                          ('cache',), lambda: [((name,), cache.hits) for name, cache in caches()])
+        registry.callback('hag_cache_misses_total', 'Cache lookups that were not answered from the cache.', 'counter',
+                          ('cache',), lambda: [((name,), cache.misses) for name, cache in caches()])
+        registry.callback('hag_cache_hit_ratio', 'Share of cache lookups answered from the cache.', 'gauge',
+                          ('cache',), lambda: [((name,), ratio(cache)) for name, cache in caches()])
+        registry.callback('hag_cache_entries', 'Entries currently held by each cache.', 'gauge',
+                          ('cache',), lambda: [((name,), len(cache)) for name, cache in caches()])
+        registry.callback('hag_scheduler_active', 'Git requests currently admitted by the scheduler.', 'gauge',
+                          (), lambda: [((), self.scheduler.active)])
+        registry.callback('hag_scheduler_waiting', 'Git requests waiting for a scheduler slot.', 'gauge',
+                          (), lambda: [((), self.scheduler.waiting)])
+        registry.callback('hag_scheduler_rejected_total', 'Git requests turned away with a 503.', 'counter',
+                          (), lambda: [((), self.scheduler.rejected)])
+        if self.hook_pipeline is not None:
+            registry.callback('hag_hooks_delivered_total', 'Post-receive events delivered to every hook.', 'counter',
+                              (), lambda: [((), self.hook_pipeline.delivered)])
+            registry.callback('hag_hooks_retries_total', 'Post-receive event deliveries scheduled for a retry.',
+                              'counter', (), lambda: [((), self.hook_pipeline.retried)])
+            registry.callback('hag_hooks_failed_total', 'Post-receive events given up on after the last retry.',
+                              'counter', (), lambda: [((), self.hook_pipeline.failed)])
+            registry.callback('hag_hooks_queued', 'Post-receive events waiting for delivery.', 'gauge',
+                              (), lambda: [((), self.hook_pipeline.queued)])
+        if self.rate_limiter is not None:
+            registry.callback('hag_ratelimit_rejected_total', 'Git requests turned away with a 429, by the kind of limit.',
+                              'counter', ('kind',),
+                              lambda: [((kind,), count) for kind, count in self.rate_limiter.rejected.items()])
+            registry.callback('hag_ratelimit_throttled_seconds_total', 'Time responses were held back by bandwidth limits.',
+                              'counter', (), lambda: [((), self.rate_limiter.throttled)])
+        if self.replicator is not None:
+            registry.callback('hag_replica_syncs_total', 'Repositories synced from the primary.', 'counter',
+                              (), lambda: [((), self.replicator.syncs)])
+            registry.callback('hag_replica_failures_total', 'Failed syncs from the primary.', 'counter',
+                              (), lambda: [((), self.replicator.failures)])
+            registry.callback('hag_replica_behind', 'Repositories behind the primary.', 'gauge',
+                              (), lambda: [((), sum(1 for s in self.replicator.status().values() if s['pending']))])
+            registry.callback('hag_replica_lag_seconds', 'How far the furthest behind repository trails the primary.',
+                              'gauge', (), lambda: [((), max((s['lag'] for s in self.replicator.status().values()),
+                                                             default=0.0))])
+        if self.access_log is not None:
+            registry.callback('hag_access_log_dropped_total', 'Access log entries dropped because the writer fell behind.',
+                              'counter', (), lambda: [((), self.access_log.dropped)])
+        if self.maintenance is not None:
+            registry.callback('hag_maintenance_runs_total', 'Completed background maintenance runs.', 'counter',
+                              (), lambda: [((), self.maintenance.runs)])
+            registry.callback('hag_maintenance_failures_total', 'Failed background maintenance runs.', 'counter',
+                              (), lambda: [((), self.maintenance.failures)])
+            registry.callback('hag_maintenance_queued', 'Repositories waiting for background maintenance.', 'gauge',
+                              (), lambda: [((), self.maintenance.queued)])
 
     def server(self):
-        server = falcon.App(middleware=[GzipDecompressionMiddleware(),
-                                        authenticator.SelectiveAuthenticationMiddleware(self.name)])
+        # Authentication keeps its place in the chain; the caching variant only answers repeat checks of credentials
+        # that were verified before
+        authentication = authenticator.SelectiveAuthenticationMiddleware(self.name)
+        if config.auth_cache:
+            authentication = authcache.CachingAuthenticationMiddleware(self.name, max_size=config.auth_cache_size,
+                                                                       ttl=config.auth_cache_ttl)
+            self.auth_cache = authentication.cache
+        middleware = [GzipDecompressionMiddleware(), authentication]
+
+        # Rate limits apply once the user is known, and pace the response before it's compressed
+        if self.rate_limiter is not None:
+            self.rate_limit_middleware = ratelimit.RateLimitMiddleware(self.rate_limiter,
+                                                                       chunk_size=config.stream_chunk_size,
+                                                                       forwarded_hops=forwarded_hops())
+            middleware.append(self.rate_limit_middleware)
+        if config.gzip_response:
+            self.compression = compression.GzipCompressionMiddleware(level=config.gzip_level,
+                                                                     min_size=config.gzip_min_size,
+                                                                     chunk_size=config.stream_chunk_size)
+            middleware.insert(0, self.compression)
+        if config.metrics:
+            self.metrics_middleware = metrics.MetricsMiddleware(max_repos=config.metrics_max_repos)
+            middleware.insert(0, self.metrics_middleware)
+
+        # Outermost, so that it sees the final status and the bytes on the wire
+        if self.access_log is not None:
+            self.access_log_middleware = accesslog.AccessLogMiddleware(self.access_log,
+                                                                       forwarded_hops=forwarded_hops())
+            middleware.insert(0, self.access_log_middleware)
+
+        server = falcon.App(middleware=middleware)
         error_handler = HCLIErrorHandler()
         server.add_error_handler(falcon.HTTPError, error_handler)
         server.add_error_handler(ProblemDetail, error_handler)
-        server.add_route('/{user}/{repo}/info/refs', GitInfoRefsResource(self.git_app), methods=['GET'])
-        server.add_route('/{user}/{repo}/git-upload-pack', GitUploadPackResource(self.git_app), methods=['POST'])
-        server.add_route('/{user}/{repo}/git-receive-pack', GitReceivePackResource(self.git_app), methods=['POST'])
+        primary = self.replicator.primary if self.replicator is not None else None
+        server.add_route('/{user}/{repo}/info/refs', GitInfoRefsResource(self.git_app, self.backend, self.ref_cache, primary), methods=['GET'])
+        server.add_route('/{user}/{repo}/git-upload-pack', GitUploadPackResource(self.git_app, self.backend, self.pack_cache, self.scheduler, self.stats_store), methods=['POST'])
+        if self.replicator is not None:
+            server.add_route('/{user}/{repo}/git-receive-pack', GitReceivePackForwardingResource(primary), methods=['POST'])
+            server.add_route('/{user}/{repo}/hag-replicate', replica.ReplicateResource(self.replicator, config.replica_token), methods=['POST'])
+            server.add_route('/replication', replica.ReplicationStatusResource(self.replicator), methods=['GET'])
+        else:
+            server.add_route('/{user}/{repo}/git-receive-pack', GitReceivePackResource(self.git_app, self.backend, self.ref_cache, self.pack_cache, self.scheduler, self.maintenance, self.stats_store), methods=['POST'])
+        server.add_route('/{user}/{repo}/HEAD', GitDumbHeadResource(self.backend), methods=['GET', 'HEAD'])
+        server.add_route('/{user}/{repo}/objects/info/packs', GitDumbInfoPacksResource(self.backend), methods=['GET', 'HEAD'])
+        server.add_route('/{user}/{repo}/objects/pack/{name}', GitDumbPackResource(self.backend), methods=['GET', 'HEAD'])
+        server.add_route('/{user}/{repo}/objects/{prefix}/{suffix}', GitDumbLooseObjectResource(self.backend), methods=['GET', 'HEAD'])
+        if config.metrics:
+            server.add_route('/metrics', metrics.MetricsResource(metrics.registry), methods=['GET'])
         return server
+
+    # The same app for an asyncio (ASGI) server: falcon's asyncio app serving the routes and middleware above, with
+    # git responses generated on a bounded pool of threads and sent from the event loop
+    def asgi_server(self):
+        return asgi.asgi_app(self.server(), self.name, workers=config.asgi_workers, git_workers=config.asgi_git_workers,
+                             push_workers=config.asgi_push_workers)
@@ -1,9 +1,8 @@
 import sys
 import os
 import importlib
-import inspect
 
-root = os.path.dirname(inspect.getfile(lambda: None))
+root = os.path.dirname(os.path.abspath(__file__))
 hcli_hag_manpage_path = root + "/data/hcli_hag.1"
 plugin_path = root + "/cli"
 cli = None
@@ -0,0 +1,54 @@
+import os
+import sys
+import zlib
+
+# Rendered man pages are cached here, one file per man page content and terminal width
+cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'hcli_hag')
+
+
+# The terminal width the way shutil.get_terminal_size() finds it (COLUMNS, then stdout), falling back to 80
+def terminal_width():
+    try:
+        columns = int(os.environ['COLUMNS'])
+    except (KeyError, ValueError):
+        columns = 0
+
+    if columns <= 0:
+        try:
+            columns = os.get_terminal_size(sys.__stdout__.fileno()).columns
+        except (AttributeError, ValueError, OSError):
+            columns = 0
+
+    return columns if columns > 0 else 80
+
+# Renders a man page (file) for the terminal. The text is cached on disk keyed by a checksum of the man page and the
+# width, so repeated calls only read two small files and the troff parser (re, textwrap) is never imported.
+# A cache that can't be written to just means rendering every time.
+def render(path, width=None):
+    if width is None:
+        width = terminal_width()
+
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    name = f"{os.path.basename(path)}-{zlib.crc32(content):08x}-{len(content)}-{width}.txt"
+    cache_path = os.path.join(cache_dir, name)
+    try:
+        with open(cache_path, 'rb') as f:
+            return f.read()
+    except OSError:
+        pass
+
+    from . import troff
+    text = troff.troff_to_text(content.decode('utf-8'), width).encode('utf-8')
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(text)
+        os.replace(tmp, cache_path)
+    except OSError:
+        pass
+
+    return text